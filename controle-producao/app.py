@@ -1,25 +1,33 @@
 # app.py (VERSÃO COMPLETA - SEM CORTES)
 
 import json
+import re
 from datetime import date, datetime, time, timedelta
-from sqlalchemy import func, extract, or_
-from collections import defaultdict
+from sqlalchemy import func, extract, or_, and_, case, cast, bindparam
+from sqlalchemy.exc import IntegrityError
+from collections import defaultdict, OrderedDict
+import io
 import os
 import csv
+import codecs
 from decimal import Decimal, InvalidOperation
 import click
 from functools import wraps
+from time import monotonic, sleep
+from threading import Lock, Thread
+from queue import Queue, Empty, Full
 
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from dotenv import load_dotenv
 
 # ==================== IMPORTAÇÕES DE MODELOS E FORMS ====================
 from models import (
-    db, User, OS, OSVersao, OrdemProducao, Romaneio, ControleProducao, Produto,
+    db, User, OS, OSVersao, consolidado_pronto, marcar_consolidado_pronto, codificar_snapshot, decodificar_snapshot, FORMATO_SNAPSHOT_DELTA, codificar_revisao, reconstrutor_revisoes, chave_item_snapshot, OSKpiMensal, inicio_do_mes, proximo_mes, OSDimensao, CAMPOS_DIMENSAO_OS, OrdemProducao, Romaneio, ControleProducao, AlteracaoProducao, Produto,
     Apontamento, ParadaNaoPlanejada, Despesa, CustoOperacional, CustoVisita, Carregamento,
-    OSManutencao, ManutApont, 
+    OSManutencao, ManutApont, alocador_numeros, duracoes_trabalhadas, segundos_trabalhados, inicio_semana, duracao_maxima_os,
+    catalogo_produtos, marcar_versao_cadastro, OEETurno, CAMPOS_OEE, aplicar_oee_em_lote, EventoApontamento, PostoMaquina, SEGUNDOS_DIA,
     # Novos Models
     Fornecedor, SolicitacaoCompra, SolicitacaoItem, PedidoCompra, PedidoItem, TipoFornecedor
 )
@@ -42,6 +50,15 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = 'uma-chave-secreta-muito-dificil-de-adivinhar-troque-depois'
 app.config['SQLALCHEMY_DATABASE_URI'] = f"mysql+pymysql://{os.environ.get('DB_USER')}:{os.environ.get('DB_PASS')}@{os.environ.get('DB_HOST')}/{os.environ.get('DB_NAME')}"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['OS_POR_PAGINA'] = int(os.environ.get('OS_POR_PAGINA', 50))
+app.config['OP_POR_PAGINA'] = int(os.environ.get('OP_POR_PAGINA', 50))
+app.config['CACHE_REFERENCIA_SEGUNDOS'] = int(os.environ.get('CACHE_REFERENCIA_SEGUNDOS', 600))
+# Números de documento reservados por vez em cada processo (1 = sem lacunas ao reiniciar)
+app.config['NUMERACAO_BLOCO'] = int(os.environ.get('NUMERACAO_BLOCO', 1))
+app.config['CACHE_RELATORIOS_SEGUNDOS'] = int(os.environ.get('CACHE_RELATORIOS_SEGUNDOS', 300))
+app.config['QUADRO_INTERVALO_SEGUNDOS'] = float(os.environ.get('QUADRO_INTERVALO_SEGUNDOS', 2))
+# De quanto em quanto tempo cada processo confere se o cadastro de produtos mudou
+app.config['CATALOGO_CONFERIR_SEGUNDOS'] = float(os.environ.get('CATALOGO_CONFERIR_SEGUNDOS', 2))
 
 # === CORREÇÃO DE QUEDAS DE CONEXÃO (POOL PRE-PING) ===
 app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
@@ -53,6 +70,8 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
 
 db.init_app(app)
 
+catalogo_produtos.intervalo = app.config['CATALOGO_CONFERIR_SEGUNDOS']
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
@@ -72,10 +91,13 @@ def format_currency(value):
     except:
         return str(value)
 
-@app.template_filter('from_json')
-def from_json_filter(s):
-    import json
-    return json.loads(s)
+@app.template_filter('format_duracao')
+def format_duracao(segundos):
+    """Segundos -> 'HH:MM' (horas podem passar de 24); None -> '-'."""
+    if segundos is None:
+        return "-"
+    horas, resto = divmod(int(segundos), 3600)
+    return f"{horas:02d}:{resto // 60:02d}"
 
 def alchemy_encoder(obj):
     if isinstance(obj, (date, datetime)):
@@ -86,6 +108,374 @@ def alchemy_encoder(obj):
         return obj.strftime('%H:%M')
     return None
 
+def kpis_mes_os(referencia):
+    """KPIs do mês direto da tabela os, em uma consulta.
+
+    Usa SUM(CASE ...) e faixas de data semiabertas ([início, próximo mês)) para
+    aproveitar os índices compostos de OS em vez de extract() nas colunas.
+    """
+    inicio = inicio_do_mes(referencia)
+    fim = proximo_mes(inicio)
+    emitida_no_mes = and_(OS.data_emissao >= inicio, OS.data_emissao < fim)
+    concluida_no_mes = and_(OS.status == 'Concluída', OS.data_conclusao >= inicio, OS.data_conclusao < fim)
+    em_aberto = and_(OS.fase == 'OS', OS.status.in_(['Aberta', 'Em Andamento']))
+
+    def contar(condicao):
+        return func.coalesce(func.sum(case((condicao, 1), else_=0)), 0)
+
+    linha = db.session.query(
+        contar(and_(emitida_no_mes, OS.fase == 'Pré-OS')),
+        contar(and_(emitida_no_mes, OS.fase == 'OS')),
+        contar(em_aberto),
+        contar(concluida_no_mes)
+    ).filter(or_(emitida_no_mes, em_aberto, concluida_no_mes)).one()
+    return tuple(int(v) for v in linha)
+
+def janela_meses(meses, referencia=None):
+    """Primeiros dias dos últimos `meses` meses, do mais antigo ao mês de referência."""
+    atual = inicio_do_mes(referencia or date.today())
+    janela = [atual]
+    for _ in range(meses - 1):
+        anterior = janela[0] - timedelta(days=1)
+        janela.insert(0, date(anterior.year, anterior.month, 1))
+    return janela
+
+def serie_mensal(coluna_data, meses, agregado=None, serie=None, filtros=(), referencia=None):
+    """Agrega linhas por mês numa janela móvel, preenchendo meses vazios com zero.
+
+    A janela vira um filtro de faixa em `coluna_data` (>= primeiro mês e
+    < mês seguinte ao de referência), então só as linhas do período são lidas.
+    `agregado` padrão é COUNT(*); `serie` separa os valores por uma coluna
+    (ex.: fase). Retorna (labels 'AAAA-MM', {serie: [valores por mês]}).
+    """
+    janela = janela_meses(meses, referencia)
+    ano = extract('year', coluna_data)
+    mes = extract('month', coluna_data)
+    grupos = [ano, mes] + ([serie] if serie is not None else [])
+    consulta = db.session.query(*grupos, agregado if agregado is not None else func.count())\
+        .filter(coluna_data >= janela[0], coluna_data < proximo_mes(janela[-1]), *filtros)\
+        .group_by(*grupos)
+
+    valores = defaultdict(dict)
+    for linha in consulta:
+        nome = linha[2] if serie is not None else None
+        valores[nome][date(int(linha[0]), int(linha[1]), 1)] = int(linha[-1] or 0)
+
+    labels = [m.strftime('%Y-%m') for m in janela]
+    series = {nome: [por_mes.get(m, 0) for m in janela] for nome, por_mes in valores.items()}
+    return labels, series
+
+# Busca geral de OS: mesmas colunas (e ordem) do índice FULLTEXT ft_os_busca
+CAMPOS_BUSCA_OS = (OS.numero, OS.cliente, OS.Razao, OS.CNPJ, OS.Cidade, OS.vendedo, OS.observacoes)
+TAMANHO_MIN_TERMO_FULLTEXT = 3 # innodb_ft_min_token_size padrão
+
+def buscar_os(query, texto):
+    """Aplica a busca geral de OS à query.
+
+    No MySQL usa MATCH ... AGAINST em modo booleano sobre o índice FULLTEXT
+    (todos os termos obrigatórios, com prefixo) e devolve a expressão de
+    relevância para ordenar. Termos curtos demais para o índice, e bancos sem
+    FULLTEXT, caem no ILIKE por campo. Retorna (query, relevancia ou None).
+    """
+    termos = [t for t in re.split(r'\W+', texto) if t]
+    if not termos:
+        return query, None
+
+    relevancia = None
+    if db.engine.dialect.name == 'mysql':
+        from sqlalchemy.dialects.mysql import match
+        longos = [t for t in termos if len(t) >= TAMANHO_MIN_TERMO_FULLTEXT]
+        if longos:
+            relevancia = match(*CAMPOS_BUSCA_OS, against=' '.join(f'+{t}*' for t in longos)).in_boolean_mode()
+            query = query.filter(relevancia > 0)
+            termos = [t for t in termos if len(t) < TAMANHO_MIN_TERMO_FULLTEXT]
+
+    for termo in termos:
+        query = query.filter(or_(*[campo.ilike(f"%{termo}%") for campo in CAMPOS_BUSCA_OS]))
+    return query, relevancia
+
+def buscar_os_ilike(query, texto):
+    """Caminho antigo (ILIKE '%x%' em cada campo), mantido para comparação de desempenho."""
+    for termo in [t for t in re.split(r'\W+', texto) if t]:
+        query = query.filter(or_(*[campo.ilike(f"%{termo}%") for campo in CAMPOS_BUSCA_OS]))
+    return query
+
+MAX_PAGINAS_BUSCA_OS = 50
+
+def pagina_busca_os(query, relevancia, por_pagina, pagina):
+    """Uma página da busca por texto, em ordem de relevância.
+
+    A relevância não é uma chave estável para keyset, então a página vai por
+    OFFSET, limitado a MAX_PAGINAS_BUSCA_OS páginas. Retorna
+    (itens, pagina_proxima, pagina_anterior); None = não há.
+    """
+    pagina = min(max(pagina, 1), MAX_PAGINAS_BUSCA_OS)
+    itens = query.order_by(relevancia.desc(), OS.id.desc())\
+        .offset((pagina - 1) * por_pagina).limit(por_pagina + 1).all()
+    tem_proxima = len(itens) > por_pagina and pagina < MAX_PAGINAS_BUSCA_OS
+    return itens[:por_pagina], pagina + 1 if tem_proxima else None, pagina - 1 if pagina > 1 else None
+
+STATUS_OS_FECHADA = ('Concluída', 'Cancelada')
+LIMITE_BUSCA_OS = 20
+
+def os_escolhida(campo):
+    """Confere só a OS enviada pelo seletor (em vez de montar a lista inteira).
+
+    Devolve (id, numero, cliente) ou None; se o id não existir, marca o erro
+    no campo (chamar depois do validate_on_submit).
+    """
+    if not campo.data:
+        return None
+    escolhida = db.session.query(OS.id, OS.numero, OS.cliente).filter(OS.id == campo.data).first()
+    if escolhida is None and isinstance(campo.errors, list):
+        campo.errors.append('OS não encontrada.')
+    return escolhida
+
+OPCOES_POR_PAGINA = (25, 50, 100, 200)
+
+def ler_por_pagina(padrao):
+    por_pagina = request.args.get('por_pagina', padrao, type=int)
+    return por_pagina if por_pagina in OPCOES_POR_PAGINA else padrao
+
+def paginar_por_id(query, coluna_id, por_pagina, apos=None, antes=None):
+    """Paginação keyset pela chave `coluna_id`, mais recentes primeiro.
+
+    `apos` = menor id da página atual (avança para registros mais antigos);
+    `antes` = maior id da página atual (volta para os mais recentes).
+    Busca por_pagina + 1 linhas só para saber se existe outra página, então o
+    custo não depende do tamanho da tabela (sem OFFSET nem COUNT). Ao voltar,
+    um EXISTS pelo índice confere se ainda há linhas mais antigas (podem ter
+    sido excluídas); ao avançar, supõe que a página de onde se veio existe.
+    Retorna (itens, cursor_proxima, cursor_anterior); cursores None = não há.
+    """
+    if antes:
+        itens = query.filter(coluna_id > antes).order_by(coluna_id.asc()).limit(por_pagina + 1).all()
+        tem_mais_recentes = len(itens) > por_pagina
+        itens = list(reversed(itens[:por_pagina]))
+        tem_mais_antigos = bool(itens) and db.session.query(
+            query.filter(coluna_id < getattr(itens[-1], coluna_id.key)).exists()
+        ).scalar()
+    else:
+        if apos:
+            query = query.filter(coluna_id < apos)
+        itens = query.order_by(coluna_id.desc()).limit(por_pagina + 1).all()
+        tem_mais_antigos = len(itens) > por_pagina
+        itens = itens[:por_pagina]
+        tem_mais_recentes = bool(apos)
+
+    chave = coluna_id.key
+    cursor_proxima = getattr(itens[-1], chave) if itens and tem_mais_antigos else None
+    cursor_anterior = getattr(itens[0], chave) if itens and tem_mais_recentes else None
+    return itens, cursor_proxima, cursor_anterior
+
+def _valor_comparavel(valor):
+    return None if valor == '' else valor
+
+def linhas_fieldlist(lista):
+    """Dados de cada sub-form de um FieldList (o `.data` do FieldList não serve
+    quando o sub-form tem um campo chamado `data`, como os custos)."""
+    return [{nome: campo.data for nome, campo in entrada.form._fields.items()} for entrada in lista]
+
+def sincronizar_filhos(modelo, coluna_pai, pai_id, linhas, campos):
+    """Grava as linhas de um FieldList como filhos de `pai_id` sem apagar tudo.
+
+    Cada linha é o dict do sub-form, com `id` do filho já gravado ou vazio.
+    Filho existente só recebe UPDATE se algum dos `campos` mudou; linhas novas
+    (ou com id que não pertence a este pai) vão num único INSERT de várias
+    linhas; filhos que sumiram do formulário saem num único DELETE ... IN.
+    Retorna as contagens e `comandos`, o total de instruções enviadas ao banco
+    (incluindo o SELECT dos filhos atuais).
+    """
+    atuais = {
+        linha.id: linha._mapping
+        for linha in db.session.query(modelo.id, *[getattr(modelo, c) for c in campos]).filter(coluna_pai == pai_id)
+    }
+    novos, alterados, mantidos = [], [], set()
+    for linha in linhas:
+        valores = {c: linha.get(c) for c in campos}
+        filho_id = linha.get('id')
+        atual = atuais.get(filho_id)
+        if atual is None or filho_id in mantidos:
+            valores[coluna_pai.key] = pai_id
+            novos.append(valores)
+            continue
+        mantidos.add(filho_id)
+        mudou = {c: v for c, v in valores.items() if _valor_comparavel(v) != _valor_comparavel(atual[c])}
+        if mudou:
+            mudou['id'] = filho_id
+            alterados.append(mudou)
+    removidos = [i for i in atuais if i not in mantidos]
+
+    comandos = 1
+    if alterados:
+        db.session.execute(db.update(modelo), alterados)
+        comandos += len(alterados)
+    if novos:
+        db.session.execute(modelo.__table__.insert(), novos)
+        comandos += 1
+    if removidos:
+        db.session.execute(db.delete(modelo).where(modelo.id.in_(removidos)))
+        comandos += 1
+    return {'inseridos': len(novos), 'atualizados': len(alterados), 'removidos': len(removidos), 'comandos': comandos}
+
+def resumo_sincronizacao(resultados):
+    total = defaultdict(int)
+    for resultado in resultados:
+        for chave, valor in resultado.items():
+            total[chave] += valor
+    return (f"{total['comandos']} comandos ({total['inseridos']} inseridos, "
+            f"{total['atualizados']} atualizados, {total['removidos']} removidos)")
+
+def opcoes_filtros_os():
+    """Valores dos dropdowns de filtro por campo, lidos da tabela os_dimensao.
+
+    Até o primeiro `flask rebuild-dimensoes` a tabela só tem os valores das
+    OS salvas depois do deploy, então usa SELECT DISTINCT direto na tabela os.
+    """
+    opcoes = {campo: [] for campo in CAMPOS_DIMENSAO_OS}
+    if not consolidado_pronto('os_dimensao'):
+        for campo in CAMPOS_DIMENSAO_OS:
+            coluna = getattr(OS, campo)
+            opcoes[campo] = sorted(r[0] for r in db.session.query(coluna).distinct().filter(coluna.isnot(None), coluna != ''))
+        return opcoes
+    linhas = db.session.query(OSDimensao.campo, OSDimensao.valor)\
+        .order_by(OSDimensao.campo, OSDimensao.valor).all()
+    for campo, valor in linhas:
+        if campo in opcoes:
+            opcoes[campo].append(valor)
+    return opcoes
+
+class CacheReferencia:
+    """Cache em memória (por processo) para cadastros que mudam pouco.
+
+    Cada chave tem um carregador registrado; o valor fica válido por
+    `ttl` segundos ou até `invalidar(chave)`, chamado pelas rotas que
+    alteram o cadastro. O TTL limita o atraso nos outros processos do
+    servidor, que não recebem a invalidação.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._carregadores = {}
+        self._valores = {}
+        self._lock = Lock()
+        self.acertos = defaultdict(int)
+        self.falhas = defaultdict(int)
+
+    def registrar(self, chave):
+        def decorator(carregador):
+            self._carregadores[chave] = carregador
+            return carregador
+        return decorator
+
+    def obter(self, chave):
+        with self._lock:
+            em_cache = self._valores.get(chave)
+            if em_cache and em_cache[0] > monotonic():
+                self.acertos[chave] += 1
+                return em_cache[1]
+            self.falhas[chave] += 1
+        valor = self._carregadores[chave]()
+        with self._lock:
+            self._valores[chave] = (monotonic() + self.ttl, valor)
+        return valor
+
+    def invalidar(self, *chaves):
+        with self._lock:
+            for chave in chaves or list(self._valores):
+                self._valores.pop(chave, None)
+
+    def estatisticas(self):
+        with self._lock:
+            agora = monotonic()
+            return {
+                chave: {
+                    'acertos': self.acertos[chave],
+                    'falhas': self.falhas[chave],
+                    'em_cache': chave in self._valores and self._valores[chave][0] > agora,
+                }
+                for chave in self._carregadores
+            }
+
+cache_referencia = CacheReferencia(app.config['CACHE_REFERENCIA_SEGUNDOS'])
+
+# Valores guardados como tuplas: as rotas copiam com list() antes de alterar
+@cache_referencia.registrar('despesas')
+def _carregar_despesas():
+    por_tipo = defaultdict(list)
+    for d in db.session.query(Despesa.id, Despesa.descricao, Despesa.tipo).order_by(Despesa.descricao):
+        por_tipo[d.tipo].append((d.id, d.descricao))
+    return {tipo: tuple(itens) for tipo, itens in por_tipo.items()}
+
+@cache_referencia.registrar('tipos_fornecedor')
+def _carregar_tipos_fornecedor():
+    return tuple((t.id, t.descricao) for t in db.session.query(TipoFornecedor.id, TipoFornecedor.descricao).order_by(TipoFornecedor.descricao))
+
+@cache_referencia.registrar('fornecedores')
+def _carregar_fornecedores():
+    return tuple((f.id, f.razao_social) for f in db.session.query(Fornecedor.id, Fornecedor.razao_social).order_by(Fornecedor.razao_social))
+
+# Dropdowns de filtro da OS (tabela os_dimensao); invalidado ao salvar OS
+cache_referencia.registrar('filtros_os')(opcoes_filtros_os)
+
+# Sequências de numeração (ver AlocadorNumeros em models.py). As sementes só
+# rodam no primeiro uso, para continuar a numeração que já existe no banco.
+alocador_numeros.registrar(
+    'op', bloco=app.config['NUMERACAO_BLOCO'],
+    semente=lambda conn: conn.execute(db.select(func.max(OrdemProducao.numero_sequencial))).scalar()
+)
+alocador_numeros.registrar(
+    'manutencao', bloco=app.config['NUMERACAO_BLOCO'],
+    semente=lambda conn: conn.execute(db.select(func.max(cast(OSManutencao.numero, db.Integer)))).scalar()
+)
+alocador_numeros.registrar('pedido', bloco=app.config['NUMERACAO_BLOCO'], por_ano=True)
+
+class CacheResultados:
+    """Resultados de consultas pesadas (relatórios) por combinação de parâmetros.
+
+    Diferente do CacheReferencia, a chave inclui os parâmetros da consulta e
+    não há invalidação: cada resultado vale `ttl` segundos. Guarda no máximo
+    `tamanho` resultados (sai o usado há mais tempo).
+    """
+
+    def __init__(self, ttl, tamanho=128):
+        self.ttl = ttl
+        self.tamanho = tamanho
+        self._valores = OrderedDict()
+        self._lock = Lock()
+        self.acertos = 0
+        self.falhas = 0
+
+    def obter(self, chave, carregador):
+        with self._lock:
+            em_cache = self._valores.get(chave)
+            if em_cache and em_cache[0] > monotonic():
+                self._valores.move_to_end(chave)
+                self.acertos += 1
+                return em_cache[1]
+            self.falhas += 1
+        valor = carregador()
+        with self._lock:
+            self._valores[chave] = (monotonic() + self.ttl, valor)
+            self._valores.move_to_end(chave)
+            while len(self._valores) > self.tamanho:
+                self._valores.popitem(last=False)
+        return valor
+
+cache_resultados = CacheResultados(app.config['CACHE_RELATORIOS_SEGUNDOS'])
+
+def opcoes_despesas(tipo):
+    return list(cache_referencia.obter('despesas').get(tipo, ()))
+
+def montar_grafico_evolucao(labels, data_pre, data_os):
+    return {
+        'labels': labels,
+        'datasets': [
+            {'label': 'Pré-OS', 'data': data_pre, 'backgroundColor': '#adb5bd', 'borderRadius': 4},
+            {'label': 'OS Definitiva', 'data': data_os, 'backgroundColor': '#0d6efd', 'borderRadius': 4}
+        ]
+    }
+
 def criar_snapshot_os(os_obj, usuario, motivo):
     """Cria uma cópia dos dados atuais da OS e salva na tabela OSVersao."""
     dados = {
@@ -116,6 +506,7 @@ def criar_snapshot_os(os_obj, usuario, motivo):
 
     for c in os_obj.custos_operacionais:
         dados['custos'].append({
+            'id': c.id,
             'tipo': 'Operacional',
             'despesa': c.despesa.descricao,
             'valor_previsto': c.valor,
@@ -127,6 +518,7 @@ def criar_snapshot_os(os_obj, usuario, motivo):
 
     for c in os_obj.custos_visitas:
         dados['custos'].append({
+            'id': c.id,
             'tipo': 'Visita',
             'despesa': c.despesa.descricao,
             'valor_previsto': c.valor,
@@ -139,23 +531,59 @@ def criar_snapshot_os(os_obj, usuario, motivo):
     if hasattr(os_obj, 'carregamentos'):
         for car in os_obj.carregamentos:
             dados['carregamentos'].append({
+                'id': car.id,
                 'data': car.data,
                 'placa': car.placa_caminhao,
                 'doc': car.documento_referencia,
                 'obs': car.observacao
             })
 
+    # Mesmo formato que o reconstrutor devolve (datas e decimais já convertidos)
+    dados = json.loads(json.dumps(dados, default=alchemy_encoder))
+    anterior = db.session.query(func.max(OSVersao.numero_revisao)).filter(OSVersao.os_id == os_obj.id).scalar()
     nova_versao = OSVersao(
         os_id=os_obj.id,
         numero_revisao=os_obj.revisao,
         usuario_responsavel=usuario,
         motivo=motivo,
-        dados_snapshot=json.dumps(dados, default=alchemy_encoder, indent=4)
+        snapshot=codificar_revisao(os_obj.id, anterior, dados)
     )
     db.session.add(nova_versao)
     os_obj.revisao += 1
     return True
 
+def _achatar(dados, prefixo=''):
+    planos = {}
+    for chave, valor in dados.items():
+        if isinstance(valor, dict):
+            planos.update(_achatar(valor, f"{prefixo}{chave}."))
+        else:
+            planos[f"{prefixo}{chave}"] = valor
+    return planos
+
+def comparar_revisoes(antes, depois):
+    """Diferenças entre duas revisões montadas pelo reconstrutor.
+
+    Cabeçalho: lista de (campo, antes, depois). Custos e carregamentos: itens
+    adicionados, removidos e alterados (pares antes/depois), casados pelo id.
+    """
+    cab_antes = _achatar(antes.get('cabecalho', {}))
+    cab_depois = _achatar(depois.get('cabecalho', {}))
+    diferencas = {'cabecalho': [
+        (campo, cab_antes.get(campo), cab_depois.get(campo))
+        for campo in sorted(set(cab_antes) | set(cab_depois))
+        if cab_antes.get(campo) != cab_depois.get(campo)
+    ]}
+    for lista in ('custos', 'carregamentos'):
+        itens_antes = {chave_item_snapshot(i): i for i in antes.get(lista) or []}
+        itens_depois = {chave_item_snapshot(i): i for i in depois.get(lista) or []}
+        diferencas[lista] = {
+            'adicionados': [i for k, i in itens_depois.items() if k not in itens_antes],
+            'removidos': [i for k, i in itens_antes.items() if k not in itens_depois],
+            'alterados': [(itens_antes[k], i) for k, i in itens_depois.items() if k in itens_antes and itens_antes[k] != i],
+        }
+    return diferencas
+
 # === MAPAS E DADOS AUXILIARES ===
 MAQUINAS_POR_SETOR = {
     'ADM': ['ESCRITORIO'],
@@ -241,98 +669,127 @@ def logout():
 @app.route('/')
 @login_required
 def index():
+    # Só o "esqueleto" da página: cada painel busca seus dados em /api/dashboard/*
+    return render_template('dashboard.html', title="Visão Geral", mes_nome=date.today().strftime('%m/%Y'))
+
+def resposta_json_cacheavel(dados, max_age):
+    """JSON com ETag e Cache-Control; responde 304 se o navegador já tem a versão."""
+    resposta = jsonify(dados)
+    resposta.headers['Cache-Control'] = f'private, max-age={max_age}'
+    resposta.add_etag()
+    return resposta.make_conditional(request)
+
+CACHE_DASHBOARD_SEGUNDOS = 60
+
+@app.route('/api/dashboard/kpis')
+@login_required
+def api_dashboard_kpis():
     try:
         hoje = date.today()
-        mes_atual = hoje.month
-        ano_atual = hoje.year
-
-        # Filtra Nulos para evitar erros
-        qtd_pre_os = OS.query.filter(
-            OS.fase == 'Pré-OS',
-            extract('month', OS.data_emissao) == mes_atual,
-            extract('year', OS.data_emissao) == ano_atual,
-            OS.data_emissao.isnot(None)
-        ).count()
-
-        qtd_os = OS.query.filter(
-            OS.fase == 'OS',
-            extract('month', OS.data_emissao) == mes_atual,
-            extract('year', OS.data_emissao) == ano_atual,
-            OS.data_emissao.isnot(None)
-        ).count()
+        inicio_mes = inicio_do_mes(hoje)
+        if not consolidado_pronto('os_kpi_mensal'):
+            # Consolidado ainda não reconstruído (antes do `flask rebuild-kpis`): direto da tabela os
+            qtd_pre_os, qtd_os, total_abertas, qtd_concluidas = kpis_mes_os(hoje)
+        else:
+            linha = db.session.query(
+                func.coalesce(func.sum(case((and_(OSKpiMensal.mes == inicio_mes, OSKpiMensal.fase == 'Pré-OS'), OSKpiMensal.qtd_emitidas), else_=0)), 0),
+                func.coalesce(func.sum(case((and_(OSKpiMensal.mes == inicio_mes, OSKpiMensal.fase == 'OS'), OSKpiMensal.qtd_emitidas), else_=0)), 0),
+                func.coalesce(func.sum(case((and_(OSKpiMensal.fase == 'OS', OSKpiMensal.status.in_(['Aberta', 'Em Andamento'])), OSKpiMensal.qtd_emitidas), else_=0)), 0),
+                func.coalesce(func.sum(case((and_(OSKpiMensal.mes == inicio_mes, OSKpiMensal.status == 'Concluída'), OSKpiMensal.qtd_concluidas), else_=0)), 0)
+            ).one()
+            qtd_pre_os, qtd_os, total_abertas, qtd_concluidas = (int(v) for v in linha)
+
+        return resposta_json_cacheavel({
+            'mes': hoje.strftime('%m/%Y'),
+            'pre_os': qtd_pre_os,
+            'os': qtd_os,
+            'abertas': total_abertas,
+            'concluidas': qtd_concluidas
+        }, CACHE_DASHBOARD_SEGUNDOS)
+    except Exception as e:
+        print(f"Erro nos KPIs do dashboard: {e}")
+        return jsonify({'error': 'Erro ao calcular KPIs'}), 500
 
-        total_abertas = OS.query.filter(
-            OS.status.in_(['Aberta', 'Em Andamento']),
-            OS.fase == 'OS'
-        ).count()
+@app.route('/api/dashboard/status')
+@login_required
+def api_dashboard_status():
+    try:
+        if consolidado_pronto('os_kpi_mensal'):
+            status_query = db.session.query(OSKpiMensal.status, func.sum(OSKpiMensal.qtd_emitidas))\
+                .group_by(OSKpiMensal.status)\
+                .having(func.sum(OSKpiMensal.qtd_emitidas) > 0).all()
+        else:
+            status_query = db.session.query(OS.status, func.count(OS.id)).group_by(OS.status).all()
 
-        qtd_concluidas = OS.query.filter(
-            OS.status == 'Concluída',
-            extract('month', OS.data_conclusao) == mes_atual,
-            extract('year', OS.data_conclusao) == ano_atual
-        ).count()
+        return resposta_json_cacheavel({
+            'labels': [s[0] for s in status_query],
+            'datasets': [{'data': [int(s[1]) for s in status_query], 'backgroundColor': ['#198754', '#ffc107', '#0d6efd', '#dc3545', '#6c757d']}]
+        }, CACHE_DASHBOARD_SEGUNDOS)
+    except Exception as e:
+        print(f"Erro no status do dashboard: {e}")
+        return jsonify({'error': 'Erro ao carregar status'}), 500
 
-        antigas_abertas = OS.query.filter(
+@app.route('/api/dashboard/antigas')
+@login_required
+def api_dashboard_antigas():
+    try:
+        hoje = date.today()
+        antigas_abertas = db.session.query(
+            OS.id, OS.numero, OS.cliente, OS.fase, OS.status, OS.data_emissao
+        ).filter(
             OS.status.notin_(['Concluída', 'Cancelada']),
             OS.data_emissao.isnot(None)
         ).order_by(OS.data_emissao.asc()).limit(5).all()
 
-        lista_antigas = []
-        for os_obj in antigas_abertas:
-            if os_obj.data_emissao:
-                dias = (hoje - os_obj.data_emissao).days
-            else:
-                dias = 0
-            lista_antigas.append({
-                'id': os_obj.id,
-                'numero': os_obj.numero,
-                'cliente': os_obj.cliente,
-                'fase': getattr(os_obj, 'fase', 'OS'),
-                'dias': dias,
-                'status': os_obj.status
-            })
-
-        evolucao_query = db.session.query(
-            func.date_format(OS.data_emissao, '%Y-%m').label('mes_ano'),
-            OS.fase,
-            func.count(OS.id)
-        ).filter(OS.data_emissao.isnot(None))\
-         .group_by('mes_ano', OS.fase)\
-         .order_by('mes_ano').limit(12).all()
-
-        dados_evolucao = defaultdict(lambda: {'Pré-OS': 0, 'OS': 0})
-        for mes, fase, qtd in evolucao_query:
-            if mes: dados_evolucao[mes][fase] = qtd
-
-        labels_chart = sorted(dados_evolucao.keys())
-        data_pre = [dados_evolucao[m].get('Pré-OS', 0) for m in labels_chart]
-        data_os = [dados_evolucao[m].get('OS', 0) for m in labels_chart]
-
-        bar_chart_data = json.dumps({
-            'labels': labels_chart,
-            'datasets': [
-                {'label': 'Pré-OS', 'data': data_pre, 'backgroundColor': '#adb5bd', 'borderRadius': 4},
-                {'label': 'OS Definitiva', 'data': data_os, 'backgroundColor': '#0d6efd', 'borderRadius': 4}
-            ]
-        })
+        lista_antigas = [{
+            'id': os_obj.id,
+            'numero': os_obj.numero,
+            'cliente': os_obj.cliente,
+            'fase': os_obj.fase or 'OS',
+            'dias': (hoje - os_obj.data_emissao).days if os_obj.data_emissao else 0,
+            'status': os_obj.status,
+            'url': url_for('visualizar_os', os_id=os_obj.id)
+        } for os_obj in antigas_abertas]
+        return resposta_json_cacheavel(lista_antigas, CACHE_DASHBOARD_SEGUNDOS)
+    except Exception as e:
+        print(f"Erro nas OS antigas do dashboard: {e}")
+        return jsonify({'error': 'Erro ao carregar OS antigas'}), 500
 
-        status_query = db.session.query(OS.status, func.count(OS.id)).group_by(OS.status).all()
-        pie_labels = [s[0] for s in status_query]
-        pie_values = [s[1] for s in status_query]
-        pie_chart_data = json.dumps({
-            'labels': pie_labels,
-            'datasets': [{'data': pie_values, 'backgroundColor': ['#198754', '#ffc107', '#0d6efd', '#dc3545', '#6c757d']}]
-        })
+JANELAS_EVOLUCAO = (3, 6, 12, 24)
+CACHE_EVOLUCAO_SEGUNDOS = 300
+_cache_evolucao = {}
 
-        return render_template('dashboard.html',
-                               title="Visão Geral", kpi_pre_os=qtd_pre_os, kpi_os=qtd_os,
-                               total_abertas=total_abertas, kpi_concluidas=qtd_concluidas,
-                               lista_antigas=lista_antigas, bar_chart_data=bar_chart_data,
-                               pie_chart_data=pie_chart_data, mes_nome=hoje.strftime('%m/%Y'))
+@app.route('/api/dashboard/evolucao')
+@login_required
+def api_dashboard_evolucao():
+    meses = request.args.get('meses', 12, type=int)
+    if meses not in JANELAS_EVOLUCAO:
+        return jsonify({'error': f'Janela inválida. Use: {", ".join(map(str, JANELAS_EVOLUCAO))}'}), 400
 
+    try:
+        # Sem o marcador na chave: com o cache quente a requisição não consulta o banco
+        chave = (meses, inicio_do_mes(date.today()))
+        em_cache = _cache_evolucao.get(chave)
+        if em_cache and em_cache[0] > monotonic():
+            dados = em_cache[1]
+        else:
+            pronto = consolidado_pronto('os_kpi_mensal')
+            if pronto:
+                labels, series = serie_mensal(OSKpiMensal.mes, meses,
+                                              agregado=func.sum(OSKpiMensal.qtd_emitidas),
+                                              serie=OSKpiMensal.fase)
+            else:
+                # Antes do `flask rebuild-kpis`: conta direto na tabela os
+                labels, series = serie_mensal(OS.data_emissao, meses, serie=OS.fase)
+            vazio = [0] * len(labels)
+            dados = montar_grafico_evolucao(labels, series.get('Pré-OS', vazio), series.get('OS', vazio))
+            if len(_cache_evolucao) > 32:
+                _cache_evolucao.clear()
+            _cache_evolucao[chave] = (monotonic() + CACHE_EVOLUCAO_SEGUNDOS, dados)
+        return resposta_json_cacheavel(dados, CACHE_EVOLUCAO_SEGUNDOS)
     except Exception as e:
-        print(f"Erro no dashboard: {e}")
-        return render_template('dashboard.html', title="Dashboard (Erro)", kpi_pre_os=0, kpi_os=0, total_abertas=0, kpi_concluidas=0, lista_antigas=[], bar_chart_data='{}', pie_chart_data='{}')
+        print(f"Erro na evolução do dashboard: {e}")
+        return jsonify({'error': 'Erro ao carregar evolução'}), 500
 
 # ==============================================================================
 # ROTAS DE ORDEM DE SERVIÇO (OS)
@@ -342,16 +799,24 @@ def index():
 @login_required
 def lista_os():
     # 1. Captura os filtros da URL (GET)
+    f_busca = request.args.get('q', '').strip()
     f_cliente = request.args.get('cliente', '')
     f_fase = request.args.get('fase', '')
     f_tipo_os = request.args.get('tipo_os', '')
     f_empresa = request.args.get('empresa', '')
     f_data_ini = request.args.get('data_ini', '')
 
-    # 2. Inicia a Query Base
-    query = OS.query
+    # 2. Inicia a Query Base (só as colunas exibidas na lista)
+    query = OS.query.options(db.load_only(
+        OS.id, OS.numero, OS.fase, OS.cliente, OS.Tipo_OS, OS.empresa,
+        OS.status, OS.data_emissao, OS.data_entrega
+    ))
 
     # 3. Aplica os Filtros (se existirem)
+    relevancia = None
+    if f_busca:
+        query, relevancia = buscar_os(query, f_busca)
+
     if f_cliente:
         query = query.filter(OS.cliente.ilike(f"%{f_cliente}%"))
 
@@ -367,25 +832,43 @@ def lista_os():
     if f_data_ini:
         query = query.filter(OS.data_emissao >= f_data_ini)
 
-    # 4. Executa a busca ordenando pelas mais recentes
-    lista_filtrada = query.order_by(OS.id.desc()).all()
+    # 4. Executa a busca ordenando pelas mais recentes, uma página por vez (keyset em OS.id)
+    por_pagina = ler_por_pagina(app.config['OS_POR_PAGINA'])
+    if relevancia is not None:
+        # Busca por texto: ordem de relevância, páginas numeradas (cursores = nº da página)
+        lista_filtrada, cursor_proxima, cursor_anterior = pagina_busca_os(
+            query, relevancia, por_pagina, request.args.get('pagina', 1, type=int))
+    else:
+        lista_filtrada, cursor_proxima, cursor_anterior = paginar_por_id(
+            query, OS.id, por_pagina,
+            apos=request.args.get('apos', type=int),
+            antes=request.args.get('antes', type=int)
+        )
+
+    # Filtros preservados nos links de paginação
+    filtros = {k: v for k, v in request.args.items() if k not in ('apos', 'antes', 'pagina') and v}
 
-    # 5. Dados para popular os Dropdowns de Filtro (Valores únicos do banco)
-    opcoes_tipo_os = sorted([r[0] for r in db.session.query(OS.Tipo_OS).distinct().filter(OS.Tipo_OS.isnot(None))])
-    opcoes_empresas = sorted([r[0] for r in db.session.query(OS.empresa).distinct().filter(OS.empresa.isnot(None))])
+    # 5. Dados para popular os Dropdowns de Filtro (tabela os_dimensao)
+    opcoes = cache_referencia.obter('filtros_os')
 
     return render_template('lista_os.html',
                            lista_os=lista_filtrada,
+                           filtros=filtros,
+                           por_pagina=por_pagina,
+                           opcoes_por_pagina=OPCOES_POR_PAGINA,
+                           cursor_proxima=cursor_proxima,
+                           cursor_anterior=cursor_anterior,
+                           busca_ranqueada=relevancia is not None,
                            title="Ordens de Serviço",
-                           opcoes_tipo_os=opcoes_tipo_os,
-                           opcoes_empresas=opcoes_empresas)
+                           opcoes_tipo_os=opcoes['Tipo_OS'],
+                           opcoes_empresas=opcoes['empresa'])
 
 @app.route('/os/nova', methods=['GET', 'POST'])
 @login_required
 def nova_os():
     form = OSForm()
-    despesas_op = [(d.id, d.descricao) for d in Despesa.query.filter_by(tipo='Operacional').order_by(Despesa.descricao).all()]
-    despesas_vis = [(d.id, d.descricao) for d in Despesa.query.filter_by(tipo='Visita').order_by(Despesa.descricao).all()]
+    despesas_op = opcoes_despesas('Operacional')
+    despesas_vis = opcoes_despesas('Visita')
 
     for custo_op_entry in form.custos_operacionais:
         custo_op_entry.despesa_id.choices = despesas_op
@@ -494,6 +977,7 @@ def nova_os():
                     db.session.add(carga)
 
             db.session.commit()
+            cache_referencia.invalidar('filtros_os')
             flash(f'OS "{nova_os_obj.numero}" criada com sucesso!', 'success')
             return redirect(url_for('lista_os'))
 
@@ -510,10 +994,98 @@ def visualizar_os(os_id):
     os_obj = OS.query.options(
         db.joinedload(OS.custos_operacionais).joinedload(CustoOperacional.despesa),
         db.joinedload(OS.custos_visitas).joinedload(CustoVisita.despesa),
-        db.joinedload(OS.versoes),
         db.joinedload(OS.carregamentos)
     ).get_or_404(os_id)
-    return render_template('visualizar_os.html', os=os_obj, title=f"Detalhes da OS {os_obj.numero}")
+    # O histórico de revisões é carregado pela página em lotes (api_os_versoes)
+    return render_template('visualizar_os.html', os=os_obj, por_pagina_versoes=POR_PAGINA_VERSOES,
+                           title=f"Detalhes da OS {os_obj.numero}")
+
+POR_PAGINA_VERSOES = 20
+
+@app.route('/api/os/<int:os_id>/versoes')
+@login_required
+def api_os_versoes(os_id):
+    """Metadados do histórico, mais recentes primeiro; ?cursor= vem da página anterior."""
+    cursor = request.args.get('cursor', type=int)
+    limite = max(1, min(request.args.get('limite', POR_PAGINA_VERSOES, type=int) or POR_PAGINA_VERSOES, 100))
+    try:
+        query = db.session.query(
+            OSVersao.numero_revisao, OSVersao.data_arquivamento, OSVersao.usuario_responsavel, OSVersao.motivo
+        ).filter(OSVersao.os_id == os_id)
+        versoes, proximo_cursor, _ = paginar_por_id(query, OSVersao.numero_revisao, limite, apos=cursor)
+        return jsonify({
+            'versoes': [{
+                'numero_revisao': v.numero_revisao,
+                'data_arquivamento': v.data_arquivamento.strftime('%d/%m/%Y %H:%M') if v.data_arquivamento else None,
+                'usuario': v.usuario_responsavel,
+                'motivo': v.motivo
+            } for v in versoes],
+            'proximo_cursor': proximo_cursor
+        })
+    except Exception as e:
+        print(f"Erro ao listar revisões da OS {os_id}: {e}")
+        return jsonify({'error': 'Erro ao listar revisões'}), 500
+
+@app.route('/api/os/<int:os_id>/versoes/<int:numero_revisao>')
+@login_required
+def api_os_versao(os_id, numero_revisao):
+    versao = db.session.query(
+        OSVersao.numero_revisao, OSVersao.data_arquivamento, OSVersao.usuario_responsavel, OSVersao.motivo
+    ).filter_by(os_id=os_id, numero_revisao=numero_revisao).first()
+    if versao is None:
+        return jsonify({'error': 'Revisão não encontrada'}), 404
+    try:
+        dados = reconstrutor_revisoes.obter(os_id, numero_revisao)
+    except Exception as e:
+        print(f"Erro ao ler revisão {numero_revisao} da OS {os_id}: {e}")
+        return jsonify({'error': 'Erro ao ler revisão'}), 500
+
+    # Cópia: o dict do reconstrutor fica em cache
+    cabecalho = dict(dados.get('cabecalho', {}))
+    custos = dados.get('custos')
+    atual = db.session.query(OS.cliente, OS.valor).filter(OS.id == os_id).first()
+    diferente = {'cliente': atual is not None and cabecalho.get('cliente') != atual.cliente}
+    if current_user.can_see_money:
+        diferente['valor_total'] = atual is not None and float(cabecalho.get('valor_total') or 0) != float(atual.valor or 0)
+    else:
+        cabecalho.pop('valor_total', None)
+        custos = None
+
+    # A revisão em si não muda, mas 'diferente' compara com a OS atual:
+    # o navegador sempre revalida e recebe 304 enquanto nada mudou.
+    return resposta_json_cacheavel({
+        'numero_revisao': versao.numero_revisao,
+        'data_arquivamento': versao.data_arquivamento.strftime('%d/%m/%Y %H:%M') if versao.data_arquivamento else None,
+        'usuario': versao.usuario_responsavel,
+        'motivo': versao.motivo,
+        'cabecalho': cabecalho,
+        'custos': custos,
+        'carregamentos': dados.get('carregamentos', []),
+        'diferente': diferente
+    }, max_age=0)
+
+@app.route('/os/<int:os_id>/versoes/comparar')
+@login_required
+def comparar_versoes(os_id):
+    os_obj = OS.query.options(db.load_only(OS.id, OS.numero, OS.revisao)).get_or_404(os_id)
+    de = request.args.get('de', type=int)
+    para = request.args.get('para', type=int)
+    antes = reconstrutor_revisoes.obter(os_id, de) if de is not None else None
+    depois = reconstrutor_revisoes.obter(os_id, para) if para is not None else None
+    if antes is None or depois is None:
+        flash('Selecione duas revisões existentes para comparar.', 'warning')
+        return redirect(url_for('visualizar_os', os_id=os_id))
+
+    metadados = {v.numero_revisao: v for v in db.session.query(
+        OSVersao.numero_revisao, OSVersao.data_arquivamento, OSVersao.usuario_responsavel, OSVersao.motivo
+    ).filter(OSVersao.os_id == os_id, OSVersao.numero_revisao.in_([de, para]))}
+    diferencas = comparar_revisoes(antes, depois)
+    if not current_user.can_see_money:
+        diferencas['cabecalho'] = [d for d in diferencas['cabecalho'] if d[0] != 'valor_total']
+        diferencas['custos'] = None
+
+    return render_template('comparar_versoes.html', os=os_obj, de=metadados[de], para=metadados[para],
+                           diferencas=diferencas, title=f"OS {os_obj.numero}: Rev. {de} x Rev. {para}")
 
 @app.route('/os/<int:os_id>/imprimir')
 @login_required
@@ -539,8 +1111,8 @@ def editar_os(os_id):
         if not form.carregamentos.entries:
             form.carregamentos.append_entry()
 
-    despesas_op = [(d.id, d.descricao) for d in Despesa.query.filter_by(tipo='Operacional').order_by(Despesa.descricao).all()]
-    despesas_vis = [(d.id, d.descricao) for d in Despesa.query.filter_by(tipo='Visita').order_by(Despesa.descricao).all()]
+    despesas_op = opcoes_despesas('Operacional')
+    despesas_vis = opcoes_despesas('Visita')
 
     for custo_op_entry in form.custos_operacionais:
         custo_op_entry.despesa_id.choices = despesas_op
@@ -609,51 +1181,28 @@ def editar_os(os_id):
             os_obj.Obs2 = form.Obs2.data
 
             # === Atualiza Listas (Custos são liberados para Compras) ===
-            CustoOperacional.query.filter_by(os_id=os_obj.id).delete()
-            CustoVisita.query.filter_by(os_id=os_obj.id).delete()
+            # Só altera as linhas que mudaram; ids dos filhos são preservados
+            campos_custo = ('despesa_id', 'valor', 'valor_realizado', 'data', 'responsavel', 'observacao')
+            sincronizacoes = [
+                sincronizar_filhos(CustoOperacional, CustoOperacional.os_id, os_obj.id,
+                                   [f for f in linhas_fieldlist(form.custos_operacionais) if f['despesa_id'] and f['valor'] is not None],
+                                   campos_custo),
+                sincronizar_filhos(CustoVisita, CustoVisita.os_id, os_obj.id,
+                                   [f for f in linhas_fieldlist(form.custos_visitas) if f['despesa_id'] and f['valor'] is not None],
+                                   campos_custo),
+            ]
 
             # Carregamento (Logística) só para quem tem acesso geral
             if current_user.can_edit_general:
-                Carregamento.query.filter_by(os_id=os_obj.id).delete()
-
-            db.session.flush()
-
-            for f in form.custos_operacionais:
-                if f.despesa_id.data and f.valor.data is not None:
-                    db.session.add(CustoOperacional(
-                        os_id=os_obj.id,
-                        despesa_id=f.despesa_id.data,
-                        valor=f.valor.data,
-                        valor_realizado=f.valor_realizado.data,
-                        data=f.data.data,
-                        responsavel=f.responsavel.data,
-                        observacao=f.observacao.data
-                    ))
-
-            for f in form.custos_visitas:
-                if f.despesa_id.data and f.valor.data is not None:
-                    db.session.add(CustoVisita(
-                        os_id=os_obj.id,
-                        despesa_id=f.despesa_id.data,
-                        valor=f.valor.data,
-                        valor_realizado=f.valor_realizado.data,
-                        data=f.data.data,
-                        responsavel=f.responsavel.data,
-                        observacao=f.observacao.data
-                    ))
-
-            if current_user.can_edit_general:
-                for carga_form in form.carregamentos:
-                    if carga_form.placa_caminhao.data or carga_form.documento_referencia.data:
-                        db.session.add(Carregamento(
-                            os_id=os_obj.id,
-                            data=carga_form.data.data,
-                            placa_caminhao=carga_form.placa_caminhao.data,
-                            documento_referencia=carga_form.documento_referencia.data,
-                            observacao=carga_form.observacao.data
-                        ))
+                sincronizacoes.append(sincronizar_filhos(
+                    Carregamento, Carregamento.os_id, os_obj.id,
+                    [f for f in linhas_fieldlist(form.carregamentos) if f['placa_caminhao'] or f['documento_referencia']],
+                    ('data', 'placa_caminhao', 'documento_referencia', 'observacao')
+                ))
 
             db.session.commit()
+            cache_referencia.invalidar('filtros_os')
+            print(f"Edição da OS {os_obj.id}: filhos em {resumo_sincronizacao(sincronizacoes)}")
             flash(f'OS "{os_obj.numero}" atualizada com sucesso!', 'success')
             return redirect(url_for('lista_os'))
 
@@ -688,51 +1237,156 @@ def gerar_revisao(os_id):
 @app.route('/cronograma')
 @login_required
 def cronograma():
-    ordens = OS.query.filter(
-        OS.fase == 'OS',
-        OS.data_inicio.isnot(None),
-        OS.data_termino.isnot(None)
-    ).all()
+    # As tarefas vêm de /api/cronograma, por janela de datas, conforme a rolagem
+    opcoes = cache_referencia.obter('filtros_os')
+    return render_template('gantt.html',
+                           title="Cronograma Geral",
+                           janela_dias=JANELA_CRONOGRAMA_DIAS,
+                           opcoes_empresas=opcoes['empresa'],
+                           opcoes_tipo_os=opcoes['Tipo_OS'],
+                           opcoes_contratos=opcoes['tipo_contrato'])
+
+# Janela padrão (para cada lado de hoje) e máxima por requisição do cronograma
+JANELA_CRONOGRAMA_DIAS = 90
+JANELA_CRONOGRAMA_MAX_DIAS = 3 * 366
+
+def tarefa_gantt(linha):
+    """Linha projetada de OS -> tarefa do Frappe Gantt."""
+    cor = 'bar-blue'
+    progress = 0
+    if linha.status == 'Concluída':
+        cor = 'bar-green'; progress = 100
+    elif linha.status == 'Em Andamento':
+        cor = 'bar-orange'; progress = 50
+    elif linha.status == 'Cancelada':
+        cor = 'bar-red'; progress = 100
+
+    tipo_destaque = f"[{linha.Tipo_OS.upper()}]" if linha.Tipo_OS else "[OS]"
+    return {
+        'id': str(linha.id),
+        'name': f"{tipo_destaque} {linha.cliente} (#{linha.numero})",
+        'start': linha.data_inicio.strftime('%Y-%m-%d'),
+        'end': linha.data_termino.strftime('%Y-%m-%d'),
+        'progress': progress,
+        'custom_class': cor,
+        '_empresa': linha.empresa or '',
+        '_tipo_os': linha.Tipo_OS or '',
+        '_contrato': linha.tipo_contrato or ''
+    }
 
-    opcoes_empresas = sorted(list(set([os.empresa for os in ordens if os.empresa])))
-    opcoes_tipo_os = sorted(list(set([os.Tipo_OS for os in ordens if os.Tipo_OS])))
-    
-    # Tratamento seguro para tipo_contrato (pode ser None)
-    contratos = [os.tipo_contrato for os in ordens if os.tipo_contrato]
-    opcoes_contratos = sorted(list(set(contratos)))
-
-    tarefas_gantt = []
-    for os_obj in ordens:
-        cor = 'bar-blue'
-        progress = 0
-        if os_obj.status == 'Concluída':
-            cor = 'bar-green'; progress = 100
-        elif os_obj.status == 'Em Andamento':
-            cor = 'bar-orange'; progress = 50
-        elif os_obj.status == 'Cancelada':
-            cor = 'bar-red'; progress = 100
-
-        tipo_destaque = f"[{os_obj.Tipo_OS.upper()}]" if os_obj.Tipo_OS else "[OS]"
-        nome_tarefa = f"{tipo_destaque} {os_obj.cliente} (#{os_obj.numero})"
-
-        tarefas_gantt.append({
-            'id': str(os_obj.id),
-            'name': nome_tarefa,
-            'start': os_obj.data_inicio.strftime('%Y-%m-%d'),
-            'end': os_obj.data_termino.strftime('%Y-%m-%d'),
-            'progress': progress,
-            'custom_class': cor,
-            '_empresa': os_obj.empresa or '',
-            '_tipo_os': os_obj.Tipo_OS or '',
-            '_contrato': os_obj.tipo_contrato or ''
+def tarefas_op_gantt(op, os_id):
+    """Barra da OP (início -> término previsto) e marco do carregamento."""
+    cor = 'bar-op-fechada' if op.status == 'Fechado' else 'bar-op'
+    tarefas = [{
+        'id': f"op-{op.id}",
+        'name': f"   ↳ OP {op.numero_sequencial} - {op.departamento}",
+        'start': op.data_inicio_previsto.strftime('%Y-%m-%d'),
+        'end': op.data_termino_previsto.strftime('%Y-%m-%d'),
+        'progress': 0,
+        'custom_class': cor,
+        '_os': str(os_id),
+        '_status': op.status
+    }]
+    if op.data_carregamento:
+        tarefas.append({
+            'id': f"car-{op.id}",
+            'name': f"   ◆ Carregamento OP {op.numero_sequencial}",
+            'start': op.data_carregamento.strftime('%Y-%m-%d'),
+            'end': op.data_carregamento.strftime('%Y-%m-%d'),
+            'progress': 0,
+            'custom_class': 'bar-marco',
+            '_os': str(os_id),
+            '_marco': True
         })
+    return tarefas
+
+def montar_cronograma(inicio, fim, filtros, incluir_ops=True):
+    """Gera o JSON do cronograma em pedaços: cada OS seguida das suas OPs.
+
+    Um erro no meio da leitura encerra o JSON com a chave "error" (o status
+    200 já foi enviado), então quem consome deve conferi-la.
+
+    São sempre três consultas, qualquer que seja o número de OS na janela:
+    a duração máxima das OS (por chave primária), as OPs de todas as OS
+    visíveis (via subconsulta, agrupadas por os_id numa passada) e as OS,
+    lidas em lotes enquanto a resposta é enviada.
+    """
+    # Nenhuma OS dura mais que a duração máxima gravada: as que terminam
+    # depois de `inicio` começaram no máximo tantos dias antes dele.
+    duracao_max = timedelta(days=duracao_maxima_os('OS'))
+    query = db.session.query(
+        OS.id, OS.numero, OS.cliente, OS.status, OS.Tipo_OS, OS.empresa, OS.tipo_contrato,
+        OS.data_inicio, OS.data_termino
+    ).filter(
+        OS.fase == 'OS',
+        OS.data_inicio >= inicio - duracao_max,
+        OS.data_inicio <= fim,
+        OS.data_termino >= inicio
+    )
+    colunas_filtro = {'empresa': OS.empresa, 'tipo_os': OS.Tipo_OS, 'contrato': OS.tipo_contrato}
+    for parametro, valor in filtros.items():
+        if valor:
+            query = query.filter(colunas_filtro[parametro] == valor)
+
+    ops_por_os = defaultdict(list)
+    if incluir_ops:
+        visiveis = query.with_entities(OS.id).subquery()
+        ops = db.session.query(
+            OrdemProducao.id, OrdemProducao.os_id, OrdemProducao.numero_sequencial, OrdemProducao.departamento,
+            OrdemProducao.status, OrdemProducao.data_inicio_previsto, OrdemProducao.data_termino_previsto,
+            OrdemProducao.data_carregamento
+        ).join(visiveis, OrdemProducao.os_id == visiveis.c.id)\
+            .order_by(OrdemProducao.os_id, OrdemProducao.data_inicio_previsto, OrdemProducao.id)
+        for op in ops:
+            ops_por_os[op.os_id].append(op)
+
+    linhas = db.session.execute(
+        query.order_by(OS.data_inicio, OS.id).statement.execution_options(yield_per=500)
+    )
 
-    return render_template('gantt.html',
-                           tarefas=json.dumps(tarefas_gantt),
-                           title="Cronograma Geral",
-                           opcoes_empresas=opcoes_empresas,
-                           opcoes_tipo_os=opcoes_tipo_os,
-                           opcoes_contratos=opcoes_contratos)
+    def gerar():
+        yield f'{{"from": "{inicio.isoformat()}", "to": "{fim.isoformat()}", "tarefas": ['
+        primeira = True
+        try:
+            for linha in linhas:
+                tarefas = [tarefa_gantt(linha)]
+                for op in ops_por_os.get(linha.id, ()):
+                    tarefas.extend(tarefas_op_gantt(op, linha.id))
+                for tarefa in tarefas:
+                    yield ('' if primeira else ',') + json.dumps(tarefa)
+                    primeira = False
+        except Exception as e:
+            # O 200 já foi enviado: fecha o JSON com o erro em vez de truncar a resposta
+            print(f"Erro ao carregar cronograma: {e}")
+            yield '], "error": "Erro ao carregar cronograma"}'
+            return
+        yield ']}'
+    return gerar()
+
+@app.route('/api/cronograma')
+@login_required
+def api_cronograma():
+    """OS (e as OPs de cada uma) que se sobrepõem à janela [from, to].
+
+    Usa o índice (fase, data_inicio, data_termino): a faixa em data_inicio vai
+    de `from` menos a maior duração de OS (tabela os_duracao_maxima, mantida
+    pelos eventos do OS) até `to`, e data_termino é conferido no próprio índice.
+    """
+    hoje = date.today()
+    inicio = request.args.get('from', type=date.fromisoformat) or hoje - timedelta(days=JANELA_CRONOGRAMA_DIAS)
+    fim = request.args.get('to', type=date.fromisoformat) or hoje + timedelta(days=JANELA_CRONOGRAMA_DIAS)
+    if fim < inicio:
+        return jsonify({'error': 'Período inválido'}), 400
+    if (fim - inicio).days > JANELA_CRONOGRAMA_MAX_DIAS:
+        return jsonify({'error': f'Período maior que {JANELA_CRONOGRAMA_MAX_DIAS} dias'}), 400
+
+    filtros = {p: request.args.get(p, '') for p in ('empresa', 'tipo_os', 'contrato')}
+    try:
+        partes = montar_cronograma(inicio, fim, filtros, incluir_ops=request.args.get('ops', '1') != '0')
+        return Response(stream_with_context(partes), mimetype='application/json')
+    except Exception as e:
+        print(f"Erro ao carregar cronograma: {e}")
+        return jsonify({'error': 'Erro ao carregar cronograma'}), 500
 
 # ==============================================================================
 # ROTAS DE ORDEM DE PRODUÇÃO (OP)
@@ -742,14 +1396,15 @@ def cronograma():
 @login_required
 def nova_ordem():
     form = OrdemProducaoForm()
-    form.os.choices = [(os_item.id, os_item.numero) for os_item in OS.query.order_by(OS.numero).all()]
-    ultimo_op = OrdemProducao.query.order_by(OrdemProducao.numero_sequencial.desc()).first()
-    proximo_numero = (ultimo_op.numero_sequencial + 1) if ultimo_op else 1
+    # Só para exibir: o número é reservado de fato ao salvar
+    proximo_numero = alocador_numeros.espiar('op')
 
-    if form.validate_on_submit():
+    valido = form.validate_on_submit()
+    os_selecionada = os_escolhida(form.os)
+    if valido and os_selecionada:
         try:
             nova_op = OrdemProducao(
-                numero_sequencial=proximo_numero,
+                numero_sequencial=alocador_numeros.proximo('op'),
                 os_id=form.os.data,
                 departamento=form.departamento.data,
                 status=form.status.data,
@@ -806,8 +1461,9 @@ def nova_ordem():
                     )
                     db.session.add(controle_item)
 
+            registrar_alteracao_producao(nova_op.id)
             db.session.commit()
-            flash('Ordem de Produção criada com sucesso!', 'success')
+            flash(f'Ordem de Produção {nova_op.numero_sequencial} criada com sucesso!', 'success')
             return redirect(url_for('lista_ordens'))
 
         except Exception as e:
@@ -815,18 +1471,67 @@ def nova_ordem():
             flash(f'Ocorreu um erro ao salvar a Ordem de Produção: {e}', 'danger')
             print(f"Erro ao salvar OP: {e}")
     preencher_choices_processo(form)
-    return render_template('ordem_form.html', form=form, title="Nova Ordem de Produção", proximo_numero=proximo_numero)
+    return render_template('ordem_form.html', form=form, title="Nova Ordem de Produção", proximo_numero=proximo_numero,
+                           os_selecionada=os_selecionada)
+
+# Filtros de igualdade da lista de OPs (parâmetro da URL -> coluna)
+FILTROS_LISTA_OP = {
+    'status': OrdemProducao.status,
+    'departamento': OrdemProducao.departamento,
+    'setor': OrdemProducao.setor,
+    'tipo_op': OrdemProducao.tipo_op,
+}
+# Faixas de data (parâmetros <nome>_de / <nome>_ate)
+DATAS_LISTA_OP = {
+    'emissao': OrdemProducao.data_emissao,
+    'carregamento': OrdemProducao.data_carregamento,
+}
 
 @app.route('/ordens')
 @login_required
 def lista_ordens():
-    query = request.args.get('q', '')
-    ordens_query = OrdemProducao.query
+    query = request.args.get('q', '').strip()
+    ordens_query = OrdemProducao.query.options(db.load_only(
+        OrdemProducao.id, OrdemProducao.numero_sequencial, OrdemProducao.cliente, OrdemProducao.codigo,
+        OrdemProducao.part_number_produto, OrdemProducao.status, OrdemProducao.departamento,
+        OrdemProducao.data_emissao, OrdemProducao.data_carregamento
+    ))
     if query:
-        search_term = f"%{query}%"
-        ordens_query = ordens_query.filter(OrdemProducao.cliente.ilike(search_term))
-    ordens = ordens_query.order_by(OrdemProducao.numero_sequencial.desc()).all()
-    return render_template('lista_ordens.html', ordens=ordens, title="Ordens de Produção", query=query)
+        ordens_query = ordens_query.filter(OrdemProducao.cliente.ilike(f"%{query}%"))
+
+    for parametro, coluna in FILTROS_LISTA_OP.items():
+        valor = request.args.get(parametro, '').strip()
+        if valor:
+            ordens_query = ordens_query.filter(coluna == valor)
+
+    for nome, coluna in DATAS_LISTA_OP.items():
+        inicio = request.args.get(f'{nome}_de', type=date.fromisoformat)
+        fim = request.args.get(f'{nome}_ate', type=date.fromisoformat)
+        if inicio:
+            ordens_query = ordens_query.filter(coluna >= inicio)
+        if fim:
+            ordens_query = ordens_query.filter(coluna <= fim)
+
+    # OS pelo número que o usuário conhece (um SELECT pelo índice único de OS.numero)
+    numero_os = request.args.get('os', '').strip()
+    if numero_os:
+        os_id = db.session.query(OS.id).filter(OS.numero == numero_os).scalar()
+        ordens_query = ordens_query.filter(OrdemProducao.os_id == os_id) if os_id else ordens_query.filter(db.false())
+
+    # Mais recentes primeiro, uma página por vez (keyset em numero_sequencial)
+    por_pagina = ler_por_pagina(app.config['OP_POR_PAGINA'])
+    ordens, cursor_proxima, cursor_anterior = paginar_por_id(
+        ordens_query, OrdemProducao.numero_sequencial, por_pagina,
+        apos=request.args.get('apos', type=int),
+        antes=request.args.get('antes', type=int)
+    )
+    filtros = {k: v for k, v in request.args.items() if k not in ('apos', 'antes') and v}
+
+    return render_template('lista_ordens.html', ordens=ordens, title="Ordens de Produção", query=query,
+                           filtros=filtros, por_pagina=por_pagina, opcoes_por_pagina=OPCOES_POR_PAGINA,
+                           cursor_proxima=cursor_proxima, cursor_anterior=cursor_anterior,
+                           opcoes_status=[v for v, _ in OrdemProducaoForm.status.kwargs['choices']],
+                           opcoes_departamento=[v for v, _ in OrdemProducaoForm.departamento.kwargs['choices'] if v])
 
 @app.route('/ordem/<int:ordem_id>/visualizar')
 @login_required
@@ -845,39 +1550,20 @@ def imprimir_ordem(ordem_id):
 
     produto_descricao = "Produto não encontrado"
     if ordem.part_number_produto:
-        produto = Produto.query.filter_by(part_number=ordem.part_number_produto).first()
+        produto = catalogo_produtos.obter().por_part_number(ordem.part_number_produto)
         if produto:
-            produto_descricao = produto.descricao
+            produto_descricao = produto['descricao']
         else:
             produto_descricao = "Sem descrição cadastrada"
     else:
         produto_descricao = "-"
 
-    total_segundos = 0
-    for item in ordem.controles_producao:
-        if item.data_inicio and item.hora_inicio and item.data_termino and item.hora_termino:
-            try:
-                inicio = datetime.combine(item.data_inicio, item.hora_inicio)
-                fim = datetime.combine(item.data_termino, item.hora_termino)
-                diferenca = fim - inicio
-                segundos = diferenca.total_seconds()
-                if segundos < 0: segundos = 0
-                total_segundos += segundos
-                horas = int(segundos // 3600)
-                minutos = int((segundos % 3600) // 60)
-                item.duracao_formatada = f"{horas:02d}:{minutos:02d}"
-            except:
-                item.duracao_formatada = "-"
-        else:
-            item.duracao_formatada = "-"
-
-    total_horas = int(total_segundos // 3600)
-    total_minutos = int((total_segundos % 3600) // 60)
-    total_formatado = f"{total_horas:02d}:{total_minutos:02d}"
+    duracoes, total_segundos = duracoes_trabalhadas(ControleProducao, ControleProducao.ordem_producao_id == ordem.id)
 
     return render_template('impressao_ordem.html',
                            ordem=ordem,
-                           total_horas_gastas=total_formatado,
+                           duracoes=duracoes,
+                           total_horas_gastas=format_duracao(total_segundos),
                            produto_descricao=produto_descricao)
 
 @app.route('/ordem/<int:ordem_id>/editar', methods=['GET', 'POST'])
@@ -888,11 +1574,13 @@ def editar_ordem(ordem_id):
         form = OrdemProducaoForm(request.form)
     else:
         form = OrdemProducaoForm(obj=ordem)
+        form.os.data = ordem.os_id
 
-    form.os.choices = [(os_item.id, os_item.numero) for os_item in OS.query.order_by(OS.numero).all()]
     preencher_choices_processo(form)
 
-    if form.validate_on_submit():
+    valido = form.validate_on_submit()
+    os_selecionada = os_escolhida(form.os)
+    if valido and os_selecionada:
         try:
             ordem.os_id = form.os.data
             ordem.departamento = form.departamento.data
@@ -916,23 +1604,20 @@ def editar_ordem(ordem_id):
             ordem.acessorios = form.acessorios.data
             ordem.observacoes = form.observacoes.data
 
-            Romaneio.query.filter_by(ordem_producao_id=ordem.id).delete()
-            ControleProducao.query.filter_by(ordem_producao_id=ordem.id).delete()
-            db.session.flush()
-
-            for item_data in form.romaneios.data:
-                if item_data.get('descricao') or item_data.get('quantidade'):
-                    item_data.pop('csrf_token', None)
-                    romaneio_item = Romaneio(ordem_producao_id=ordem.id, **item_data)
-                    db.session.add(romaneio_item)
-
-            for item_data in form.controles_producao.data:
-                 if item_data.get('processo'):
-                    item_data.pop('csrf_token', None)
-                    controle_item = ControleProducao(ordem_producao_id=ordem.id, **item_data)
-                    db.session.add(controle_item)
+            sincronizacoes = [
+                sincronizar_filhos(Romaneio, Romaneio.ordem_producao_id, ordem.id,
+                                   [f for f in linhas_fieldlist(form.romaneios) if f['descricao'] or f['quantidade']],
+                                   ('id_item', 'descricao', 'quantidade', 'materia_prima_utilizada')),
+                sincronizar_filhos(ControleProducao, ControleProducao.ordem_producao_id, ordem.id,
+                                   [f for f in linhas_fieldlist(form.controles_producao) if f['processo']],
+                                   ('departamento', 'obs_prod', 'turno', 'processo', 'maquina', 'operador',
+                                    'data_inicio', 'hora_inicio', 'data_pausa', 'motivo_pausa',
+                                    'data_termino', 'hora_termino', 'qualidade')),
+            ]
 
+            registrar_alteracao_producao(ordem.id)
             db.session.commit()
+            print(f"Edição da OP {ordem.id}: filhos em {resumo_sincronizacao(sincronizacoes)}")
             flash('Ordem de Produção atualizada com sucesso!', 'success')
             return redirect(url_for('lista_ordens'))
 
@@ -941,7 +1626,206 @@ def editar_ordem(ordem_id):
             flash(f'Erro ao atualizar a Ordem de Produção: {e}', 'danger')
             print(f"Erro ao editar OP {ordem_id}: {e}")
 
-    return render_template('ordem_form.html', form=form, ordem=ordem, title=f"Editar OP {ordem.numero_sequencial}")
+    return render_template('ordem_form.html', form=form, ordem=ordem, title=f"Editar OP {ordem.numero_sequencial}",
+                           os_selecionada=os_selecionada)
+
+# ==============================================================================
+# QUADRO DE PRODUÇÃO AO VIVO (SERVER-SENT EVENTS)
+# ==============================================================================
+ETAPA_ABERTA = and_(ControleProducao.data_inicio.isnot(None), ControleProducao.data_termino.is_(None))
+
+def registrar_alteracao_producao(ordem_id):
+    """Avisa o quadro ao vivo; chamar na mesma transação que grava a OP ou suas etapas."""
+    db.session.add(AlteracaoProducao(ordem_producao_id=ordem_id))
+
+def cartoes_quadro(ids_op=None):
+    """Etapas de controle em aberto (iniciadas, sem término) agrupadas por OP: {op_id: cartão}.
+
+    Sem `ids_op`, todas as OPs com etapa aberta. Com `ids_op`, toda OP pedida
+    volta no resultado, com `etapas` vazia se não tem mais etapa aberta (ou
+    foi excluída), para o quadro retirá-la.
+    """
+    query = db.session.query(
+        OrdemProducao.id, OrdemProducao.numero_sequencial, OrdemProducao.cliente, OrdemProducao.status,
+        ControleProducao.id, ControleProducao.departamento, ControleProducao.maquina, ControleProducao.processo,
+        ControleProducao.operador, ControleProducao.turno, ControleProducao.data_inicio, ControleProducao.hora_inicio,
+        ControleProducao.data_pausa, ControleProducao.motivo_pausa
+    )
+    juncao = and_(ControleProducao.ordem_producao_id == OrdemProducao.id, ETAPA_ABERTA)
+    if ids_op is None:
+        query = query.join(ControleProducao, juncao)
+    else:
+        query = query.outerjoin(ControleProducao, juncao).filter(OrdemProducao.id.in_(ids_op))
+
+    cartoes = {}
+    for (op_id, numero, cliente, status, etapa_id, departamento, maquina, processo,
+         operador, turno, data_inicio, hora_inicio, data_pausa, motivo_pausa) in query:
+        cartao = cartoes.setdefault(op_id, {'id': op_id, 'numero': numero, 'cliente': cliente, 'status': status, 'etapas': []})
+        if etapa_id is None:
+            continue
+        cartao['etapas'].append({
+            'id': etapa_id,
+            'departamento': departamento or '',
+            'maquina': maquina or '',
+            'processo': processo,
+            'operador': operador,
+            'turno': turno,
+            'inicio': f"{data_inicio.isoformat()}T{hora_inicio.strftime('%H:%M') if hora_inicio else '00:00'}",
+            'pausada': data_pausa is not None,
+            'motivo_pausa': motivo_pausa,
+        })
+    for op_id in ids_op or ():
+        cartoes.setdefault(op_id, {'id': op_id, 'etapas': []})
+    return cartoes
+
+class QuadroProducao:
+    """Transmissor único do quadro ao vivo, compartilhado pelos navegadores do processo.
+
+    Uma thread (só enquanto houver alguém conectado) lê a cada `intervalo` as
+    linhas de alteracao_producao depois do cursor, recarrega só aquelas OPs e
+    põe o mesmo pacote na fila de cada assinante: uma consulta por rodada,
+    qualquer que seja o número de telas abertas.
+
+    Um id que falta na sequência pode ser uma transação ainda não confirmada:
+    o cursor espera por ele até `espera_lacuna` segundos (depois, foi rollback).
+    """
+
+    def __init__(self, intervalo, espera_lacuna=30, tamanho_fila=50):
+        self.intervalo = intervalo
+        self.espera_lacuna = espera_lacuna
+        self.tamanho_fila = tamanho_fila
+        self._lock = Lock()
+        self._assinantes = set()
+        self._thread = None
+        self._cartoes = None # None = ainda não carregado
+        self._cursor = 0
+        self._vistos = set()
+        self._lacunas = {}
+        self.rodadas = 0
+
+    def assinar(self):
+        fila = Queue(maxsize=self.tamanho_fila)
+        with self._lock:
+            self._assinantes.add(fila)
+            if self._cartoes is not None:
+                fila.put_nowait(self._pacote('retrato', self._cartoes.values()))
+            if self._thread is None:
+                self._thread = Thread(target=self._rodar, name='quadro-producao', daemon=True)
+                self._thread.start()
+        return fila
+
+    def cancelar(self, fila):
+        with self._lock:
+            self._assinantes.discard(fila)
+
+    @staticmethod
+    def _pacote(tipo, cartoes):
+        return tipo, json.dumps(list(cartoes), ensure_ascii=False)
+
+    def _enviar(self, tipo, cartoes):
+        pacote = self._pacote(tipo, cartoes)
+        for fila in self._assinantes:
+            try:
+                fila.put_nowait(pacote)
+            except Full:
+                # Navegador parado: descarta o atrasado e manda o quadro inteiro
+                with fila.mutex:
+                    fila.queue.clear()
+                fila.put_nowait(self._pacote('retrato', self._cartoes.values()))
+
+    def _rodar(self):
+        with app.app_context():
+            while True:
+                with self._lock:
+                    if not self._assinantes:
+                        self._thread, self._cartoes = None, None
+                        return
+                try:
+                    if self._cartoes is None:
+                        self._carregar_tudo()
+                    else:
+                        self._verificar()
+                    self.rodadas += 1
+                except Exception as e:
+                    print(f"Erro no quadro de produção: {e}")
+                finally:
+                    db.session.remove()
+                sleep(self.intervalo)
+
+    def _carregar_tudo(self):
+        # Parte de um cursor antigo o bastante para não haver transação em aberto
+        # abaixo dele; o que veio depois é reaplicado na próxima rodada (idempotente).
+        limite = datetime.now() - timedelta(seconds=self.espera_lacuna)
+        cursor = db.session.query(func.coalesce(func.max(AlteracaoProducao.id), 0))\
+            .filter(AlteracaoProducao.momento < limite).scalar()
+        cartoes = cartoes_quadro()
+        with self._lock:
+            self._cursor, self._vistos, self._lacunas = cursor, set(), {}
+            self._cartoes = cartoes
+            self._enviar('retrato', cartoes.values())
+
+    def _verificar(self):
+        linhas = db.session.query(AlteracaoProducao.id, AlteracaoProducao.ordem_producao_id)\
+            .filter(AlteracaoProducao.id > self._cursor).order_by(AlteracaoProducao.id).all()
+        if not linhas:
+            return
+        agora = monotonic()
+        presentes = {i for i, _ in linhas}
+        for faltante in range(self._cursor + 1, linhas[-1][0]):
+            if faltante not in presentes:
+                self._lacunas.setdefault(faltante, agora)
+        novas = {op for i, op in linhas if i not in self._vistos}
+        self._vistos |= presentes
+
+        aguardando = [i for i, desde in self._lacunas.items() if i not in presentes and agora - desde < self.espera_lacuna]
+        self._cursor = min(aguardando) - 1 if aguardando else linhas[-1][0]
+        self._lacunas = {i: d for i, d in self._lacunas.items() if i > self._cursor and i not in presentes}
+        self._vistos = {i for i in self._vistos if i > self._cursor}
+        if not novas:
+            return
+
+        cartoes = cartoes_quadro(novas)
+        with self._lock:
+            for op_id, cartao in cartoes.items():
+                if cartao['etapas']:
+                    self._cartoes[op_id] = cartao
+                else:
+                    self._cartoes.pop(op_id, None)
+            self._enviar('delta', cartoes.values())
+
+quadro_producao = QuadroProducao(app.config['QUADRO_INTERVALO_SEGUNDOS'])
+
+@app.route('/quadro-producao')
+@login_required
+def quadro_producao_pagina():
+    return render_template('quadro_producao.html', title="Quadro de Produção ao Vivo",
+                           departamentos=list(PROCESSOS_POR_DEPARTAMENTO))
+
+@app.route('/quadro-producao/eventos')
+@login_required
+def quadro_producao_eventos():
+    """Fluxo SSE: evento `retrato` (quadro inteiro) ao conectar, depois `delta` com as OPs que mudaram.
+
+    Cada conexão ocupa uma thread do servidor enquanto a tela estiver aberta
+    (rodar com workers de threads, ex.: gunicorn --threads).
+    """
+    fila = quadro_producao.assinar()
+
+    def eventos():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    tipo, dados = fila.get(timeout=15)
+                except Empty:
+                    yield ': ping\n\n' # mantém a conexão aberta em proxies
+                    continue
+                yield f'event: {tipo}\ndata: {dados}\n\n'
+        finally:
+            quadro_producao.cancelar(fila)
+
+    return Response(eventos(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # ==============================================================================
 # ROTAS DE USUÁRIOS (ADMIN)
@@ -1003,20 +1887,47 @@ def excluir_usuario(user_id):
         flash('Usuário excluído.', 'success')
     return redirect(url_for('lista_usuarios'))
 
+@app.route('/admin/cache-referencia')
+@login_required
+@role_required('admin')
+def estatisticas_cache_referencia():
+    return jsonify({'ttl_segundos': cache_referencia.ttl, 'chaves': cache_referencia.estatisticas()})
+
 # ==============================================================================
 # ROTAS DE PRODUTOS E MANUTENÇÃO
 # ==============================================================================
 
+PRODUTOS_POR_BLOCO = 100 # linhas por pedido da grade de produtos
+
 @app.route('/produtos')
 @login_required
 def lista_produtos():
-    query = request.args.get('q', '')
-    produtos_query = Produto.query
-    if query:
-        search_term = f"%{query}%"
-        produtos_query = produtos_query.filter(or_(Produto.part_number.ilike(search_term), Produto.sku.ilike(search_term), Produto.descricao.ilike(search_term)))
-    produtos = produtos_query.order_by(Produto.part_number).all()
-    return render_template('lista_produtos.html', produtos=produtos, title="Lista de Produtos", query=query)
+    # As linhas vêm de /api/produtos/grade conforme a grade rola (ver lista_produtos.html)
+    catalogo = catalogo_produtos.obter()
+    return render_template('lista_produtos.html', title="Lista de Produtos", query=request.args.get('q', ''),
+                           opcoes_filtro={c: catalogo.valores(c) for c in catalogo.COLUNAS_FILTRO},
+                           bloco=PRODUTOS_POR_BLOCO)
+
+@app.route('/api/produtos/grade')
+@login_required
+def api_grade_produtos():
+    """Janela da lista de produtos: filtro (q, tipo_de_material, unidade), ordenação e
+    paginação por deslocamento, servidos do catálogo em memória."""
+    catalogo = catalogo_produtos.obter()
+    ordenar = request.args.get('ordenar', 'part_number')
+    if ordenar not in catalogo.COLUNAS_ORDEM:
+        return jsonify({'error': f'Ordenação inválida. Use: {", ".join(catalogo.COLUNAS_ORDEM)}'}), 400
+    inicio = max(request.args.get('inicio', 0, type=int), 0)
+    quantidade = min(max(request.args.get('quantidade', PRODUTOS_POR_BLOCO, type=int), 1), PRODUTOS_POR_BLOCO)
+    filtros = {c: request.args[c] for c in catalogo.COLUNAS_FILTRO if request.args.get(c)}
+
+    try:
+        total, produtos = catalogo.listar(request.args.get('q', ''), filtros, ordenar,
+                                          request.args.get('direcao') == 'desc', inicio, quantidade)
+        return jsonify({'total': total, 'inicio': inicio, 'produtos': produtos})
+    except Exception as e:
+        print(f"Erro ao listar produtos: {e}")
+        return jsonify({'error': 'Erro ao listar produtos'}), 500
 
 @app.route('/produtos/novo', methods=['GET', 'POST'])
 @login_required
@@ -1064,13 +1975,28 @@ def os_info():
     if os_data: return jsonify({'cliente': os_data.cliente})
     else: return jsonify({'error': 'OS não encontrada'}), 404
 
+@app.route('/api/os/busca')
+@login_required
+def busca_os_seletor():
+    """Seletor de OS da OP: prefixo do número ou do cliente (usa os índices)."""
+    termo = request.args.get('q', '').strip()
+    if not termo:
+        return jsonify([])
+    query = db.session.query(OS.id, OS.numero, OS.cliente, OS.status).filter(
+        or_(OS.numero.startswith(termo, autoescape=True), OS.cliente.startswith(termo, autoescape=True))
+    )
+    if request.args.get('abertas') == '1':
+        query = query.filter(OS.status.notin_(STATUS_OS_FECHADA))
+    resultados = query.order_by(OS.numero).limit(LIMITE_BUSCA_OS).all()
+    return jsonify([{'id': o.id, 'numero': o.numero, 'cliente': o.cliente, 'status': o.status} for o in resultados])
+
 @app.route('/api/produto/info')
 @login_required
 def produto_info():
     part_number_query = request.args.get('part_number', '')
     if not part_number_query: return jsonify({'error': 'Part number não fornecido'}), 400
-    produto = Produto.query.filter_by(part_number=part_number_query).first()
-    if produto: return jsonify(produto.to_dict())
+    produto = catalogo_produtos.obter().por_part_number(part_number_query)
+    if produto: return jsonify(produto)
     else: return jsonify({'error': 'Produto não encontrado'}), 404
 
 @app.route('/api/produtos/search')
@@ -1078,19 +2004,18 @@ def produto_info():
 def search_produtos():
     query = request.args.get('q', '')
     if not query: return jsonify([])
-    search_term = f"%{query}%"
-    produtos = Produto.query.filter(or_(Produto.part_number.ilike(search_term), Produto.sku.ilike(search_term), Produto.descricao.ilike(search_term))).order_by(Produto.part_number).limit(50).all()
-    return jsonify([p.to_dict() for p in produtos])
+    # Índice em memória do processo (ver CatalogoProdutos): sem ILIKE a cada tecla
+    return jsonify(catalogo_produtos.obter().buscar(query, limite=50))
 
 @app.route('/manutencao/nova', methods=['GET', 'POST'])
 @login_required
 def nova_manutencao():
     form = OSManutencaoForm()
-    ultimo_os = OSManutencao.query.order_by(OSManutencao.id.desc()).first()
-    proximo_numero = str(int(ultimo_os.numero) + 1) if ultimo_os and ultimo_os.numero.isdigit() else "1"
+    # Só para exibir: o número é reservado de fato ao salvar
+    proximo_numero = str(alocador_numeros.espiar('manutencao'))
     if form.validate_on_submit():
         try:
-            nova_os = OSManutencao(numero=proximo_numero, data_abertura=form.data_abertura.data, hora_abert=form.hora_abert.data, solicitante=form.solicitante.data, area_setor=form.area_setor.data, maq_equip=form.maq_equip.data, ocorrencia=form.ocorrencia.data, parada=form.parada.data, manut_corretiva=form.manut_corretiva.data, manut_preventiva=form.manut_preventiva.data, manut_preditiva=form.manut_preditiva.data, inspecao=form.inspecao.data, melhorias=form.melhorias.data, predial=form.predial.data, outro=form.outro.data, sintoma=form.sintoma.data, causa=form.causa.data, intervencao=form.intervencao.data, materiais_utilizados=form.materiais_utilizados.data, materiais_comprados=form.materiais_comprados.data, ficha_tec=form.ficha_tec.data, obs_manut=form.obs_manut.data, assinatura1=form.assinatura1.data, assinatura2=form.assinatura2.data, data_encerramento=form.data_encerramento.data)
+            nova_os = OSManutencao(numero=str(alocador_numeros.proximo('manutencao')), data_abertura=form.data_abertura.data, hora_abert=form.hora_abert.data, solicitante=form.solicitante.data, area_setor=form.area_setor.data, maq_equip=form.maq_equip.data, ocorrencia=form.ocorrencia.data, parada=form.parada.data, manut_corretiva=form.manut_corretiva.data, manut_preventiva=form.manut_preventiva.data, manut_preditiva=form.manut_preditiva.data, inspecao=form.inspecao.data, melhorias=form.melhorias.data, predial=form.predial.data, outro=form.outro.data, sintoma=form.sintoma.data, causa=form.causa.data, intervencao=form.intervencao.data, materiais_utilizados=form.materiais_utilizados.data, materiais_comprados=form.materiais_comprados.data, ficha_tec=form.ficha_tec.data, obs_manut=form.obs_manut.data, assinatura1=form.assinatura1.data, assinatura2=form.assinatura2.data, data_encerramento=form.data_encerramento.data)
             db.session.add(nova_os)
             db.session.flush()
             for apontamento_data in form.apontamentos.data:
@@ -1117,14 +2042,11 @@ def editar_manutencao(os_id):
     if form.validate_on_submit():
         try:
             os_obj.numero=form.numero.data; os_obj.data_abertura=form.data_abertura.data; os_obj.hora_abert=form.hora_abert.data; os_obj.solicitante=form.solicitante.data; os_obj.area_setor=form.area_setor.data; os_obj.maq_equip=form.maq_equip.data; os_obj.ocorrencia=form.ocorrencia.data; os_obj.parada=form.parada.data; os_obj.manut_corretiva=form.manut_corretiva.data; os_obj.manut_preventiva=form.manut_preventiva.data; os_obj.manut_preditiva=form.manut_preditiva.data; os_obj.inspecao=form.inspecao.data; os_obj.melhorias=form.melhorias.data; os_obj.predial=form.predial.data; os_obj.outro=form.outro.data; os_obj.sintoma=form.sintoma.data; os_obj.causa=form.causa.data; os_obj.intervencao=form.intervencao.data; os_obj.materiais_utilizados=form.materiais_utilizados.data; os_obj.materiais_comprados=form.materiais_comprados.data; os_obj.ficha_tec=form.ficha_tec.data; os_obj.obs_manut=form.obs_manut.data; os_obj.assinatura1=form.assinatura1.data; os_obj.assinatura2=form.assinatura2.data; os_obj.data_encerramento=form.data_encerramento.data
-            ManutApont.query.filter_by(os_manutencao_id=os_obj.id).delete()
-            db.session.flush()
-            for apontamento_data in form.apontamentos.data:
-                if apontamento_data.get('manutentor'):
-                    apontamento_data.pop('csrf_token', None)
-                    apontamento = ManutApont(os_manutencao_id=os_obj.id, manutentor=apontamento_data['manutentor'], data_inicio=apontamento_data.get('data_inicio'), hora_inicio=apontamento_data.get('hora_inicio'), data_termino=apontamento_data.get('data_termino'), hora_termino=apontamento_data.get('hora_termino'))
-                    db.session.add(apontamento)
+            sincronizacao = sincronizar_filhos(ManutApont, ManutApont.os_manutencao_id, os_obj.id,
+                                               [f for f in linhas_fieldlist(form.apontamentos) if f['manutentor']],
+                                               ('manutentor', 'data_inicio', 'hora_inicio', 'data_termino', 'hora_termino'))
             db.session.commit()
+            print(f"Edição da OS Manutenção {os_obj.id}: filhos em {resumo_sincronizacao([sincronizacao])}")
             flash(f'OS Manutenção Nº {os_obj.numero} atualizada com sucesso!', 'success')
             return redirect(url_for('lista_manutencao'))
         except Exception as e:
@@ -1143,46 +2065,18 @@ def lista_manutencao():
 def visualizar_manutencao(os_id):
     os_manut = OSManutencao.query.options(db.joinedload(OSManutencao.apontamentos)).get_or_404(os_id)
     parada_status = 'Sim' if os_manut.parada == 'Sim' else 'Não'
-    total_segundos = 0
-    for item in os_manut.apontamentos:
-        if item.data_inicio and item.hora_inicio and item.data_termino and item.hora_termino:
-            try:
-                inicio = datetime.combine(item.data_inicio, item.hora_inicio)
-                fim = datetime.combine(item.data_termino, item.hora_termino)
-                diferenca = fim - inicio
-                segundos = diferenca.total_seconds()
-                if segundos < 0: segundos = 0
-                total_segundos += segundos
-                horas = int(segundos // 3600); minutos = int((segundos % 3600) // 60)
-                item.duracao_formatada = f"{horas:02d}:{minutos:02d}"
-            except: item.duracao_formatada = "-"
-        else: item.duracao_formatada = "-"
-    total_horas = int(total_segundos // 3600); total_minutos = int((total_segundos % 3600) // 60)
-    total_horas_gastas = f"{total_horas:02d}:{total_minutos:02d}"
-    return render_template('visualizar_manutencao.html', os_manut=os_manut, parada_status=parada_status, total_horas_gastas=total_horas_gastas, title=f"Detalhes da OS {os_manut.numero}")
+    duracoes, total_segundos = duracoes_trabalhadas(ManutApont, ManutApont.os_manutencao_id == os_manut.id)
+    total_horas_gastas = format_duracao(total_segundos)
+    return render_template('visualizar_manutencao.html', os_manut=os_manut, parada_status=parada_status, duracoes=duracoes, total_horas_gastas=total_horas_gastas, title=f"Detalhes da OS {os_manut.numero}")
 
 @app.route('/manutencao/<int:os_id>/imprimir')
 @login_required
 def imprimir_manutencao(os_id):
     os_manut = OSManutencao.query.options(db.joinedload(OSManutencao.apontamentos)).get_or_404(os_id)
     parada_status = 'Sim' if os_manut.parada == 'Sim' else 'Não'
-    total_segundos = 0
-    for item in os_manut.apontamentos:
-        if item.data_inicio and item.hora_inicio and item.data_termino and item.hora_termino:
-            try:
-                inicio = datetime.combine(item.data_inicio, item.hora_inicio)
-                fim = datetime.combine(item.data_termino, item.hora_termino)
-                diferenca = fim - inicio
-                segundos = diferenca.total_seconds()
-                if segundos < 0: segundos = 0
-                total_segundos += segundos
-                horas = int(segundos // 3600); minutos = int((segundos % 3600) // 60)
-                item.duracao_formatada = f"{horas:02d}:{minutos:02d}"
-            except: item.duracao_formatada = "-"
-        else: item.duracao_formatada = "-"
-    total_horas = int(total_segundos // 3600); total_minutos = int((total_segundos % 3600) // 60)
-    total_horas_gastas = f"{total_horas:02d}:{total_minutos:02d}"
-    return render_template('imprimir_manutencao.html', os_manut=os_manut, parada_status=parada_status, total_horas_gastas=total_horas_gastas)
+    duracoes, total_segundos = duracoes_trabalhadas(ManutApont, ManutApont.os_manutencao_id == os_manut.id)
+    total_horas_gastas = format_duracao(total_segundos)
+    return render_template('imprimir_manutencao.html', os_manut=os_manut, parada_status=parada_status, duracoes=duracoes, total_horas_gastas=total_horas_gastas)
 
 @app.route('/manutencao/<int:os_id>/excluir', methods=['POST'])
 @login_required
@@ -1218,6 +2112,7 @@ def nova_despesa():
             else:
                 nova = Despesa(descricao=form.descricao.data, tipo=form.tipo.data)
                 db.session.add(nova); db.session.commit()
+                cache_referencia.invalidar('despesas')
                 flash(f'Despesa "{form.descricao.data}" criada com sucesso!', 'success')
                 return redirect(url_for('lista_despesas'))
         except Exception as e:
@@ -1238,6 +2133,7 @@ def gerenciar_tipos_fornecedor():
         novo_tipo = TipoFornecedor(descricao=form.descricao.data)
         db.session.add(novo_tipo)
         db.session.commit()
+        cache_referencia.invalidar('tipos_fornecedor')
         flash('Novo tipo de fornecedor cadastrado!', 'success')
         return redirect(url_for('gerenciar_tipos_fornecedor'))
     
@@ -1258,7 +2154,7 @@ def novo_fornecedor():
     form = FornecedorForm()
     
     # POPULAR O SELECT FIELD COM DADOS DO BANCO
-    form.tipo_fornecedor_id.choices = [(t.id, t.descricao) for t in TipoFornecedor.query.order_by(TipoFornecedor.descricao).all()]
+    form.tipo_fornecedor_id.choices = list(cache_referencia.obter('tipos_fornecedor'))
     form.tipo_fornecedor_id.choices.insert(0, (0, 'Selecione um tipo...'))
 
     if form.validate_on_submit():
@@ -1283,6 +2179,7 @@ def novo_fornecedor():
             )
             db.session.add(novo)
             db.session.commit()
+            cache_referencia.invalidar('fornecedores')
             flash('Fornecedor cadastrado com sucesso!', 'success')
             return redirect(url_for('lista_fornecedores'))
             
@@ -1295,7 +2192,7 @@ def editar_fornecedor(id):
     form = FornecedorForm(obj=fornecedor)
     
     # POPULAR O SELECT (Igual ao cadastro)
-    form.tipo_fornecedor_id.choices = [(t.id, t.descricao) for t in TipoFornecedor.query.order_by(TipoFornecedor.descricao).all()]
+    form.tipo_fornecedor_id.choices = list(cache_referencia.obter('tipos_fornecedor'))
     
     if request.method == 'GET':
         # Pré-selecionar o valor atual
@@ -1304,6 +2201,7 @@ def editar_fornecedor(id):
     if form.validate_on_submit():
         form.populate_obj(fornecedor)
         db.session.commit()
+        cache_referencia.invalidar('fornecedores')
         flash('Fornecedor atualizado!', 'success')
         return redirect(url_for('lista_fornecedores'))
         
@@ -1327,6 +2225,7 @@ def api_novo_tipo_fornecedor():
         novo = TipoFornecedor(descricao=descricao)
         db.session.add(novo)
         db.session.commit()
+        cache_referencia.invalidar('tipos_fornecedor')
         
         return jsonify({
             'success': True, 
@@ -1406,7 +2305,7 @@ def gerar_pedido(solicitacao_id):
     form = PedidoCompraForm()
     
     # Preenche o Dropdown de Fornecedores
-    form.fornecedor.choices = [(f.id, f.razao_social) for f in Fornecedor.query.order_by(Fornecedor.razao_social).all()]
+    form.fornecedor.choices = list(cache_referencia.obter('fornecedores'))
     
     # --- MÉTODO GET: Preenche o formulário com dados da Solicitação ---
     if request.method == 'GET':
@@ -1424,8 +2323,9 @@ def gerar_pedido(solicitacao_id):
     # --- MÉTODO POST: Salvar ou Aprovar ---
     if form.validate_on_submit():
         try:
-            # 1. Gera número do pedido (AnoMesDia-HoraMinuto) para ser único
-            num_pedido = datetime.now().strftime('%Y%m%d-%H%M%S')
+            # 1. Número do pedido: sequência por ano (ex.: 2026-00042)
+            ano = date.today().year
+            num_pedido = f"{ano}-{alocador_numeros.proximo('pedido', ano=ano):05d}"
             
             # 2. Calcula o Valor Total
             total_pedido = Decimal('0.00')
@@ -1493,6 +2393,390 @@ def gerar_pedido(solicitacao_id):
     return render_template('novo_pedido.html', form=form, solicitacao=solicitacao)
 
 
+# ==============================================================================
+# RELATÓRIO DE HORAS DE PRODUÇÃO
+# ==============================================================================
+FONTES_HORAS = {
+    'controle': ('Controle de Produção', ControleProducao),
+    'apontamento': ('Apontamentos', Apontamento),
+}
+
+DIMENSOES_HORAS = {
+    'maquina': 'Máquina',
+    'operador': 'Operador',
+    'processo': 'Processo',
+    'turno': 'Turno',
+    'departamento': 'Departamento',
+    'semana': 'Semana',
+}
+
+def coluna_dimensao(modelo, dimensao):
+    if dimensao == 'semana':
+        return inicio_semana(modelo.data_inicio)
+    if dimensao == 'maquina' and modelo is Apontamento:
+        return Apontamento.maquina_operacao
+    return getattr(modelo, dimensao)
+
+def horas_producao(fonte, linhas, colunas, inicio, fim, filtros):
+    """Soma das durações agrupada por uma ou duas dimensões, no banco.
+
+    Retorna tuplas (valor_linha, valor_coluna ou None, segundos, registros).
+    """
+    modelo = FONTES_HORAS[fonte][1]
+    grupos = [coluna_dimensao(modelo, linhas)]
+    if colunas:
+        grupos.append(coluna_dimensao(modelo, colunas))
+    query = db.session.query(*grupos, func.sum(segundos_trabalhados(modelo)), func.count(modelo.id))\
+        .filter(modelo.data_inicio >= inicio, modelo.data_inicio <= fim)
+    for dimensao, valor in filtros.items():
+        if valor:
+            query = query.filter(coluna_dimensao(modelo, dimensao) == valor)
+    resultado = []
+    for linha in query.group_by(*grupos).all():
+        valor_coluna = linha[1] if colunas else None
+        resultado.append((linha[0], valor_coluna, int(linha[-2] or 0), int(linha[-1])))
+    return resultado
+
+def rotulo_dimensao(valor):
+    if valor is None or valor == '':
+        return '(não informado)'
+    if isinstance(valor, date):
+        return valor.strftime('%d/%m/%Y')
+    if isinstance(valor, str) and re.fullmatch(r'\d{4}-\d{2}-\d{2}', valor):
+        return date.fromisoformat(valor).strftime('%d/%m/%Y') # semana no SQLite
+    return str(valor)
+
+def montar_pivo(resultado, com_colunas):
+    """Linhas x colunas com totais; sem dimensão de coluna, só a coluna Total."""
+    def ordenar(valores):
+        return sorted(valores, key=lambda v: (v is None or v == '', str(v)))
+    linhas = ordenar({r[0] for r in resultado})
+    colunas = ordenar({r[1] for r in resultado}) if com_colunas else []
+    celulas, total_linha, total_coluna = {}, defaultdict(int), defaultdict(int)
+    for valor_linha, valor_coluna, segundos, _ in resultado:
+        celulas[(valor_linha, valor_coluna)] = segundos
+        total_linha[valor_linha] += segundos
+        total_coluna[valor_coluna] += segundos
+    return {
+        'linhas': [(rotulo_dimensao(v), [celulas.get((v, c)) for c in colunas], total_linha[v]) for v in linhas],
+        'colunas': [rotulo_dimensao(c) for c in colunas],
+        'totais_colunas': [total_coluna[c] for c in colunas],
+        'total': sum(total_linha.values()),
+        'registros': sum(r[3] for r in resultado),
+    }
+
+def csv_pivo(pivo, titulo_linhas):
+    """CSV (; e vírgula decimal, abre direto no Excel) com horas em decimal."""
+    def horas(segundos):
+        return '' if segundos is None else f"{segundos / 3600:.2f}".replace('.', ',')
+    saida = io.StringIO()
+    escritor = csv.writer(saida, delimiter=';')
+    escritor.writerow([titulo_linhas] + pivo['colunas'] + ['Total (h)'])
+    for rotulo, celulas, total in pivo['linhas']:
+        escritor.writerow([rotulo] + [horas(c) for c in celulas] + [horas(total)])
+    escritor.writerow(['Total'] + [horas(t) for t in pivo['totais_colunas']] + [horas(pivo['total'])])
+    return '\ufeff' + saida.getvalue()
+
+@app.route('/relatorios/horas-producao')
+@login_required
+def relatorio_horas_producao():
+    hoje = date.today()
+    fim_padrao = inicio_do_mes(hoje) - timedelta(days=1) # mês passado
+    inicio = request.args.get('de', type=date.fromisoformat) or inicio_do_mes(fim_padrao)
+    fim = request.args.get('ate', type=date.fromisoformat) or fim_padrao
+    fonte = request.args.get('fonte', 'controle')
+    linhas = request.args.get('linhas', 'maquina')
+    colunas = request.args.get('colunas', '')
+    if fonte not in FONTES_HORAS:
+        fonte = 'controle'
+    if linhas not in DIMENSOES_HORAS:
+        linhas = 'maquina'
+    if colunas not in DIMENSOES_HORAS or colunas == linhas:
+        colunas = ''
+    filtros = {d: request.args.get(d, '').strip() for d in ('departamento', 'maquina', 'operador', 'turno')}
+
+    chave = ('horas_producao', fonte, linhas, colunas, inicio, fim, tuple(sorted(filtros.items())))
+    try:
+        resultado = cache_resultados.obter(chave, lambda: horas_producao(fonte, linhas, colunas, inicio, fim, filtros))
+    except Exception as e:
+        print(f"Erro no relatório de horas: {e}")
+        flash('Erro ao gerar o relatório de horas.', 'danger')
+        resultado = []
+    pivo = montar_pivo(resultado, bool(colunas))
+
+    if request.args.get('formato') == 'csv':
+        nome = f"horas_{fonte}_{linhas}{'_' + colunas if colunas else ''}_{inicio:%Y%m%d}_{fim:%Y%m%d}.csv"
+        return Response(csv_pivo(pivo, DIMENSOES_HORAS[linhas]), mimetype='text/csv',
+                        headers={'Content-Disposition': f'attachment; filename={nome}'})
+
+    return render_template('relatorio_horas.html', title="Horas de Produção", pivo=pivo,
+                           fontes=FONTES_HORAS, dimensoes=DIMENSOES_HORAS,
+                           departamentos=list(PROCESSOS_POR_DEPARTAMENTO),
+                           fonte=fonte, linhas=linhas, colunas=colunas, inicio=inicio, fim=fim, filtros=filtros)
+
+# ==============================================================================
+# PAINEL DE OEE (DISPONIBILIDADE x QUALIDADE POR MÁQUINA E TURNO)
+# ==============================================================================
+AGRUPAMENTOS_OEE = ('dia', 'semana')
+OEE_MAX_DIAS = 366
+
+def indicadores_oee(segundos_producao, segundos_parada, qtd_apontamentos, qtd_aprovados):
+    """Percentuais (0-100, 1 casa) de disponibilidade, qualidade e OEE; None sem base de cálculo."""
+    disponivel = segundos_producao + segundos_parada
+    disponibilidade = segundos_producao / disponivel if disponivel else None
+    qualidade = qtd_aprovados / qtd_apontamentos if qtd_apontamentos else None
+    oee = disponibilidade * qualidade if disponibilidade is not None and qualidade is not None else None
+    def pct(v):
+        return None if v is None else round(v * 100, 1)
+    return {'disponibilidade': pct(disponibilidade), 'qualidade': pct(qualidade), 'oee': pct(oee)}
+
+def consultar_oee(grupos, inicio, fim, maquina, turno):
+    somas = [func.coalesce(func.sum(getattr(OEETurno, c)), 0) for c in CAMPOS_OEE]
+    query = db.session.query(*grupos, *somas).filter(OEETurno.data >= inicio, OEETurno.data <= fim)\
+        .filter(or_(*(getattr(OEETurno, c) != 0 for c in CAMPOS_OEE))) # linhas zeradas pelos eventos
+    if maquina:
+        query = query.filter(OEETurno.maquina == maquina)
+    if turno:
+        query = query.filter(OEETurno.turno == turno)
+    return query.group_by(*grupos).order_by(*grupos).all()
+
+def montar_oee(inicio, fim, maquina, turno, agrupar):
+    """Série de tendência por dia/semana e tabela por máquina x turno, lidas do consolidado oee_turno."""
+    periodo = inicio_semana(OEETurno.data) if agrupar == 'semana' else OEETurno.data
+    tendencia = {'labels': [], 'disponibilidade': [], 'qualidade': [], 'oee': []}
+    for valor, *totais in consultar_oee([periodo], inicio, fim, maquina, turno):
+        tendencia['labels'].append(rotulo_dimensao(valor))
+        for chave, pct in indicadores_oee(*(int(t) for t in totais)).items():
+            tendencia[chave].append(pct)
+
+    maquinas = []
+    for valor_maquina, valor_turno, *totais in consultar_oee([OEETurno.maquina, OEETurno.turno], inicio, fim, maquina, turno):
+        producao, parada, apontamentos, aprovados = (int(t) for t in totais)
+        maquinas.append({
+            'maquina': valor_maquina or '(não informada)',
+            'turno': valor_turno or '-',
+            'horas_producao': round(producao / 3600, 1),
+            'horas_parada': round(parada / 3600, 1),
+            'apontamentos': apontamentos,
+            'aprovados': aprovados,
+            **indicadores_oee(producao, parada, apontamentos, aprovados)
+        })
+    return {'tendencia': tendencia, 'maquinas': maquinas}
+
+@app.route('/relatorios/oee')
+@login_required
+def painel_oee():
+    # Os dados vêm de /api/oee; aqui só as opções dos filtros (valores distintos do consolidado)
+    maquinas = [m[0] for m in db.session.query(OEETurno.maquina).distinct().order_by(OEETurno.maquina) if m[0]]
+    turnos = [t[0] for t in db.session.query(OEETurno.turno).distinct().order_by(OEETurno.turno) if t[0]]
+    hoje = date.today()
+    return render_template('oee.html', title="OEE por Máquina e Turno", maquinas=maquinas, turnos=turnos,
+                           inicio=hoje - timedelta(days=29), fim=hoje)
+
+@app.route('/api/oee')
+@login_required
+def api_oee():
+    hoje = date.today()
+    inicio = request.args.get('de', type=date.fromisoformat) or hoje - timedelta(days=29)
+    fim = request.args.get('ate', type=date.fromisoformat) or hoje
+    agrupar = request.args.get('agrupar', 'dia')
+    if fim < inicio:
+        return jsonify({'error': 'Período inválido'}), 400
+    if (fim - inicio).days > OEE_MAX_DIAS:
+        return jsonify({'error': f'Período maior que {OEE_MAX_DIAS} dias'}), 400
+    if agrupar not in AGRUPAMENTOS_OEE:
+        return jsonify({'error': f'Agrupamento inválido. Use: {", ".join(AGRUPAMENTOS_OEE)}'}), 400
+
+    try:
+        dados = montar_oee(inicio, fim, request.args.get('maquina', ''), request.args.get('turno', ''), agrupar)
+        return resposta_json_cacheavel(dados, CACHE_DASHBOARD_SEGUNDOS)
+    except Exception as e:
+        print(f"Erro ao carregar OEE: {e}")
+        return jsonify({'error': 'Erro ao carregar OEE'}), 500
+
+# ==============================================================================
+# API DE APONTAMENTO DOS TERMINAIS DE CHÃO DE FÁBRICA
+# ==============================================================================
+TIPOS_EVENTO = ('inicio', 'pausa', 'fim')
+MAX_EVENTOS_LOTE = 500
+MAQUINAS_VALIDAS = {m for maquinas in MAQUINAS_POR_SETOR.values() for m in maquinas}
+
+class EventoInvalido(ValueError):
+    pass
+
+def _texto_evento(bruto, campo, tamanho, obrigatorio=True):
+    valor = bruto.get(campo)
+    valor = str(valor).strip() if valor is not None else ''
+    if not valor:
+        if obrigatorio:
+            raise EventoInvalido(f"'{campo}' é obrigatório")
+        return None
+    if len(valor) > tamanho:
+        raise EventoInvalido(f"'{campo}' maior que {tamanho} caracteres")
+    return valor
+
+def validar_evento(bruto):
+    """Normaliza um evento do terminal. 'inicio' traz OP, turno, operador e
+    processo; 'pausa' traz o motivo; 'fim' pode trazer `aprovado` (padrão true)."""
+    if not isinstance(bruto, dict):
+        raise EventoInvalido('evento deve ser um objeto')
+    evento = {
+        'chave': _texto_evento(bruto, 'chave', 64),
+        'tipo': bruto.get('tipo'),
+        'maquina': _texto_evento(bruto, 'maquina', 100),
+        'ordem_producao_id': None, 'departamento': None, 'turno': None,
+        'processo': None, 'operador': None, 'motivo': None, 'aprovado': None,
+    }
+    if evento['tipo'] not in TIPOS_EVENTO:
+        raise EventoInvalido(f"'tipo' deve ser um de: {', '.join(TIPOS_EVENTO)}")
+    if evento['maquina'] not in MAQUINAS_VALIDAS:
+        raise EventoInvalido('máquina não cadastrada')
+    try:
+        momento = datetime.fromisoformat(str(bruto.get('momento')))
+    except ValueError:
+        raise EventoInvalido("'momento' inválido (use AAAA-MM-DDTHH:MM:SS)")
+    if momento.tzinfo is not None:
+        momento = momento.astimezone().replace(tzinfo=None) # hora local, como o resto do sistema
+    evento['momento'] = momento.replace(microsecond=0)
+
+    if evento['tipo'] == 'inicio':
+        op = bruto.get('op')
+        if not isinstance(op, int) or isinstance(op, bool):
+            raise EventoInvalido("'op' deve ser o id numérico da OP")
+        evento['ordem_producao_id'] = op
+        evento['turno'] = _texto_evento(bruto, 'turno', 5)
+        evento['operador'] = _texto_evento(bruto, 'operador', 50)
+        evento['processo'] = _texto_evento(bruto, 'processo', 100)
+        evento['departamento'] = _texto_evento(bruto, 'departamento', 50, obrigatorio=False)
+    elif evento['tipo'] == 'pausa':
+        evento['motivo'] = _texto_evento(bruto, 'motivo', 50)
+    else:
+        evento['aprovado'] = bruto.get('aprovado', True)
+        if not isinstance(evento['aprovado'], bool):
+            raise EventoInvalido("'aprovado' deve ser true ou false")
+    return evento
+
+def fechar_trecho(posto, momento, aprovado, apontamentos, paradas):
+    """Transforma o trecho em aberto da máquina em linha de Apontamento ou de ParadaNaoPlanejada."""
+    if posto.situacao == 'produzindo':
+        apontamentos.append({
+            'ordem_producao_id': posto.ordem_producao_id, 'departamento': posto.departamento,
+            'turno': posto.turno, 'processo': posto.processo, 'maquina_operacao': posto.maquina,
+            'operador': posto.operador, 'data_inicio': posto.desde.date(), 'hora_inicio': posto.desde.time(),
+            'data_termino': momento.date(), 'hora_termino': momento.time(), 'qualidade_aprovado': aprovado,
+        })
+    elif posto.situacao == 'pausada':
+        # Coluna TIME: pausas de mais de um dia ficam limitadas a 23:59:59
+        segundos = min(int((momento - posto.desde).total_seconds()), SEGUNDOS_DIA - 1)
+        paradas.append({
+            'ordem_producao_id': posto.ordem_producao_id, 'parada': posto.motivo,
+            'tempo_espera': time(segundos // 3600, segundos // 60 % 60, segundos % 60),
+            'data': posto.desde.date(), 'turno': posto.turno, 'maquina': posto.maquina,
+        })
+
+def gravar_lote_eventos(brutos):
+    """Valida, descarta repetidos e grava um lote de eventos dos terminais.
+
+    O número de comandos não cresce com o lote: um SELECT das chaves já
+    recebidas, um das OPs, um dos postos (com trava), um INSERT de várias
+    linhas para eventos, apontamentos e paradas, e os UPDATEs dos postos e do
+    consolidado de OEE. Eventos de uma máquina são aplicados em ordem de
+    `momento`; um evento anterior ao último já aplicado é rejeitado.
+    """
+    rejeitados, validos, chaves = [], [], set()
+    duplicados = 0
+    for indice, bruto in enumerate(brutos):
+        try:
+            evento = validar_evento(bruto)
+        except EventoInvalido as e:
+            chave = bruto.get('chave') if isinstance(bruto, dict) else None
+            rejeitados.append({'indice': indice, 'chave': chave, 'erro': str(e)})
+            continue
+        if evento['chave'] in chaves:
+            duplicados += 1
+            continue
+        chaves.add(evento['chave'])
+        validos.append((indice, evento))
+    if not validos:
+        return {'aceitos': 0, 'duplicados': duplicados, 'rejeitados': rejeitados}
+
+    ja_recebidas = {c for (c,) in db.session.query(EventoApontamento.chave).filter(EventoApontamento.chave.in_(chaves))}
+    duplicados += len(ja_recebidas)
+    validos = [(i, e) for i, e in validos if e['chave'] not in ja_recebidas]
+
+    ids_op = {e['ordem_producao_id'] for _, e in validos if e['ordem_producao_id'] is not None}
+    ops_existentes = {i for (i,) in db.session.query(OrdemProducao.id).filter(OrdemProducao.id.in_(ids_op))} if ids_op else set()
+    maquinas = {e['maquina'] for _, e in validos}
+    postos = {p.maquina: p for p in PostoMaquina.query.filter(PostoMaquina.maquina.in_(maquinas)).with_for_update()}
+
+    aceitos, apontamentos, paradas = [], [], []
+    for indice, evento in sorted(validos, key=lambda v: (v[1]['maquina'], v[1]['momento'], v[0])):
+        posto, tipo, momento = postos.get(evento['maquina']), evento['tipo'], evento['momento']
+        erro = None
+        if posto is not None and momento < posto.desde:
+            erro = 'anterior ao último evento desta máquina'
+        elif tipo == 'inicio' and evento['ordem_producao_id'] not in ops_existentes:
+            erro = 'OP não encontrada'
+        elif tipo == 'pausa' and (posto is None or posto.situacao != 'produzindo'):
+            erro = 'máquina não está produzindo'
+        elif tipo == 'fim' and (posto is None or posto.situacao == 'livre'):
+            erro = 'máquina sem início em aberto'
+        if erro:
+            rejeitados.append({'indice': indice, 'chave': evento['chave'], 'erro': erro})
+            continue
+
+        if posto is None:
+            posto = postos[evento['maquina']] = PostoMaquina(maquina=evento['maquina'], situacao='livre')
+            db.session.add(posto)
+        else:
+            # Início com a máquina já produzindo fecha o trecho anterior (fim esquecido)
+            fechar_trecho(posto, momento, evento['aprovado'] is not False, apontamentos, paradas)
+        posto.desde = momento
+        if tipo == 'inicio':
+            posto.situacao, posto.motivo = 'produzindo', None
+            for campo in ('ordem_producao_id', 'departamento', 'turno', 'processo', 'operador'):
+                setattr(posto, campo, evento[campo])
+        elif tipo == 'pausa':
+            posto.situacao, posto.motivo = 'pausada', evento['motivo']
+        else:
+            posto.situacao, posto.motivo = 'livre', None
+        aceitos.append(evento)
+
+    if aceitos:
+        db.session.execute(EventoApontamento.__table__.insert(), aceitos)
+    if apontamentos:
+        db.session.execute(Apontamento.__table__.insert(), apontamentos)
+    if paradas:
+        db.session.execute(ParadaNaoPlanejada.__table__.insert(), paradas)
+    aplicar_oee_em_lote(db.session.connection(), apontamentos, paradas)
+    db.session.commit()
+    return {'aceitos': len(aceitos), 'duplicados': duplicados, 'rejeitados': sorted(rejeitados, key=lambda r: r['indice']),
+            'apontamentos': len(apontamentos), 'paradas': len(paradas)}
+
+@app.route('/api/apontamentos/eventos', methods=['POST'])
+@login_required
+def api_eventos_apontamento():
+    """Recebe {"eventos": [...]} dos terminais; responde o que foi aceito, repetido ou rejeitado."""
+    dados = request.get_json(silent=True)
+    eventos = dados.get('eventos') if isinstance(dados, dict) else None
+    if not isinstance(eventos, list):
+        return jsonify({'error': 'Envie {"eventos": [...]}'}), 400
+    if len(eventos) > MAX_EVENTOS_LOTE:
+        return jsonify({'error': f'No máximo {MAX_EVENTOS_LOTE} eventos por lote'}), 400
+
+    for tentativa in range(2):
+        try:
+            return jsonify(gravar_lote_eventos(eventos))
+        except IntegrityError:
+            # Outro lote gravou a mesma chave ou o mesmo posto agora: de novo, já vendo o que ele gravou
+            db.session.rollback()
+            if tentativa:
+                return jsonify({'error': 'Conflito ao gravar o lote, reenvie'}), 409
+        except Exception as e:
+            db.session.rollback()
+            print(f"Erro ao gravar eventos de apontamento: {e}")
+            return jsonify({'error': 'Erro ao gravar eventos'}), 500
+
 # ==============================================================================
 # COMANDOS CLI
 # ==============================================================================
@@ -1555,53 +2839,406 @@ def seed_tipos():
         except Exception as e:
             print(f"Erro ao popular tipos: {e}")
 
-@app.cli.command('import-products')
-@click.argument('filename')
-def import_products_command(filename):
+@app.cli.command('podar-versoes')
+@click.option('--manter', default=20, show_default=True, help='Revisões mais recentes mantidas por OS.')
+@click.option('--dias', default=None, type=int, help='Só apaga revisões arquivadas há mais de N dias.')
+@click.option('--dry-run', is_flag=True, help='Só mostra quantas revisões seriam apagadas.')
+def podar_versoes_command(manter, dias, dry_run):
+    """Política de retenção do histórico de revisões (os_versao)."""
     with app.app_context():
         try:
-            num_deleted = db.session.query(Produto).delete()
+            limite_data = datetime.now() - timedelta(days=dias) if dias else None
+            # Só metadados: snapshot e dados_snapshot são deferred
+            linhas = db.session.query(OSVersao.id, OSVersao.os_id, OSVersao.numero_revisao, OSVersao.data_arquivamento)\
+                .order_by(OSVersao.os_id, OSVersao.numero_revisao.desc()).all()
+            # completar: revisões mantidas cuja anterior será apagada. Se forem
+            # delta, perdem a base e precisam virar revisão completa antes.
+            apagar, completar, os_atual, posicao, mais_nova = [], [], None, 0, None
+            for versao_id, os_id, numero_revisao, data_arquivamento in linhas:
+                if os_id != os_atual:
+                    os_atual, posicao, mais_nova = os_id, 0, None
+                posicao += 1
+                if posicao <= manter or (limite_data and data_arquivamento and data_arquivamento > limite_data):
+                    mais_nova = (versao_id, os_id, numero_revisao)
+                    continue
+                apagar.append(versao_id)
+                if mais_nova:
+                    completar.append(mais_nova)
+                    mais_nova = None
+
+            if dry_run:
+                print(f"{len(apagar)} de {len(linhas)} revisões seriam apagadas.")
+                return
+            convertidas = 0
+            for versao_id, os_id, numero_revisao in completar:
+                blob = db.session.query(OSVersao.snapshot).filter(OSVersao.id == versao_id).scalar()
+                if blob is None or decodificar_snapshot(blob)[0] != FORMATO_SNAPSHOT_DELTA:
+                    continue
+                dados = reconstrutor_revisoes.obter(os_id, numero_revisao)
+                db.session.execute(db.update(OSVersao).where(OSVersao.id == versao_id)
+                                   .values(snapshot=codificar_snapshot(dados)))
+                convertidas += 1
             db.session.commit()
-            if num_deleted > 0: print(f"{num_deleted} produtos antigos foram apagados.")
+            if convertidas:
+                print(f"{convertidas} revisões convertidas em revisão completa.")
+            for i in range(0, len(apagar), 500):
+                OSVersao.query.filter(OSVersao.id.in_(apagar[i:i + 500])).delete(synchronize_session=False)
+                db.session.commit()
+            print(f"{len(apagar)} de {len(linhas)} revisões apagadas.")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Erro ao podar revisões: {e}")
 
-            with open(filename, mode='r', encoding='latin-1') as csv_file:
-                header_line = csv_file.readline()
-                headers = [h.strip().lower() for h in header_line.split(';')]
-                print(f"Cabeçalhos detectados no CSV: {headers}")
-                csv_reader = csv.DictReader(csv_file, fieldnames=headers, delimiter=';')
-                products_to_add = []
-                print(f"Lendo o arquivo '{filename}'...")
+@app.cli.command('checar-consultas-cronograma')
+def checar_consultas_cronograma_command():
+    """Confere que o cronograma faz o mesmo número de consultas para qualquer janela."""
+    from sqlalchemy import event
+    with app.app_context():
+        consultas = []
+        def contar(conn, cursor, statement, *args):
+            consultas.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', contar)
+        try:
+            hoje = date.today()
+            resultados = []
+            duracao_maxima_os('OS')  # fora da contagem: na primeira vez calcula e grava o máximo
+            for dias in (7, 90, 365, JANELA_CRONOGRAMA_MAX_DIAS // 2):
+                consultas.clear()
+                corpo = ''.join(montar_cronograma(hoje - timedelta(days=dias), hoje + timedelta(days=dias), {}))
+                dados = json.loads(corpo)
+                if 'error' in dados:
+                    raise click.ClickException(dados['error'])
+                tarefas = dados['tarefas']
+                qtd_os = sum(1 for t in tarefas if '_os' not in t)
+                resultados.append(len(consultas))
+                print(f"Janela de ±{dias} dias: {qtd_os} OS, {len(tarefas) - qtd_os} barras de OP -> {len(consultas)} consultas")
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', contar)
+        if len(set(resultados)) != 1:
+            raise click.ClickException("O número de consultas variou com o tamanho da janela.")
+        print(f"OK: {resultados[0]} consultas em todas as janelas.")
+
+@app.cli.command('estressar-numeracao')
+@click.option('--threads', default=8, show_default=True, help='Threads reservando ao mesmo tempo.')
+@click.option('--por-thread', default=100, show_default=True, help='Números reservados por thread.')
+@click.option('--bloco', default=1, show_default=True, help='Tamanho do bloco reservado por vez.')
+def estressar_numeracao_command(threads, por_thread, bloco):
+    """Reserva números em paralelo numa sequência de teste e confere que nenhum se repete."""
+    from concurrent.futures import ThreadPoolExecutor
+    from models import AlocadorNumeros, SequenciaDocumento
+    nome = 'estresse'
+
+    def trabalhador(_):
+        # Um alocador por thread faz o papel de um processo do servidor
+        alocador = AlocadorNumeros()
+        alocador.registrar(nome, bloco=bloco)
+        with app.app_context():
+            return [alocador.proximo(nome) for _ in range(por_thread)]
+
+    with app.app_context():
+        SequenciaDocumento.query.filter_by(nome=nome).delete()
+        db.session.commit()
+        try:
+            inicio = monotonic()
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                numeros = [n for lote in executor.map(trabalhador, range(threads)) for n in lote]
+            duracao = monotonic() - inicio
+        finally:
+            SequenciaDocumento.query.filter_by(nome=nome).delete()
+            db.session.commit()
+
+    repetidos = len(numeros) - len(set(numeros))
+    print(f"{len(numeros)} números em {duracao:.2f}s ({threads} threads, bloco {bloco}): "
+          f"{repetidos} repetidos, maior = {max(numeros)}")
+    if repetidos:
+        raise click.ClickException("Números repetidos na sequência.")
+    print("OK: nenhuma colisão.")
+
+@app.cli.command('rebuild-kpis')
+def rebuild_kpis_command():
+    """Recalcula do zero o consolidado os_kpi_mensal a partir da tabela os."""
+    with app.app_context():
+        try:
+            consolidado = defaultdict(lambda: [0, 0])
+            chave_grupo = (OS.fase, OS.status, OS.empresa)
+
+            emitidas = db.session.query(
+                extract('year', OS.data_emissao), extract('month', OS.data_emissao), *chave_grupo, func.count(OS.id)
+            ).filter(OS.data_emissao.isnot(None)).group_by(
+                extract('year', OS.data_emissao), extract('month', OS.data_emissao), *chave_grupo
+            ).all()
+            for ano, mes, fase, status, empresa, qtd in emitidas:
+                consolidado[(date(int(ano), int(mes), 1), fase or '', status or '', empresa or '')][0] += qtd
+
+            concluidas = db.session.query(
+                extract('year', OS.data_conclusao), extract('month', OS.data_conclusao), *chave_grupo, func.count(OS.id)
+            ).filter(OS.data_conclusao.isnot(None)).group_by(
+                extract('year', OS.data_conclusao), extract('month', OS.data_conclusao), *chave_grupo
+            ).all()
+            for ano, mes, fase, status, empresa, qtd in concluidas:
+                consolidado[(date(int(ano), int(mes), 1), fase or '', status or '', empresa or '')][1] += qtd
+
+            db.session.query(OSKpiMensal).delete()
+            if consolidado:
+                db.session.execute(OSKpiMensal.__table__.insert(), [
+                    {'mes': mes, 'fase': fase, 'status': status, 'empresa': empresa,
+                     'qtd_emitidas': qtd_emi, 'qtd_concluidas': qtd_con}
+                    for (mes, fase, status, empresa), (qtd_emi, qtd_con) in consolidado.items()
+                ])
+            marcar_consolidado_pronto('os_kpi_mensal')
+            db.session.commit()
+            print(f"Consolidado de KPIs reconstruído: {len(consolidado)} linhas.")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Erro ao reconstruir KPIs: {e}")
+
+def consolidar_oee(inicio, fim):
+    """Linhas de oee_turno para [inicio, fim], agregadas no banco a partir dos apontamentos e paradas."""
+    consolidado = defaultdict(lambda: [0, 0, 0, 0])
+
+    maquina = func.coalesce(Apontamento.maquina_operacao, '')
+    turno = func.coalesce(Apontamento.turno, '')
+    apontamentos = db.session.query(
+        Apontamento.data_inicio, maquina, turno,
+        func.sum(func.coalesce(segundos_trabalhados(Apontamento), 0)),
+        func.count(Apontamento.id),
+        func.sum(case((Apontamento.qualidade_aprovado == False, 0), else_=1))
+    ).filter(Apontamento.data_inicio >= inicio, Apontamento.data_inicio <= fim)\
+        .group_by(Apontamento.data_inicio, maquina, turno).all()
+    for data, valor_maquina, valor_turno, segundos, qtd, aprovados in apontamentos:
+        linha = consolidado[(data, valor_maquina, valor_turno)]
+        linha[0] += int(segundos or 0)
+        linha[2] += int(qtd)
+        linha[3] += int(aprovados or 0)
+
+    espera = ParadaNaoPlanejada.tempo_espera
+    maquina = func.coalesce(ParadaNaoPlanejada.maquina, '')
+    turno = func.coalesce(ParadaNaoPlanejada.turno, '')
+    paradas = db.session.query(
+        ParadaNaoPlanejada.data, maquina, turno,
+        func.sum(extract('hour', espera) * 3600 + extract('minute', espera) * 60 + extract('second', espera))
+    ).filter(ParadaNaoPlanejada.data >= inicio, ParadaNaoPlanejada.data <= fim)\
+        .group_by(ParadaNaoPlanejada.data, maquina, turno).all()
+    for data, valor_maquina, valor_turno, segundos in paradas:
+        consolidado[(data, valor_maquina, valor_turno)][1] += int(segundos or 0)
+
+    return [{'data': data, 'maquina': valor_maquina, 'turno': valor_turno, **dict(zip(CAMPOS_OEE, valores))}
+            for (data, valor_maquina, valor_turno), valores in consolidado.items()]
+
+@app.cli.command('rebuild-oee')
+@click.option('--de', 'inicio', type=click.DateTime(formats=['%Y-%m-%d']), help='Primeiro dia (padrão: o mais antigo).')
+@click.option('--ate', 'fim', type=click.DateTime(formats=['%Y-%m-%d']), help='Último dia (padrão: hoje).')
+@click.option('--dias-por-lote', default=31, show_default=True, type=click.IntRange(min=1), help='Dias processados por transação.')
+def rebuild_oee_command(inicio, fim, dias_por_lote):
+    """Recalcula o consolidado oee_turno em lotes de datas (uma transação por lote).
+
+    Só o período informado é apagado e refeito. Rodar fora do horário de
+    apontamentos: um lançamento feito no meio de um lote pode ficar de fora.
+    """
+    with app.app_context():
+        if inicio is None:
+            inicio = min(filter(None, [
+                db.session.query(func.min(Apontamento.data_inicio)).scalar(),
+                db.session.query(func.min(ParadaNaoPlanejada.data)).scalar(),
+            ]), default=None)
+            if inicio is None:
+                print("Nenhum apontamento ou parada com data para consolidar.")
+                return
+        else:
+            inicio = inicio.date()
+        fim = fim.date() if fim else date.today()
 
+        lote_inicio, total = inicio, 0
+        while lote_inicio <= fim:
+            lote_fim = min(lote_inicio + timedelta(days=dias_por_lote - 1), fim)
+            try:
+                db.session.query(OEETurno).filter(OEETurno.data >= lote_inicio, OEETurno.data <= lote_fim)\
+                    .delete(synchronize_session=False)
+                linhas = consolidar_oee(lote_inicio, lote_fim)
+                if linhas:
+                    db.session.execute(OEETurno.__table__.insert(), linhas)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Erro ao consolidar OEE de {lote_inicio:%d/%m/%Y} a {lote_fim:%d/%m/%Y}: {e}")
+                return
+            total += len(linhas)
+            print(f"{lote_inicio:%d/%m/%Y} a {lote_fim:%d/%m/%Y}: {len(linhas)} linhas")
+            lote_inicio = lote_fim + timedelta(days=1)
+        print(f"Consolidado de OEE reconstruído: {total} linhas.")
+
+@app.cli.command('rebuild-dimensoes')
+def rebuild_dimensoes_command():
+    """Recalcula do zero os valores dos filtros (os_dimensao) a partir da tabela os."""
+    with app.app_context():
+        try:
+            linhas = []
+            for campo in CAMPOS_DIMENSAO_OS:
+                coluna = getattr(OS, campo)
+                valores = db.session.query(coluna).distinct().filter(coluna.isnot(None), coluna != '').all()
+                linhas.extend({'campo': campo, 'valor': v[0]} for v in valores)
+
+            db.session.query(OSDimensao).delete()
+            if linhas:
+                db.session.execute(OSDimensao.__table__.insert(), linhas)
+            marcar_consolidado_pronto('os_dimensao')
+            db.session.commit()
+            print(f"Valores de filtro da OS reconstruídos: {len(linhas)} linhas.")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Erro ao reconstruir valores de filtro: {e}")
+
+# Colunas do CSV de produtos gravadas no cadastro ('unidade' só se vier no arquivo)
+CAMPOS_IMPORTACAO = ('part_number', 'sku', 'descricao', 'tipo_de_material', 'custo')
+AMOSTRA_CODIFICACAO = 64 * 1024
+TAMANHOS_PRODUTO = {c.name: getattr(c.type, 'length', None) for c in Produto.__table__.c}
+
+def detectar_codificacao(amostra):
+    """UTF-8 (com ou sem BOM) se a amostra decodificar; senão cp1252, que é o
+    latin-1 do Windows (travessão e aspas curvas em 0x80-0x9F); latin-1 se
+    a amostra tiver bytes que o cp1252 não define."""
+    if amostra.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(amostra, final=False) # amostra pode cortar um caractere
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    try:
+        amostra.decode('cp1252')
+        return 'cp1252'
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+def corrigir_mojibake(texto):
+    """Desfaz texto UTF-8 que já foi lido como cp1252 ('INSTALAÃ‡ÃƒO' -> 'INSTALAÇÃO').
+    Texto acentuado legítimo quase nunca forma UTF-8 válido, então fica como está."""
+    if 'Ã' not in texto and 'Â' not in texto:
+        return texto
+    try:
+        return texto.encode('cp1252').decode('utf-8')
+    except UnicodeError:
+        return texto
+
+def ler_produto_csv(row, campos):
+    """Linha do CSV -> valores do cadastro, cortados no tamanho das colunas."""
+    valores = {}
+    for campo in campos:
+        texto = corrigir_mojibake((row.get(campo) or '').strip())
+        if campo == 'custo':
+            texto = texto.replace(',', '.')
+            valores[campo] = Decimal(texto) if texto else Decimal('0.0')
+        else:
+            valores[campo] = texto[:TAMANHOS_PRODUTO[campo]] or None
+    if not valores['part_number']:
+        raise ValueError("sem 'part_number'")
+    valores['descricao'] = valores['descricao'] or ''
+    return valores
+
+def gravar_lote_produtos(connection, lote, existentes):
+    """Upsert por part_number das linhas novas/alteradas de um lote."""
+    tabela = Produto.__table__
+    campos = list(next(iter(lote)))
+    if connection.dialect.name == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(tabela).values(lote)
+        connection.execute(stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in campos if c != 'part_number'}))
+        return
+    novos = [l for l in lote if l['part_number'] not in existentes]
+    alterados = [{f'b_{c}': l[c] for c in campos} for l in lote if l['part_number'] in existentes]
+    if novos:
+        connection.execute(tabela.insert(), novos)
+    if alterados:
+        connection.execute(tabela.update().where(tabela.c.part_number == bindparam('b_part_number'))
+                           .values({c: bindparam(f'b_{c}') for c in campos if c != 'part_number'}), alterados)
+
+@app.cli.command('import-products')
+@click.argument('filename')
+@click.option('--lote', default=1000, show_default=True, type=click.IntRange(min=1), help='Linhas por transação.')
+@click.option('--codificacao', default=None, help='Codificação do arquivo (padrão: detectada).')
+@click.option('--dry-run', is_flag=True, help='Só conta o que seria incluído/alterado, sem gravar.')
+def import_products_command(filename, lote, codificacao, dry_run):
+    """Importa/atualiza o cadastro de produtos a partir do CSV (separador ';').
+
+    Lê o arquivo em lotes e grava por part_number (INSERT ... ON DUPLICATE KEY
+    UPDATE no MySQL), uma transação por lote: o cadastro nunca fica vazio, os
+    ids continuam os mesmos (itens de solicitação de compra seguem apontando
+    para o produto) e a memória não cresce com o tamanho do arquivo. Linhas
+    iguais ao que já está gravado não são reenviadas. Produtos que saíram do
+    arquivo continuam no cadastro.
+    """
+    with app.app_context():
+        try:
+            tamanho = os.path.getsize(filename)
+            with open(filename, 'rb') as bruto:
+                codificacao = codificacao or detectar_codificacao(bruto.read(AMOSTRA_CODIFICACAO))
+                bruto.seek(0)
+                csv_file = io.TextIOWrapper(bruto, encoding=codificacao, newline='')
+                headers = [h.strip().lower() for h in csv_file.readline().split(';')]
+                print(f"Codificação: {codificacao}. Cabeçalhos detectados no CSV: {headers}")
+                if 'part_number' not in headers:
+                    print("Erro: o CSV não tem a coluna 'part_number'.")
+                    return
+                campos = CAMPOS_IMPORTACAO + (('unidade',) if 'unidade' in headers else ())
+                csv_reader = csv.DictReader(csv_file, fieldnames=headers, delimiter=';')
+                colunas = [getattr(Produto, c) for c in campos]
+                totais = dict.fromkeys(('novos', 'alterados', 'iguais', 'ignoradas'), 0)
+                print(f"Lendo o arquivo '{filename}'{' (simulação, nada será gravado)' if dry_run else ''}...")
+
+                def processar(pendentes):
+                    existentes = {linha[0]: tuple(linha) for linha in db.session.query(*colunas)
+                                  .filter(Produto.part_number.in_(list(pendentes))).all()}
+                    gravar = []
+                    for part_number, valores in pendentes.items():
+                        atual = existentes.get(part_number)
+                        if atual is None:
+                            totais['novos'] += 1
+                        elif atual == tuple(valores[c] for c in campos):
+                            totais['iguais'] += 1
+                            continue
+                        else:
+                            totais['alterados'] += 1
+                        gravar.append(valores)
+                    if gravar and not dry_run:
+                        gravar_lote_produtos(db.session.connection(), gravar, existentes)
+                        db.session.commit()
+                    else:
+                        db.session.rollback() # encerra a leitura do lote
+
+                pendentes, i = {}, 1
                 for i, row in enumerate(csv_reader, start=2):
                     try:
-                        part_number_val = row.get('part_number', '').strip()
-                        if not part_number_val:
-                            print(f"Aviso: Linha {i} sem 'part_number'. Ignorada.")
-                            continue
-                        sku_val = row.get('sku', '').strip() or None
-                        tipo_material_val = row.get('tipo_de_material', '').strip() or None
-                        descricao_val = row.get('descricao', '').strip()
-                        costo_str = row.get('custo', '0').replace(',', '.').strip()
-                        costo_value = Decimal(costo_str) if costo_str else Decimal('0.0')
-
-                        product = Produto(part_number=part_number_val, sku=sku_val, descricao=descricao_val, tipo_de_material=tipo_material_val, custo=costo_value)
-                        products_to_add.append(product)
-                    except Exception as e:
-                        print(f"Erro na linha {i}: {e}. Ignorada.")
+                        valores = ler_produto_csv(row, campos)
+                    except (ValueError, InvalidOperation) as e:
+                        print(f"Aviso: Linha {i} ignorada: {e}.")
+                        totais['ignoradas'] += 1
                         continue
-
-                if products_to_add:
-                    db.session.bulk_save_objects(products_to_add)
-                    db.session.commit()
-                    print(f"Importação concluída! {len(products_to_add)} produtos adicionados.")
-                else:
-                    print("Nenhum produto válido encontrado.")
+                    pendentes[valores['part_number']] = valores # repetido no lote: vale a última linha
+                    if len(pendentes) >= lote:
+                        processar(pendentes)
+                        pendentes = {}
+                        print(f"  {i} linhas ({bruto.tell() * 100 // max(tamanho, 1)}%): {totais['novos']} novos, "
+                              f"{totais['alterados']} alterados, {totais['iguais']} sem alteração, {totais['ignoradas']} ignoradas")
+                if pendentes:
+                    processar(pendentes)
+
+            gravados = totais['novos'] + totais['alterados']
+            if gravados and not dry_run:
+                marcar_versao_cadastro(db.session.connection(), 'produto') # uma recarga do catálogo, no fim
+                db.session.commit()
+            print(f"{'Simulação' if dry_run else 'Importação'} concluída! {i - 1} linhas: {totais['novos']} novos, "
+                  f"{totais['alterados']} alterados, {totais['iguais']} sem alteração, {totais['ignoradas']} ignoradas.")
 
         except FileNotFoundError: print(f"Erro: Arquivo '{filename}' não encontrado.")
         except Exception as e:
             db.session.rollback()
             print(f"Erro geral na importação: {e}")
-            print("Transação revertida.")
+            print("Lote atual revertido; os lotes anteriores já foram gravados. Rode de novo: linhas já gravadas são puladas.")
+            try:
+                marcar_versao_cadastro(db.session.connection(), 'produto')
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -23,4 +23,59 @@ with app.app_context():
             conn.commit()
         print("Sucesso! Tabela PedidoCompra atualizada para suportar aprovações.")
     except Exception as e:
-        print(f"Erro (ignore se for 'duplicate column'): {e}")
\ No newline at end of file
+        print(f"Erro (ignore se for 'duplicate column'): {e}")
+
+    print("Atualizando tabela de Paradas Não Planejadas (OEE)...")
+    try:
+        with db.engine.connect() as conn:
+            # Data, turno e máquina da parada: sem eles a parada não entra no OEE
+            try: conn.execute(text("ALTER TABLE parada_nao_planejada ADD COLUMN data DATE"))
+            except: pass
+
+            try: conn.execute(text("ALTER TABLE parada_nao_planejada ADD COLUMN turno VARCHAR(5)"))
+            except: pass
+
+            try: conn.execute(text("ALTER TABLE parada_nao_planejada ADD COLUMN maquina VARCHAR(100)"))
+            except: pass
+
+            conn.commit()
+        db.create_all() # cria a tabela oee_turno
+        print("Sucesso! Rode `flask rebuild-oee` para consolidar o histórico.")
+    except Exception as e:
+        print(f"Erro (ignore se for 'duplicate column'): {e}")
+
+    print("Ampliando colunas de máquina/processo (nomes de MAQUINAS_POR_SETOR) para os terminais...")
+    try:
+        with db.engine.connect() as conn:
+            for tabela, coluna, tipo in [('apontamento', 'maquina_operacao', 'VARCHAR(100) NOT NULL'),
+                                         ('apontamento', 'processo', 'VARCHAR(100) NOT NULL'),
+                                         ('parada_nao_planejada', 'maquina', 'VARCHAR(100)'),
+                                         ('oee_turno', 'maquina', "VARCHAR(100) NOT NULL DEFAULT ''")]:
+                try: conn.execute(text(f"ALTER TABLE {tabela} MODIFY COLUMN {coluna} {tipo}"))
+                except Exception as e: print(f"  {tabela}.{coluna}: {e}")
+            conn.commit()
+        db.create_all() # cria evento_apontamento e posto_maquina
+        print("Sucesso! Terminais podem enviar para /api/apontamentos/eventos.")
+    except Exception as e:
+        print(f"Erro: {e}")
+
+    print("Criando carimbo de versão do cadastro de produtos (catálogo em memória)...")
+    try:
+        db.create_all() # cria versao_cadastro; sem linha, o catálogo parte da versão 0
+        print("Sucesso!")
+    except Exception as e:
+        print(f"Erro: {e}")
+
+    print("Criando marca de rebuild dos consolidados (dashboard e filtros usam a tabela os até o primeiro rebuild)...")
+    try:
+        db.create_all() # cria consolidado_reconstruido
+        print("Sucesso! Rode `flask rebuild-kpis` e `flask rebuild-dimensoes` para passar a ler os consolidados.")
+    except Exception as e:
+        print(f"Erro: {e}")
+
+    print("Criando duração máxima das OS (limite da janela do cronograma)...")
+    try:
+        db.create_all() # cria os_duracao_maxima; sem linha, o cronograma calcula o máximo no primeiro uso
+        print("Sucesso!")
+    except Exception as e:
+        print(f"Erro: {e}")
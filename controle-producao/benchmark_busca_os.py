@@ -0,0 +1,87 @@
+import argparse
+import random
+from datetime import date, timedelta
+from statistics import median
+from time import perf_counter
+
+from app import app, db, OS, buscar_os, buscar_os_ilike, pagina_busca_os
+
+# Compara a busca geral de OS (FULLTEXT) com o caminho antigo (ILIKE '%x%'),
+# na primeira página e numa página funda da lista ranqueada.
+# Uso: python benchmark_busca_os.py "termo1" "termo 2" ...  (padrão: alguns termos comuns)
+#      python benchmark_busca_os.py --popular 500000   (SÓ em banco de teste: cria OS sintéticas 'BENCH-...')
+#      python benchmark_busca_os.py --limpar            (apaga as OS 'BENCH-...')
+parser = argparse.ArgumentParser()
+parser.add_argument('termos', nargs='*', default=['reconlog', 'galpao', 'sao paulo', '2024'])
+parser.add_argument('--popular', type=int, default=0, help='OS sintéticas a criar antes de medir.')
+parser.add_argument('--limpar', action='store_true', help='Apaga as OS sintéticas e sai.')
+args = parser.parse_args()
+
+REPETICOES = 20
+POR_PAGINA = 50
+PAGINA_FUNDA = 10
+META_MS = 50
+
+CLIENTES = ['Reconlog Brasil', 'Galpão Norte', 'Tendas São Paulo', 'Eventos Rio', 'Feira Agro 2024', 'Construtora Sul']
+CIDADES = ['São Paulo', 'Campinas', 'Rio de Janeiro', 'Curitiba', 'Belo Horizonte', 'Porto Alegre']
+VENDEDORES = ['Ana', 'Bruno', 'Carla', 'Diego', 'Elisa']
+
+def popular(quantidade):
+    """Insere OS sintéticas em lotes (INSERT de várias linhas; não passa pelos eventos do OS)."""
+    random.seed(1)
+    inicio = db.session.query(db.func.count(OS.id)).filter(OS.numero.like('BENCH-%')).scalar()
+    for base in range(inicio, inicio + quantidade, 5000):
+        db.session.execute(OS.__table__.insert(), [{
+            'numero': f'BENCH-{i:07d}', 'cliente': random.choice(CLIENTES), 'Cidade': random.choice(CIDADES),
+            'vendedo': random.choice(VENDEDORES), 'Razao': f'Razão {i % 997}', 'CNPJ': f'{i:014d}',
+            'observacoes': f'Locação de galpão {random.randint(10, 60)}m para evento {i % 211}',
+            'data_emissao': date(2020, 1, 1) + timedelta(days=i % 2000), 'status': 'Aberta', 'fase': 'OS',
+        } for i in range(base, min(base + 5000, inicio + quantidade))])
+        db.session.commit()
+    print(f"{quantidade} OS sintéticas criadas.")
+
+def medir(funcao):
+    tempos = []
+    for _ in range(REPETICOES):
+        inicio = perf_counter()
+        resultado = funcao()
+        tempos.append((perf_counter() - inicio) * 1000)
+    tempos.sort()
+    return len(resultado), median(tempos), tempos[int(len(tempos) * 0.95) - 1]
+
+with app.app_context():
+    if args.limpar:
+        apagadas = db.session.query(OS).filter(OS.numero.like('BENCH-%')).delete(synchronize_session=False)
+        db.session.commit()
+        print(f"{apagadas} OS sintéticas apagadas.")
+        raise SystemExit
+    if args.popular:
+        popular(args.popular)
+
+    total = db.session.query(db.func.count(OS.id)).scalar()
+    print(f"Banco: {db.engine.dialect.name} | OS na tabela: {total} | {REPETICOES} repetições por termo | meta: p95 < {META_MS} ms\n")
+    if db.engine.dialect.name != 'mysql':
+        print("Aviso: sem FULLTEXT neste banco; as linhas 'FULLTEXT' medem o ILIKE. A meta vale para o MySQL.\n")
+    print(f"{'Termo':<20} {'Caminho':<16} {'Linhas':>7} {'Mediana (ms)':>13} {'p95 (ms)':>10}")
+
+    acima_da_meta = []
+    for termo in args.termos:
+        def pagina_indice(pagina):
+            query, relevancia = buscar_os(OS.query.with_entities(OS.id), termo)
+            if relevancia is None:
+                return query.order_by(OS.id.desc()).limit(POR_PAGINA).all()
+            return pagina_busca_os(query, relevancia, POR_PAGINA, pagina)[0]
+
+        def via_ilike():
+            return buscar_os_ilike(OS.query.with_entities(OS.id), termo).order_by(OS.id.desc()).limit(POR_PAGINA).all()
+
+        caminhos = (('FULLTEXT p.1', lambda: pagina_indice(1)),
+                    (f'FULLTEXT p.{PAGINA_FUNDA}', lambda: pagina_indice(PAGINA_FUNDA)),
+                    ('ILIKE', via_ilike))
+        for nome, funcao in caminhos:
+            linhas, mediana, p95 = medir(funcao)
+            print(f"{termo[:20]:<20} {nome:<16} {linhas:>7} {mediana:>13.2f} {p95:>10.2f}")
+            if nome.startswith('FULLTEXT') and p95 >= META_MS:
+                acima_da_meta.append(f"{termo} ({nome})")
+
+    print(f"\nAcima da meta: {', '.join(acima_da_meta)}" if acima_da_meta else "\nOK: busca indexada dentro da meta em todos os termos.")
@@ -0,0 +1,26 @@
+from app import app, db
+from sqlalchemy import inspect
+
+# Cria no banco os índices declarados nos models que ainda não existem.
+# (O `flask create-db` só cria índices junto com tabelas novas.)
+with app.app_context():
+    print("Verificando índices...")
+    inspector = inspect(db.engine)
+    tabelas_banco = set(inspector.get_table_names())
+    criados = 0
+    with db.engine.begin() as conn:
+        for tabela in db.metadata.sorted_tables:
+            if tabela.name not in tabelas_banco:
+                print(f"- Tabela '{tabela.name}' não existe (rode `flask create-db`).")
+                continue
+            existentes = {ix['name'] for ix in inspector.get_indexes(tabela.name)}
+            for indice in tabela.indexes:
+                if indice.name in existentes:
+                    continue
+                try:
+                    indice.create(bind=conn)
+                    criados += 1
+                    print(f"- Índice {indice.name} criado em {tabela.name}.")
+                except Exception as e:
+                    print(f"Erro ao criar {indice.name}: {e}")
+    print(f"Concluído! {criados} índice(s) criado(s).")
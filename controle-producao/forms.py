@@ -2,6 +2,7 @@ from datetime import date, datetime, time, timedelta
 from flask_wtf import FlaskForm
 from wtforms import Form, StringField, PasswordField, BooleanField, IntegerField, DecimalField, DateField, TimeField, TextAreaField, SubmitField, FieldList, FormField, SelectField, RadioField
 from wtforms.validators import DataRequired, Optional, Length, InputRequired, Email
+from wtforms.widgets import HiddenInput
 
 # ==================== LISTAS DE OPÇÕES (MANUTENÇÃO - COMPLETAS) ====================
 OPCOES_SINTOMAS = [
@@ -178,6 +179,7 @@ class ProdutoForm(FlaskForm):
 
 class CustoOperacionalForm(FlaskForm):
     class Meta: csrf = False
+    id = IntegerField(widget=HiddenInput(), validators=[Optional()]) # Filho já gravado (vazio = linha nova)
     despesa_id = SelectField('Despesa Operacional', coerce=int, validators=[InputRequired()])
     valor = DecimalField('Previsto (R$)', places=2, validators=[InputRequired()])
     valor_realizado = DecimalField('Realizado (R$)', places=2, validators=[Optional()])
@@ -187,6 +189,7 @@ class CustoOperacionalForm(FlaskForm):
 
 class CustoVisitaForm(FlaskForm):
     class Meta: csrf = False
+    id = IntegerField(widget=HiddenInput(), validators=[Optional()])
     despesa_id = SelectField('Despesa de Visita', coerce=int, validators=[InputRequired()])
     valor = DecimalField('Previsto (R$)', places=2, validators=[InputRequired()])
     valor_realizado = DecimalField('Realizado (R$)', places=2, validators=[Optional()])
@@ -196,18 +199,21 @@ class CustoVisitaForm(FlaskForm):
 
 class CarregamentoForm(FlaskForm):
     class Meta: csrf = False
+    id = IntegerField(widget=HiddenInput(), validators=[Optional()])
     data = DateField('Data', default=date.today, format='%Y-%m-%d', validators=[DataRequired()])
     placa_caminhao = StringField('Placa', validators=[Optional(), Length(max=20)])
     documento_referencia = StringField('Doc/Romaneio', validators=[Optional(), Length(max=100)])
     observacao = StringField('Obs', validators=[Optional(), Length(max=200)])
 
 class RomaneioForm(Form):
+    id = IntegerField(widget=HiddenInput(), validators=[Optional()])
     id_item = IntegerField('ID', validators=[Optional()])
     descricao = StringField('Descrição', validators=[Optional(), Length(max=60)])
     quantidade = IntegerField('Qnt', validators=[Optional()])
     materia_prima_utilizada = StringField('Matéria Prima', validators=[Optional(), Length(max=50)])
 
 class ControleProducaoForm(Form):
+    id = IntegerField(widget=HiddenInput(), validators=[Optional()])
     departamento = SelectField('Departamento', choices=[('', 'Selecione'), ('Metalúrgica', 'Metalúrgica'), ('Confecção Lona', 'Confecção Lona'), ('Lavagem Lona', 'Lavagem Lona'), ('Logística', 'Logística')], validators=[Optional()])
     obs_prod = TextAreaField('Observação', validators=[Optional()])
     turno = SelectField('Turno', choices=[('', 'Selecione'), ('1', '1'), ('2', '2'), ('3', '3'), ('4', '4')], validators=[Optional()])
@@ -238,8 +244,12 @@ class ParadaForm(FlaskForm):
     tempo_espera = TimeField('Tempo de Espera', validators=[Optional()], format='%H:%M')
     desvios_registrados = TextAreaField('Desvios', validators=[Optional()])
     aprovacao_desvio = StringField('Aprovação', validators=[Optional()])
+    data = DateField('Data', validators=[Optional()], format='%Y-%m-%d')
+    turno = StringField('Turno', validators=[Optional()])
+    maquina = StringField('Máquina', validators=[Optional()])
 
 class ManutApontForm(Form):
+    id = IntegerField(widget=HiddenInput(), validators=[Optional()])
     manutentor = StringField('Manutentor', validators=[DataRequired(), Length(max=40)])
     data_inicio = DateField('Data Início', validators=[Optional()], format='%Y-%m-%d')
     hora_inicio = TimeField('Hora Início', validators=[Optional()], format='%H:%M')
@@ -318,7 +328,8 @@ class OSForm(FlaskForm):
     submit = SubmitField('Salvar OS')
 
 class OrdemProducaoForm(FlaskForm):
-    os = SelectField('Ordem de Serviço (OS)', coerce=int, validators=[DataRequired(message="Selecione uma OS.")])
+    # Escolhida pelo seletor com busca (/api/os/busca); a rota confere se o id existe
+    os = IntegerField('Ordem de Serviço (OS)', validators=[DataRequired(message="Selecione uma OS.")])
     departamento = SelectField('Departamento', choices=[('', 'Selecione'), ('Metalurgia', 'Metalurgia'), ('Lona', 'Lona'), ('Logistica', 'Logistica')], validators=[DataRequired()])
     status = SelectField('Status', choices=[('Aberto', 'Aberto'), ('Fechado', 'Fechado')], validators=[DataRequired()], default='Aberto')
     data_fechamento = DateField('Data de Fechamento', validators=[Optional()], format='%Y-%m-%d')
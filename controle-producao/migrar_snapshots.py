@@ -0,0 +1,57 @@
+from app import app, db
+from models import OSVersao, codificar_snapshot
+from sqlalchemy import text, inspect, bindparam
+import json
+import sys
+
+# Converte os_versao.dados_snapshot (JSON texto com indent) para o formato
+# binário em os_versao.snapshot, em lotes, e libera a coluna antiga.
+# Pode ser interrompido e rodado de novo: só pega linhas ainda não migradas.
+# Uso: python migrar_snapshots.py [tamanho_do_lote]
+LOTE = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+with app.app_context():
+    print("Migrando snapshots de revisões da OS...")
+    colunas = {c['name'] for c in inspect(db.engine).get_columns('os_versao')}
+    with db.engine.begin() as conn:
+        if 'snapshot' not in colunas:
+            tipo = 'MEDIUMBLOB' if conn.dialect.name == 'mysql' else 'BLOB'
+            conn.execute(text(f"ALTER TABLE os_versao ADD COLUMN snapshot {tipo} NULL"))
+            print("- Coluna 'snapshot' criada.")
+        if conn.dialect.name == 'mysql':
+            conn.execute(text("ALTER TABLE os_versao MODIFY dados_snapshot TEXT NULL"))
+
+    tabela = OSVersao.__table__
+    atualizar = tabela.update().where(tabela.c.id == bindparam('b_id')).values(
+        snapshot=bindparam('b_snapshot'), dados_snapshot=None
+    )
+    ultimo_id, migradas, bytes_antes, bytes_depois = 0, 0, 0, 0
+    while True:
+        linhas = db.session.execute(
+            db.select(tabela.c.id, tabela.c.dados_snapshot)
+            .where(tabela.c.id > ultimo_id, tabela.c.snapshot.is_(None), tabela.c.dados_snapshot.isnot(None))
+            .order_by(tabela.c.id).limit(LOTE)
+        ).all()
+        if not linhas:
+            break
+        parametros = []
+        for versao_id, texto in linhas:
+            try:
+                blob = codificar_snapshot(json.loads(texto))
+            except ValueError as e:
+                print(f"- Revisão id={versao_id} ignorada (JSON inválido): {e}")
+                continue
+            parametros.append({'b_id': versao_id, 'b_snapshot': blob})
+            bytes_antes += len(texto.encode('utf-8'))
+            bytes_depois += len(blob)
+        if parametros:
+            db.session.execute(atualizar, parametros)
+        db.session.commit()
+        ultimo_id = linhas[-1][0]
+        migradas += len(parametros)
+        print(f"- {migradas} revisões migradas (até id={ultimo_id})")
+
+    if migradas:
+        print(f"Concluído! {migradas} revisões: {bytes_antes / 1024:.1f} KB -> {bytes_depois / 1024:.1f} KB.")
+    else:
+        print("Concluído! Nenhuma revisão pendente.")
@@ -1,9 +1,23 @@
 # models.py (VERSÃO FINAL COMPLETA E VERIFICADA)
 
+import hashlib
+import heapq
+import json
+import re
+import unicodedata
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
 from datetime import date, datetime, time
 from decimal import Decimal
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy import event, inspect, case, or_, func, Integer
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+from threading import Lock, Thread
+from time import monotonic
 from werkzeug.security import generate_password_hash, check_password_hash
 
 db = SQLAlchemy()
@@ -132,6 +146,20 @@ class OS(db.Model):
     carregamentos = db.relationship('Carregamento', backref='os', lazy=True, cascade="all, delete-orphan")
     versoes = db.relationship('OSVersao', backref='os_pai', lazy=True, order_by="desc(OSVersao.numero_revisao)", cascade="all, delete-orphan")
 
+    # Índices compostos usados pelo dashboard (filtros por faixa de data)
+    __table_args__ = (
+        db.Index('ix_os_fase_data_emissao', 'fase', 'data_emissao'),
+        db.Index('ix_os_status_data_conclusao', 'status', 'data_conclusao'),
+        db.Index('ix_os_status_data_emissao', 'status', 'data_emissao'),
+        # Janela do cronograma: fase = 'OS' AND data_inicio <= fim AND data_termino >= inicio
+        db.Index('ix_os_fase_inicio_termino', 'fase', 'data_inicio', 'data_termino'),
+        # Busca por prefixo do seletor de OS da OP (numero já tem índice único)
+        db.Index('ix_os_cliente', 'cliente'),
+        # Busca geral da lista de OS (só existe no MySQL; collation já ignora acentos)
+        db.Index('ft_os_busca', 'numero', 'cliente', 'Razao', 'CNPJ', 'Cidade', 'vendedo', 'observacoes',
+                 mysql_prefix='FULLTEXT').ddl_if(dialect='mysql'),
+    )
+
     def __repr__(self):
          return f"OS {self.numero}"
 
@@ -143,7 +171,364 @@ class OSVersao(db.Model):
     data_arquivamento = db.Column(db.DateTime, default=datetime.now)
     usuario_responsavel = db.Column(db.String(50))
     motivo = db.Column(db.String(100))
-    dados_snapshot = db.Column(db.Text, nullable=False) # JSON completo
+    # Corpo da revisão: deferred, só é lido quando a revisão é aberta
+    snapshot = db.deferred(db.Column(db.LargeBinary(16777215), nullable=True)) # Ver codificar_snapshot() abaixo
+    dados_snapshot = db.deferred(db.Column(db.Text, nullable=True)) # Formato antigo (JSON texto), ver migrar_snapshots.py
+
+    __table_args__ = (
+        db.Index('ix_os_versao_os_revisao', 'os_id', 'numero_revisao'),
+    )
+
+# ==============================================================================
+# REVISÕES DA OS: SNAPSHOT BINÁRIO, DELTAS E RECONSTRUÇÃO
+# ==============================================================================
+# Snapshot binário: 1 byte com a versão do formato + corpo em JSON compacto
+# (sem espaços) comprimido com zlib.
+#   1 = revisão completa (keyframe)
+#   2 = delta: {'base': revisão anterior, 'campos': mudanças}, ver calcular_delta()
+# Linhas antigas só com dados_snapshot (texto) também contam como completas.
+FORMATO_SNAPSHOT_ZLIB = 1
+FORMATO_SNAPSHOT_DELTA = 2
+# No máximo INTERVALO_KEYFRAME - 1 deltas seguidos antes de uma revisão completa
+INTERVALO_KEYFRAME = 10
+
+def codificar_snapshot(dados, default=None, formato=FORMATO_SNAPSHOT_ZLIB):
+    corpo = json.dumps(dados, default=default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return bytes([formato]) + zlib.compress(corpo, 9)
+
+def decodificar_snapshot(blob):
+    """Devolve (formato, corpo)."""
+    formato = blob[0]
+    if formato in (FORMATO_SNAPSHOT_ZLIB, FORMATO_SNAPSHOT_DELTA):
+        return formato, json.loads(zlib.decompress(blob[1:]).decode('utf-8'))
+    raise ValueError(f"Formato de snapshot desconhecido: {formato}")
+
+def chave_item_snapshot(item):
+    """Identifica um item de lista do snapshot (custo, carregamento) entre revisões."""
+    if isinstance(item, dict) and item.get('id') is not None:
+        return f"{item.get('tipo', '')}:{item['id']}"
+    # Snapshots antigos não guardavam o id: usa o conteúdo
+    return hashlib.sha1(json.dumps(item, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def calcular_delta(anterior, atual):
+    """Mudanças de `atual` em relação a `anterior`, campo a campo do snapshot.
+
+    Dicts (cabeçalho) guardam só as chaves alteradas/removidas; listas guardam
+    a ordem das chaves dos itens e o conteúdo só dos itens novos ou alterados.
+    """
+    delta = {}
+    for campo in set(anterior) | set(atual):
+        a, b = anterior.get(campo), atual.get(campo)
+        if campo not in atual:
+            delta[campo] = {'tipo': 'removido'}
+        elif a == b and campo in anterior:
+            continue
+        elif isinstance(a, dict) and isinstance(b, dict):
+            delta[campo] = {'tipo': 'dict',
+                            'alterados': {k: v for k, v in b.items() if k not in a or a[k] != v},
+                            'removidos': [k for k in a if k not in b]}
+        elif isinstance(a, list) and isinstance(b, list):
+            base = {chave_item_snapshot(i): i for i in a}
+            ordem, itens = [], {}
+            for item in b:
+                chave = chave_item_snapshot(item)
+                ordem.append(chave)
+                if base.get(chave) != item:
+                    itens[chave] = item
+            delta[campo] = {'tipo': 'lista', 'ordem': ordem, 'itens': itens}
+        else:
+            delta[campo] = {'tipo': 'valor', 'valor': b}
+    return delta
+
+def aplicar_delta(anterior, delta):
+    """Inverso de calcular_delta(); não altera `anterior` (pode estar em cache)."""
+    dados = dict(anterior)
+    for campo, mudanca in delta.items():
+        tipo = mudanca['tipo']
+        if tipo == 'removido':
+            dados.pop(campo, None)
+        elif tipo == 'dict':
+            novo = dict(anterior.get(campo) or {})
+            novo.update(mudanca['alterados'])
+            for chave in mudanca['removidos']:
+                novo.pop(chave, None)
+            dados[campo] = novo
+        elif tipo == 'lista':
+            base = {chave_item_snapshot(i): i for i in anterior.get(campo) or []}
+            dados[campo] = [mudanca['itens'].get(chave, base.get(chave)) for chave in mudanca['ordem']]
+        else:
+            dados[campo] = mudanca['valor']
+    return dados
+
+class ReconstrutorRevisoes:
+    """Monta o conteúdo completo de uma revisão seguindo a cadeia de deltas.
+
+    Uma consulta traz até INTERVALO_KEYFRAME corpos (o suficiente para chegar
+    na revisão completa anterior); cada revisão montada fica num LRU por
+    (os_id, numero_revisao). Revisões não mudam depois de gravadas, então o
+    cache não precisa de invalidação. O dict devolvido é compartilhado: não
+    altere.
+    """
+
+    def __init__(self, tamanho):
+        self.tamanho = tamanho
+        self._cache = OrderedDict()
+        self._lock = Lock()
+        self.acertos = 0
+        self.falhas = 0
+
+    def obter(self, os_id, numero_revisao):
+        """Devolve o dict da revisão, ou None se ela não existir."""
+        encontrado = self.obter_com_profundidade(os_id, numero_revisao)
+        return encontrado[0] if encontrado is not None else None
+
+    def obter_com_profundidade(self, os_id, numero_revisao):
+        """(dict da revisão, quantos deltas a separam da revisão completa
+        anterior), numa única consulta ao cache; None se ela não existir."""
+        encontrado = self._do_cache((os_id, numero_revisao))
+        if encontrado is not None:
+            return encontrado
+        corpos = self._carregar_corpos(os_id, numero_revisao)
+        if numero_revisao not in corpos:
+            return None
+        return self._montar(os_id, numero_revisao, corpos)
+
+    def _do_cache(self, chave):
+        with self._lock:
+            valor = self._cache.get(chave)
+            if valor is None:
+                self.falhas += 1
+                return None
+            self._cache.move_to_end(chave)
+            self.acertos += 1
+            return valor
+
+    def _guardar(self, chave, valor):
+        with self._lock:
+            self._cache[chave] = valor
+            self._cache.move_to_end(chave)
+            while len(self._cache) > self.tamanho:
+                self._cache.popitem(last=False)
+
+    def _carregar_corpos(self, os_id, ate_revisao):
+        linhas = db.session.query(OSVersao.numero_revisao, OSVersao.snapshot, OSVersao.dados_snapshot)\
+            .filter(OSVersao.os_id == os_id, OSVersao.numero_revisao <= ate_revisao)\
+            .order_by(OSVersao.numero_revisao.desc()).limit(INTERVALO_KEYFRAME).all()
+        return {n: (blob, texto) for n, blob, texto in linhas}
+
+    def _montar(self, os_id, numero_revisao, corpos):
+        chave = (os_id, numero_revisao)
+        with self._lock:
+            if chave in self._cache:
+                return self._cache[chave]
+        if numero_revisao not in corpos:
+            corpos = self._carregar_corpos(os_id, numero_revisao)
+            if numero_revisao not in corpos:
+                raise LookupError(f"Revisão base {numero_revisao} da OS {os_id} não existe")
+        blob, texto = corpos[numero_revisao]
+        if blob is None:
+            valor = (json.loads(texto) if texto else {}, 0)
+        else:
+            formato, corpo = decodificar_snapshot(blob)
+            if formato == FORMATO_SNAPSHOT_DELTA:
+                base, profundidade = self._montar(os_id, corpo['base'], corpos)
+                valor = (aplicar_delta(base, corpo['campos']), profundidade + 1)
+            else:
+                valor = (corpo, 0)
+        self._guardar(chave, valor)
+        return valor
+
+reconstrutor_revisoes = ReconstrutorRevisoes(tamanho=256)
+
+def codificar_revisao(os_id, numero_anterior, dados):
+    """Corpo de uma nova revisão: delta contra `numero_anterior` ou completa.
+
+    `dados` já deve estar no formato JSON (datas/decimais convertidos), que é
+    o mesmo devolvido pelo reconstrutor.
+    """
+    if numero_anterior is not None:
+        encontrado = reconstrutor_revisoes.obter_com_profundidade(os_id, numero_anterior)
+        if encontrado is not None and encontrado[1] + 1 < INTERVALO_KEYFRAME:
+            delta = {'base': numero_anterior, 'campos': calcular_delta(encontrado[0], dados)}
+            return codificar_snapshot(delta, formato=FORMATO_SNAPSHOT_DELTA)
+    return codificar_snapshot(dados)
+
+# ==============================================================================
+# CONSOLIDADO MENSAL DE KPIs DA OS (ALIMENTA O DASHBOARD)
+# ==============================================================================
+class OSKpiMensal(db.Model):
+    """Contagem de OS por mês x fase x status x empresa.
+
+    qtd_emitidas conta pelo mês de data_emissao; qtd_concluidas pelo mês de
+    data_conclusao. Mantida pelos eventos do OS abaixo e reconstruída com
+    `flask rebuild-kpis`.
+    """
+    __tablename__ = 'os_kpi_mensal'
+    id = db.Column(db.Integer, primary_key=True)
+    mes = db.Column(db.Date, nullable=False) # Sempre o dia 1 do mês
+    fase = db.Column(db.String(20), nullable=False, default='')
+    status = db.Column(db.String(20), nullable=False, default='')
+    empresa = db.Column(db.String(50), nullable=False, default='')
+    qtd_emitidas = db.Column(db.Integer, nullable=False, default=0)
+    qtd_concluidas = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('mes', 'fase', 'status', 'empresa', name='uq_os_kpi_mensal_chave'),
+    )
+
+class ConsolidadoReconstruido(db.Model):
+    """Marca que o `flask rebuild-...` de um consolidado já rodou ('os_kpi_mensal', ...).
+
+    Os eventos começam a gravar no consolidado assim que o código novo sobe;
+    até o primeiro rebuild ele só tem as linhas tocadas depois disso, então
+    as telas leem a tabela de origem enquanto não houver a marca.
+    """
+    __tablename__ = 'consolidado_reconstruido'
+    nome = db.Column(db.String(30), primary_key=True)
+    reconstruido_em = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+def consolidado_pronto(nome):
+    return db.session.get(ConsolidadoReconstruido, nome) is not None
+
+def marcar_consolidado_pronto(nome):
+    """Chamar na mesma transação do rebuild."""
+    db.session.merge(ConsolidadoReconstruido(nome=nome, reconstruido_em=datetime.now()))
+
+def inicio_do_mes(d):
+    return date(d.year, d.month, 1)
+
+def proximo_mes(d):
+    return date(d.year + 1, 1, 1) if d.month == 12 else date(d.year, d.month + 1, 1)
+
+def _kpi_contribuicoes(data_emissao, data_conclusao, fase, status, empresa):
+    """Linhas do consolidado que uma OS com esses valores incrementa."""
+    chave = (fase or '', status or '', empresa or '')
+    deltas = {}
+    if data_emissao:
+        mes = inicio_do_mes(data_emissao)
+        deltas[mes] = [1, 0]
+    if data_conclusao:
+        mes = inicio_do_mes(data_conclusao)
+        deltas.setdefault(mes, [0, 0])[1] += 1
+    return {(mes,) + chave: tuple(v) for mes, v in deltas.items()}
+
+def _aplicar_delta_kpi(connection, chave, d_emitidas, d_concluidas):
+    tabela = OSKpiMensal.__table__
+    mes, fase, status, empresa = chave
+    if connection.dialect.name == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(tabela).values(mes=mes, fase=fase, status=status, empresa=empresa,
+                                     qtd_emitidas=d_emitidas, qtd_concluidas=d_concluidas)
+        stmt = stmt.on_duplicate_key_update(
+            qtd_emitidas=tabela.c.qtd_emitidas + d_emitidas,
+            qtd_concluidas=tabela.c.qtd_concluidas + d_concluidas
+        )
+        connection.execute(stmt)
+        return
+    # Outros bancos (ex.: SQLite local): UPDATE e, se não existir, INSERT
+    resultado = connection.execute(
+        tabela.update()
+        .where(tabela.c.mes == mes, tabela.c.fase == fase, tabela.c.status == status, tabela.c.empresa == empresa)
+        .values(qtd_emitidas=tabela.c.qtd_emitidas + d_emitidas,
+                qtd_concluidas=tabela.c.qtd_concluidas + d_concluidas)
+    )
+    if resultado.rowcount == 0:
+        connection.execute(tabela.insert().values(mes=mes, fase=fase, status=status, empresa=empresa,
+                                                  qtd_emitidas=d_emitidas, qtd_concluidas=d_concluidas))
+
+def _guardar_valores_anteriores(modelo, campos):
+    # Carrega o valor antigo mesmo com o atributo expirado (após commit), para o delta do after_update
+    for c in campos:
+        event.listen(getattr(modelo, c), 'set', lambda *args: None, active_history=True)
+
+def _valores_linha(target, campos, anteriores=False):
+    """{campo: valor} da linha; com anteriores=True, os valores de antes das alterações
+    pendentes (campos registrados em _guardar_valores_anteriores)."""
+    if not anteriores:
+        return {c: getattr(target, c) for c in campos}
+    estado = inspect(target)
+    valores = {}
+    for c in campos:
+        hist = estado.attrs[c].history
+        if hist.deleted:
+            valores[c] = hist.deleted[0]
+        elif hist.unchanged:
+            valores[c] = hist.unchanged[0]
+        else:
+            valores[c] = getattr(target, c)
+    return valores
+
+CAMPOS_KPI_OS = ('data_emissao', 'data_conclusao', 'fase', 'status', 'empresa')
+_guardar_valores_anteriores(OS, CAMPOS_KPI_OS)
+
+@event.listens_for(OS, 'after_insert')
+def _kpi_os_inserida(mapper, connection, target):
+    for chave, (d_emi, d_con) in _kpi_contribuicoes(**_valores_linha(target, CAMPOS_KPI_OS)).items():
+        _aplicar_delta_kpi(connection, chave, d_emi, d_con)
+
+@event.listens_for(OS, 'after_update')
+def _kpi_os_atualizada(mapper, connection, target):
+    antes = _kpi_contribuicoes(**_valores_linha(target, CAMPOS_KPI_OS, anteriores=True))
+    depois = _kpi_contribuicoes(**_valores_linha(target, CAMPOS_KPI_OS))
+    if antes == depois:
+        return
+    for chave in set(antes) | set(depois):
+        a_emi, a_con = antes.get(chave, (0, 0))
+        d_emi, d_con = depois.get(chave, (0, 0))
+        if (a_emi, a_con) != (d_emi, d_con):
+            _aplicar_delta_kpi(connection, chave, d_emi - a_emi, d_con - a_con)
+
+@event.listens_for(OS, 'after_delete')
+def _kpi_os_excluida(mapper, connection, target):
+    for chave, (d_emi, d_con) in _kpi_contribuicoes(**_valores_linha(target, CAMPOS_KPI_OS, anteriores=True)).items():
+        _aplicar_delta_kpi(connection, chave, -d_emi, -d_con)
+
+# ==============================================================================
+# VALORES DOS FILTROS DA OS (Tipo_OS, empresa, tipo_contrato)
+# ==============================================================================
+class OSDimensao(db.Model):
+    """Valores distintos usados nos filtros das telas de OS e do cronograma.
+
+    Alimentada pelos eventos do OS abaixo (só acrescenta valores novos) e
+    reconstruída com `flask rebuild-dimensoes`, que também remove os que
+    deixaram de ser usados.
+    """
+    __tablename__ = 'os_dimensao'
+    id = db.Column(db.Integer, primary_key=True)
+    campo = db.Column(db.String(20), nullable=False) # Nome do atributo no OS
+    valor = db.Column(db.String(50), nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('campo', 'valor', name='uq_os_dimensao_campo_valor'),
+    )
+
+CAMPOS_DIMENSAO_OS = ('Tipo_OS', 'empresa', 'tipo_contrato')
+
+def _registrar_dimensao(connection, campo, valor):
+    tabela = OSDimensao.__table__
+    if connection.dialect.name == 'mysql':
+        connection.execute(tabela.insert().prefix_with('IGNORE').values(campo=campo, valor=valor))
+        return
+    existe = connection.execute(
+        db.select(tabela.c.id).where(tabela.c.campo == campo, tabela.c.valor == valor)
+    ).first()
+    if existe is None:
+        connection.execute(tabela.insert().values(campo=campo, valor=valor))
+
+@event.listens_for(OS, 'after_insert')
+def _dimensoes_os_inserida(mapper, connection, target):
+    for campo in CAMPOS_DIMENSAO_OS:
+        valor = getattr(target, campo)
+        if valor:
+            _registrar_dimensao(connection, campo, valor)
+
+@event.listens_for(OS, 'after_update')
+def _dimensoes_os_atualizada(mapper, connection, target):
+    estado = inspect(target)
+    for campo in CAMPOS_DIMENSAO_OS:
+        valor = getattr(target, campo)
+        if valor and estado.attrs[campo].history.has_changes():
+            _registrar_dimensao(connection, campo, valor)
 
 class Carregamento(db.Model):
     __tablename__ = 'carregamento'
@@ -233,6 +618,18 @@ class OrdemProducao(db.Model):
     apontamentos = db.relationship('Apontamento', backref='ordem_producao', lazy=True, cascade="all, delete-orphan")
     paradas = db.relationship('ParadaNaoPlanejada', backref='ordem_producao', lazy=True, cascade="all, delete-orphan")
 
+    # Lista de OPs: cada filtro de igualdade seguido da chave da paginação
+    # (numero_sequencial), para ler a página na ordem do índice e parar no limite
+    __table_args__ = (
+        db.Index('ix_ordem_producao_status_numero', 'status', 'numero_sequencial'),
+        db.Index('ix_ordem_producao_depto_status_numero', 'departamento', 'status', 'numero_sequencial'),
+        db.Index('ix_ordem_producao_setor_numero', 'setor', 'numero_sequencial'),
+        db.Index('ix_ordem_producao_tipo_op_numero', 'tipo_op', 'numero_sequencial'),
+        db.Index('ix_ordem_producao_os_numero', 'os_id', 'numero_sequencial'),
+        # OPs abertas por data de carregamento (programação de expedição)
+        db.Index('ix_ordem_producao_status_carregamento', 'status', 'data_carregamento'),
+    )
+
 class Produto(db.Model):
     __tablename__ = 'produto'
     id = db.Column(db.Integer, primary_key=True)
@@ -271,6 +668,25 @@ class ControleProducao(db.Model):
     hora_termino = db.Column(db.Time, nullable=True)
     qualidade = db.Column(db.String(20), nullable=True)
 
+    # Relatório de horas: filtro por máquina/operador + período
+    __table_args__ = (
+        db.Index('ix_controle_producao_maquina_data', 'maquina', 'data_inicio'),
+        db.Index('ix_controle_producao_operador_data', 'operador', 'data_inicio'),
+        # Quadro ao vivo: etapas sem término
+        db.Index('ix_controle_producao_termino', 'data_termino'),
+    )
+
+class AlteracaoProducao(db.Model):
+    """Uma linha por gravação de OP (cabeçalho ou etapas de controle).
+
+    O id crescente é o cursor do quadro de produção ao vivo: o transmissor
+    lê só as linhas depois da última processada e recarrega aquelas OPs.
+    """
+    __tablename__ = 'alteracao_producao'
+    id = db.Column(db.Integer, primary_key=True)
+    ordem_producao_id = db.Column(db.Integer, nullable=False) # sem FK: sobrevive à exclusão da OP
+    momento = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
 class Romaneio(db.Model):
     __tablename__ = 'romaneio'
     id = db.Column(db.Integer, primary_key=True)
@@ -287,8 +703,8 @@ class Apontamento(db.Model):
     departamento = db.Column(db.String(50), nullable=True)
     obs_prod = db.Column(db.Text, nullable=True)
     turno = db.Column(db.String(5), nullable=False)
-    processo = db.Column(db.String(10), nullable=False)
-    maquina_operacao = db.Column(db.String(10), nullable=False)
+    processo = db.Column(db.String(100), nullable=False)
+    maquina_operacao = db.Column(db.String(100), nullable=False) # Nome como em MAQUINAS_POR_SETOR
     operador = db.Column(db.String(50), nullable=False)
     data_inicio = db.Column(db.Date, nullable=False)
     hora_inicio = db.Column(db.Time, nullable=False)
@@ -296,6 +712,12 @@ class Apontamento(db.Model):
     hora_termino = db.Column(db.Time, nullable=False)
     qualidade_aprovado = db.Column(db.Boolean, default=True)
 
+    # Relatório de horas: filtro por máquina/operador + período
+    __table_args__ = (
+        db.Index('ix_apontamento_maquina_data', 'maquina_operacao', 'data_inicio'),
+        db.Index('ix_apontamento_operador_data', 'operador', 'data_inicio'),
+    )
+
 class ParadaNaoPlanejada(db.Model):
     __tablename__ = 'parada_nao_planejada'
     id = db.Column(db.Integer, primary_key=True)
@@ -304,6 +726,10 @@ class ParadaNaoPlanejada(db.Model):
     tempo_espera = db.Column(db.Time, nullable=False)
     desvios_registrados = db.Column(db.Text, nullable=True)
     aprovacao_desvio = db.Column(db.String(50), nullable=True)
+    # Quando/onde a parada aconteceu (entra no OEE); registros antigos ficam sem
+    data = db.Column(db.Date, nullable=True)
+    turno = db.Column(db.String(5), nullable=True)
+    maquina = db.Column(db.String(100), nullable=True)
 
 # ==============================================================================
 # TABELAS DE MANUTENÇÃO
@@ -353,6 +779,299 @@ class ManutApont(db.Model):
     data_termino = db.Column(db.Date, nullable=True)
     hora_termino = db.Column(db.Time, nullable=True)
 
+# ==============================================================================
+# DURAÇÃO DE APONTAMENTOS (ControleProducao, Apontamento, ManutApont)
+# ==============================================================================
+# Os três guardam início e término em colunas separadas de data e hora. A
+# duração é calculada no banco, então serve tanto para uma OP quanto para
+# somar milhares de OPs numa consulta.
+SEGUNDOS_DIA = 86400
+
+class _SegundosEntre(FunctionElement):
+    """(data_fim + hora_fim) - (data_ini + hora_ini), em segundos."""
+    type = Integer()
+    inherit_cache = True
+    name = 'segundos_entre'
+
+@compiles(_SegundosEntre, 'mysql')
+def _segundos_entre_mysql(elemento, compiler, **kw):
+    di, hi, df, hf = (compiler.process(c, **kw) for c in elemento.clauses)
+    return f"TIMESTAMPDIFF(SECOND, TIMESTAMP({di}, {hi}), TIMESTAMP({df}, {hf}))"
+
+@compiles(_SegundosEntre)
+def _segundos_entre_padrao(elemento, compiler, **kw):
+    # SQLite (ambiente local): datas e horas ficam como texto ISO
+    di, hi, df, hf = (compiler.process(c, **kw) for c in elemento.clauses)
+    return (f"CAST(ROUND((julianday({df} || ' ' || {hf}) - julianday({di} || ' ' || {hi})) * {SEGUNDOS_DIA}) AS INTEGER)")
+
+def segundos_trabalhados(modelo):
+    """Expressão SQL com a duração de cada linha de `modelo`, em segundos.
+
+    NULL se faltar alguma data/hora. Término antes do início no mesmo dia é
+    turno que virou a noite (soma 24h); nos demais casos negativos, 0.
+    """
+    bruto = _SegundosEntre(modelo.data_inicio, modelo.hora_inicio, modelo.data_termino, modelo.hora_termino)
+    return case(
+        (or_(modelo.data_inicio.is_(None), modelo.hora_inicio.is_(None),
+             modelo.data_termino.is_(None), modelo.hora_termino.is_(None)), None),
+        (bruto >= 0, bruto),
+        (modelo.data_termino == modelo.data_inicio, bruto + SEGUNDOS_DIA),
+        else_=0
+    )
+
+def duracoes_trabalhadas(modelo, *filtros):
+    """Duração de cada linha filtrada e o total, numa consulta só.
+
+    Retorna ({id: segundos ou None}, total_segundos).
+    """
+    segundos = segundos_trabalhados(modelo)
+    linhas = db.session.query(modelo.id, segundos, func.sum(segundos).over()).filter(*filtros).all()
+    por_linha = {linha_id: (int(s) if s is not None else None) for linha_id, s, _ in linhas}
+    total = int(linhas[0][2] or 0) if linhas else 0
+    return por_linha, total
+
+class _InicioSemana(FunctionElement):
+    """Segunda-feira da semana da data."""
+    type = db.Date()
+    inherit_cache = True
+    name = 'inicio_semana'
+
+@compiles(_InicioSemana, 'mysql')
+def _inicio_semana_mysql(elemento, compiler, **kw):
+    data = compiler.process(list(elemento.clauses)[0], **kw)
+    return f"DATE_SUB({data}, INTERVAL WEEKDAY({data}) DAY)"
+
+@compiles(_InicioSemana)
+def _inicio_semana_padrao(elemento, compiler, **kw):
+    data = compiler.process(list(elemento.clauses)[0], **kw)
+    return f"date({data}, '-' || ((CAST(strftime('%w', {data}) AS INTEGER) + 6) % 7) || ' days')"
+
+def inicio_semana(coluna_data):
+    return _InicioSemana(coluna_data)
+
+class _DiasEntre(FunctionElement):
+    """data_fim - data_ini, em dias."""
+    type = Integer()
+    inherit_cache = True
+    name = 'dias_entre'
+
+@compiles(_DiasEntre, 'mysql')
+def _dias_entre_mysql(elemento, compiler, **kw):
+    di, df = (compiler.process(c, **kw) for c in elemento.clauses)
+    return f"DATEDIFF({df}, {di})"
+
+@compiles(_DiasEntre)
+def _dias_entre_padrao(elemento, compiler, **kw):
+    di, df = (compiler.process(c, **kw) for c in elemento.clauses)
+    return f"CAST(julianday({df}) - julianday({di}) AS INTEGER)"
+
+def dias_entre(data_ini, data_fim):
+    return _DiasEntre(data_ini, data_fim)
+
+# ==============================================================================
+# DURAÇÃO MÁXIMA DAS OS (LIMITE INFERIOR DA JANELA DO CRONOGRAMA)
+# ==============================================================================
+class DuracaoMaximaOS(db.Model):
+    """Maior data_termino - data_inicio (em dias) já gravado, por fase.
+
+    O cronograma lê as OS com data_inicio a partir do início da janela menos
+    esse valor. Só cresce: os eventos do OS o elevam na mesma transação que
+    grava a OS; encurtar ou excluir uma OS deixa o limite folgado, não errado.
+    """
+    __tablename__ = 'os_duracao_maxima'
+    fase = db.Column(db.String(20), primary_key=True)
+    dias = db.Column(db.Integer, nullable=False, default=0)
+
+def registrar_duracao_os(connection, fase, dias):
+    """Eleva o máximo da fase para `dias`, se for maior. Chamar também nas
+    gravações em lote (INSERT de várias linhas), que não disparam os eventos."""
+    tabela = DuracaoMaximaOS.__table__
+    if connection.dialect.name == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(tabela).values(fase=fase, dias=dias)
+        connection.execute(stmt.on_duplicate_key_update(dias=func.greatest(tabela.c.dias, stmt.inserted.dias)))
+        return
+    resultado = connection.execute(tabela.update().where(tabela.c.fase == fase)
+                                   .values(dias=func.max(tabela.c.dias, dias)))
+    if resultado.rowcount == 0:
+        connection.execute(tabela.insert().values(fase=fase, dias=dias))
+
+def duracao_maxima_os(fase):
+    """Máximo gravado da fase. Sem linha (tabela recém-criada), calcula a
+    partir das OS existentes e grava."""
+    dias = db.session.query(DuracaoMaximaOS.dias).filter_by(fase=fase).scalar()
+    if dias is None:
+        dias = db.session.query(func.max(dias_entre(OS.data_inicio, OS.data_termino)))\
+            .filter(OS.fase == fase).scalar() or 0
+        registrar_duracao_os(db.session.connection(), fase, dias)
+        db.session.commit()
+    return dias
+
+@event.listens_for(OS, 'after_insert')
+@event.listens_for(OS, 'after_update')
+def _duracao_os_gravada(mapper, connection, target):
+    estado = inspect(target)
+    if not any(estado.attrs[c].history.has_changes() for c in ('fase', 'data_inicio', 'data_termino')):
+        return
+    if target.fase and target.data_inicio and target.data_termino:
+        registrar_duracao_os(connection, target.fase, (target.data_termino - target.data_inicio).days)
+
+# ==============================================================================
+# OEE POR MÁQUINA E TURNO (CONSOLIDADO DIÁRIO)
+# ==============================================================================
+class OEETurno(db.Model):
+    """Tempos e contagens por dia x máquina x turno para o painel de OEE.
+
+    Mantida pelos eventos de Apontamento e ParadaNaoPlanejada abaixo (somam
+    e subtraem a contribuição de cada linha) e reconstruída em lotes com
+    `flask rebuild-oee`.
+
+    Disponibilidade = produção / (produção + paradas); Qualidade = aprovados /
+    apontamentos. Desempenho precisaria de tempo de ciclo padrão e quantidade
+    produzida por apontamento, que o sistema não registra.
+    """
+    __tablename__ = 'oee_turno'
+    id = db.Column(db.Integer, primary_key=True)
+    data = db.Column(db.Date, nullable=False)
+    maquina = db.Column(db.String(100), nullable=False, default='')
+    turno = db.Column(db.String(5), nullable=False, default='')
+    segundos_producao = db.Column(db.Integer, nullable=False, default=0)
+    segundos_parada = db.Column(db.Integer, nullable=False, default=0)
+    qtd_apontamentos = db.Column(db.Integer, nullable=False, default=0)
+    qtd_aprovados = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('data', 'maquina', 'turno', name='uq_oee_turno_chave'),
+    )
+
+CAMPOS_OEE = ('segundos_producao', 'segundos_parada', 'qtd_apontamentos', 'qtd_aprovados')
+
+def segundos_entre(data_inicio, hora_inicio, data_termino, hora_termino):
+    """Mesma regra de segundos_trabalhados(), para uma linha já em memória."""
+    if None in (data_inicio, hora_inicio, data_termino, hora_termino):
+        return None
+    bruto = int((datetime.combine(data_termino, hora_termino) - datetime.combine(data_inicio, hora_inicio)).total_seconds())
+    if bruto >= 0:
+        return bruto
+    return bruto + SEGUNDOS_DIA if data_termino == data_inicio else 0
+
+def _contribuicao_apontamento(v):
+    if v['data_inicio'] is None:
+        return {}
+    chave = (v['data_inicio'], v['maquina_operacao'] or '', v['turno'] or '')
+    aprovado = 1 if v['qualidade_aprovado'] or v['qualidade_aprovado'] is None else 0
+    segundos = segundos_entre(v['data_inicio'], v['hora_inicio'], v['data_termino'], v['hora_termino']) or 0
+    return {chave: (segundos, 0, 1, aprovado)}
+
+def _contribuicao_parada(v):
+    if v['data'] is None or v['tempo_espera'] is None:
+        return {}
+    t = v['tempo_espera']
+    chave = (v['data'], v['maquina'] or '', v['turno'] or '')
+    return {chave: (0, t.hour * 3600 + t.minute * 60 + t.second, 0, 0)}
+
+def _aplicar_delta_oee(connection, chave, deltas):
+    tabela = OEETurno.__table__
+    data, maquina, turno = chave
+    valores = dict(zip(CAMPOS_OEE, deltas))
+    if connection.dialect.name == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(tabela).values(data=data, maquina=maquina, turno=turno, **valores)
+        stmt = stmt.on_duplicate_key_update(**{c: tabela.c[c] + d for c, d in valores.items()})
+        connection.execute(stmt)
+        return
+    # Outros bancos (ex.: SQLite local): UPDATE e, se não existir, INSERT
+    resultado = connection.execute(
+        tabela.update()
+        .where(tabela.c.data == data, tabela.c.maquina == maquina, tabela.c.turno == turno)
+        .values(**{c: tabela.c[c] + d for c, d in valores.items()})
+    )
+    if resultado.rowcount == 0:
+        connection.execute(tabela.insert().values(data=data, maquina=maquina, turno=turno, **valores))
+
+def aplicar_oee_em_lote(connection, apontamentos=(), paradas=()):
+    """Para INSERTs de várias linhas, que não disparam os eventos do mapper:
+    soma a contribuição das linhas (dicts com as colunas) e aplica um delta por chave."""
+    total = defaultdict(lambda: [0, 0, 0, 0])
+    for linhas, contribuicao in ((apontamentos, _contribuicao_apontamento), (paradas, _contribuicao_parada)):
+        for v in linhas:
+            for chave, valores in contribuicao(v).items():
+                total[chave] = [t + x for t, x in zip(total[chave], valores)]
+    for chave, deltas in total.items():
+        if any(deltas):
+            _aplicar_delta_oee(connection, chave, deltas)
+
+def _registrar_eventos_oee(modelo, campos, contribuicao):
+    _guardar_valores_anteriores(modelo, campos)
+
+    def aplicar(connection, antes, depois):
+        for chave in set(antes) | set(depois):
+            a = antes.get(chave, (0, 0, 0, 0))
+            d = depois.get(chave, (0, 0, 0, 0))
+            if a != d:
+                _aplicar_delta_oee(connection, chave, [x - y for x, y in zip(d, a)])
+
+    @event.listens_for(modelo, 'after_insert')
+    def _inserido(mapper, connection, target):
+        aplicar(connection, {}, contribuicao(_valores_linha(target, campos)))
+
+    @event.listens_for(modelo, 'after_update')
+    def _atualizado(mapper, connection, target):
+        aplicar(connection, contribuicao(_valores_linha(target, campos, anteriores=True)),
+                contribuicao(_valores_linha(target, campos)))
+
+    @event.listens_for(modelo, 'after_delete')
+    def _excluido(mapper, connection, target):
+        aplicar(connection, contribuicao(_valores_linha(target, campos, anteriores=True)), {})
+
+_registrar_eventos_oee(
+    Apontamento,
+    ('data_inicio', 'hora_inicio', 'data_termino', 'hora_termino', 'maquina_operacao', 'turno', 'qualidade_aprovado'),
+    _contribuicao_apontamento
+)
+_registrar_eventos_oee(ParadaNaoPlanejada, ('data', 'maquina', 'turno', 'tempo_espera'), _contribuicao_parada)
+
+# ==============================================================================
+# EVENTOS DOS TERMINAIS DE CHÃO DE FÁBRICA
+# ==============================================================================
+class EventoApontamento(db.Model):
+    """Eventos início/pausa/fim recebidos dos terminais, só acrescentados.
+
+    A `chave` é gerada pelo terminal: reenviar o mesmo evento (timeout, rede
+    instável) não duplica o apontamento.
+    """
+    __tablename__ = 'evento_apontamento'
+    id = db.Column(db.Integer, primary_key=True)
+    chave = db.Column(db.String(64), unique=True, nullable=False)
+    tipo = db.Column(db.String(10), nullable=False) # 'inicio', 'pausa' ou 'fim'
+    maquina = db.Column(db.String(100), nullable=False)
+    momento = db.Column(db.DateTime, nullable=False)
+    ordem_producao_id = db.Column(db.Integer, db.ForeignKey('ordem_producao.id'), nullable=True)
+    departamento = db.Column(db.String(50), nullable=True)
+    turno = db.Column(db.String(5), nullable=True)
+    processo = db.Column(db.String(100), nullable=True)
+    operador = db.Column(db.String(50), nullable=True)
+    motivo = db.Column(db.String(50), nullable=True)
+    aprovado = db.Column(db.Boolean, nullable=True)
+    recebido_em = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+class PostoMaquina(db.Model):
+    """Situação atual de cada máquina segundo os terminais ('livre', 'produzindo', 'pausada').
+
+    Guarda o início do trecho em aberto: o próximo evento da máquina fecha o
+    trecho em um Apontamento (produzindo) ou em uma ParadaNaoPlanejada (pausada).
+    """
+    __tablename__ = 'posto_maquina'
+    maquina = db.Column(db.String(100), primary_key=True)
+    situacao = db.Column(db.String(12), nullable=False, default='livre')
+    desde = db.Column(db.DateTime, nullable=False)
+    ordem_producao_id = db.Column(db.Integer, db.ForeignKey('ordem_producao.id'), nullable=True)
+    departamento = db.Column(db.String(50), nullable=True)
+    turno = db.Column(db.String(5), nullable=True)
+    processo = db.Column(db.String(100), nullable=True)
+    operador = db.Column(db.String(50), nullable=True)
+    motivo = db.Column(db.String(50), nullable=True)
+
 # ==============================================================================
 # MÓDULO DE COMPRAS E SUPRIMENTOS (Adicione isto ao final do models.py)
 # ==============================================================================
@@ -452,4 +1171,424 @@ class PedidoItem(db.Model):
     descricao = db.Column(db.String(100), nullable=False)
     quantidade = db.Column(db.Numeric(10, 2), nullable=False)
     valor_unitario = db.Column(db.Numeric(10, 2), nullable=False)
-    valor_total_item = db.Column(db.Numeric(10, 2), nullable=False)
\ No newline at end of file
+    valor_total_item = db.Column(db.Numeric(10, 2), nullable=False)
+
+
+# ==============================================================================
+# NUMERAÇÃO DE DOCUMENTOS (OP, OS DE MANUTENÇÃO, PEDIDO DE COMPRA)
+# ==============================================================================
+class SequenciaDocumento(db.Model):
+    """Próximo número livre de cada sequência ('op', 'pedido-2026', ...)."""
+    __tablename__ = 'sequencia_documento'
+    nome = db.Column(db.String(30), primary_key=True)
+    proximo = db.Column(db.Integer, nullable=False)
+
+class AlocadorNumeros:
+    """Entrega números únicos por sequência, sem max()+1.
+
+    A reserva roda numa transação própria e curta (UPDATE proximo = proximo + n
+    trava só a linha da sequência), fora da transação do documento: quem está
+    salvando uma OP não segura a numeração dos outros. Com bloco > 1 cada
+    processo reserva vários números de uma vez e os entrega da memória.
+    Número reservado e não usado (rollback, reinício do processo) vira
+    lacuna, nunca repetição.
+    """
+
+    def __init__(self):
+        self._sequencias = {}
+        self._blocos = {}
+        self._lock = Lock()
+
+    def registrar(self, nome, semente=None, bloco=1, por_ano=False):
+        """`semente(connection)` devolve o maior número já usado antes da
+        sequência existir; sequências por ano recomeçam em 1 a cada ano."""
+        self._sequencias[nome] = {'semente': None if por_ano else semente, 'bloco': max(1, bloco), 'por_ano': por_ano}
+
+    def _chave(self, nome, ano):
+        if self._sequencias[nome]['por_ano']:
+            return f"{nome}-{ano or date.today().year}"
+        return nome
+
+    def proximo(self, nome, ano=None):
+        chave = self._chave(nome, ano)
+        with self._lock:
+            atual, limite = self._blocos.get(chave, (0, 0))
+            if atual >= limite:
+                atual, limite = self._reservar(chave, self._sequencias[nome])
+            self._blocos[chave] = (atual + 1, limite)
+            return atual
+
+    def espiar(self, nome, ano=None):
+        """Número provável do próximo documento, sem reservar (só para exibir)."""
+        chave = self._chave(nome, ano)
+        with self._lock:
+            atual, limite = self._blocos.get(chave, (0, 0))
+            if atual < limite:
+                return atual
+        valor = db.session.query(SequenciaDocumento.proximo).filter_by(nome=chave).scalar()
+        if valor is None:
+            config = self._sequencias[nome]
+            valor = (config['semente'](db.session.connection()) or 0) + 1 if config['semente'] else 1
+        return valor
+
+    def _reservar(self, chave, config):
+        """Reserva o bloco [inicio, fim) no banco."""
+        from sqlalchemy.exc import IntegrityError
+        tabela = SequenciaDocumento.__table__
+        tamanho = config['bloco']
+        for _ in range(3):
+            with db.engine.begin() as conn:
+                resultado = conn.execute(
+                    tabela.update().where(tabela.c.nome == chave).values(proximo=tabela.c.proximo + tamanho)
+                )
+                if resultado.rowcount:
+                    fim = conn.execute(db.select(tabela.c.proximo).where(tabela.c.nome == chave)).scalar()
+                    return fim - tamanho, fim
+            # Primeiro uso: cria a linha continuando do maior número existente
+            try:
+                with db.engine.begin() as conn:
+                    semente = config['semente'](conn) if config['semente'] else 0
+                    conn.execute(tabela.insert().values(nome=chave, proximo=(semente or 0) + 1))
+            except IntegrityError:
+                pass # Outro processo criou ao mesmo tempo: só tentar o UPDATE de novo
+        raise RuntimeError(f"Não foi possível reservar números da sequência '{chave}'")
+
+alocador_numeros = AlocadorNumeros()
+
+# ==============================================================================
+# CATÁLOGO DE PRODUTOS EM MEMÓRIA (BUSCA E CONSULTA POR PART NUMBER)
+# ==============================================================================
+class VersaoCadastro(db.Model):
+    """Carimbo de versão de cadastros mantidos em memória ('produto', ...).
+
+    Incrementado na mesma transação que altera o cadastro; cada processo
+    compara com a versão do seu índice para saber se precisa recarregar.
+    """
+    __tablename__ = 'versao_cadastro'
+    nome = db.Column(db.String(30), primary_key=True)
+    versao = db.Column(db.Integer, nullable=False, default=0)
+
+def marcar_versao_cadastro(connection, nome):
+    """Incrementa a versão do cadastro. Chamar também nas gravações em lote
+    (INSERT de várias linhas, bulk_save_objects), que não disparam os eventos."""
+    tabela = VersaoCadastro.__table__
+    if connection.dialect.name == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        connection.execute(insert(tabela).values(nome=nome, versao=1)
+                           .on_duplicate_key_update(versao=tabela.c.versao + 1))
+    else:
+        resultado = connection.execute(tabela.update().where(tabela.c.nome == nome).values(versao=tabela.c.versao + 1))
+        if resultado.rowcount == 0:
+            connection.execute(tabela.insert().values(nome=nome, versao=1))
+    if nome == 'produto':
+        catalogo_produtos.invalidar()
+
+def normalizar_busca(texto):
+    """Minúsculas e sem acentos, para comparar termos digitados com o cadastro."""
+    texto = texto or ''
+    if not texto.isascii():
+        texto = unicodedata.normalize('NFKD', texto).encode('ascii', 'ignore').decode('ascii')
+    return texto.casefold().strip()
+
+TERMO_BUSCA = re.compile(r'[0-9a-z]+')
+
+CAMPOS_PRODUTO = ('id', 'part_number', 'sku', 'descricao', 'tipo_de_material', 'custo', 'unidade')
+
+class IndiceProdutos:
+    """Retrato imutável do cadastro de produtos, montado de uma vez.
+
+    Produtos ficam em ordem de part_number normalizado, então a posição já é
+    a ordem de exibição. Prefixos de part_number e SKU são faixas em listas
+    ordenadas (bisect: a mesma consulta de uma trie, com bem menos memória).
+    Os termos da descrição, do part_number e do SKU formam um índice
+    invertido termo -> posições, também ordenado para expandir prefixos.
+    """
+
+    # Termos em pelo menos tantos produtos guardam o mapa de bits
+    MIN_POSICOES_MAPA = 256
+    # Prefixo que expande para mais termos que isso (ex.: uma letra) guarda o
+    # mapa de bits da faixa inteira, até MAX_FAIXAS_GUARDADAS faixas
+    MAX_TERMOS_PREFIXO = 64
+    MAX_FAIXAS_GUARDADAS = 256
+    # Grade de produtos: colunas ordenáveis/filtráveis e resultados guardados
+    COLUNAS_ORDEM = ('part_number', 'sku', 'descricao', 'tipo_de_material', 'unidade', 'custo')
+    COLUNAS_FILTRO = ('tipo_de_material', 'unidade')
+    MAX_LISTAS_GUARDADAS = 16
+
+    def __init__(self, linhas, versao):
+        self.versao = versao
+        normalizadas = sorted(
+            ((normalizar_busca(l[1]), normalizar_busca(l[2]), normalizar_busca(l[3]), l) for l in linhas),
+            key=lambda n: n[0]
+        )
+        self.produtos = [tuple(l[:5]) + (str(l[5]), l[6]) for _, _, _, l in normalizadas]
+        self._part_numbers = [pn for pn, _, _, _ in normalizadas]
+        self._por_part_number = {pn: pos for pos, pn in enumerate(self._part_numbers)}
+        skus = sorted((sku, pos) for pos, (_, sku, _, _) in enumerate(normalizadas) if sku)
+        self._skus = [s for s, _ in skus]
+        self._skus_pos = [p for _, p in skus]
+        self._sku_por_pos = [sku for _, sku, _, _ in normalizadas]
+
+        postagens = defaultdict(list)
+        for pos, (pn, sku, descricao, _) in enumerate(normalizadas):
+            for termo in set(TERMO_BUSCA.findall(f"{descricao} {pn} {sku}")):
+                postagens[termo].append(pos)
+        self._termos = sorted(postagens)
+        self._postagens = [postagens[t] for t in self._termos]
+        # Termos frequentes já saem com o mapa de bits (int: bit p = posição p) pronto
+        self._mapas = {}
+        for i, posicoes in enumerate(self._postagens):
+            if len(posicoes) >= self.MIN_POSICOES_MAPA:
+                self._mapa_termo(i)
+        self._mapas_faixa = {}
+        self._ordens = {}
+        self._mapas_valor = {}
+        self._listas = {}
+
+    @staticmethod
+    def _faixa(chaves, prefixo):
+        return bisect_left(chaves, prefixo), bisect_left(chaves, prefixo + '\uffff')
+
+    def como_dict(self, pos):
+        return dict(zip(CAMPOS_PRODUTO, self.produtos[pos]))
+
+    def por_part_number(self, part_number):
+        pos = self._por_part_number.get(normalizar_busca(part_number))
+        return None if pos is None else self.como_dict(pos)
+
+    def buscar(self, texto, limite=50):
+        """Prefixo de part_number, depois prefixo de SKU, depois produtos em que
+        cada termo digitado começa algum termo do cadastro; cada grupo em ordem
+        de part_number."""
+        prefixo = normalizar_busca(texto)
+        if not prefixo:
+            return []
+        achados, vistos = [], set()
+
+        def incluir(posicoes):
+            for pos in posicoes:
+                if len(achados) >= limite:
+                    return
+                if pos not in vistos:
+                    vistos.add(pos)
+                    achados.append(pos)
+
+        inicio, fim = self._faixa(self._part_numbers, prefixo)
+        incluir(range(inicio, min(fim, inicio + limite)))
+        if len(achados) < limite:
+            inicio, fim = self._faixa(self._skus, prefixo)
+            if (fim - inicio) ** 2 > len(self.produtos) * limite:
+                # Faixa larga: varrer em ordem de part_number acha o limite antes
+                incluir(pos for pos, sku in enumerate(self._sku_por_pos) if sku.startswith(prefixo))
+            else:
+                incluir(heapq.nsmallest(limite, self._skus_pos[inicio:fim]))
+        termos = TERMO_BUSCA.findall(prefixo)
+        if termos and len(achados) < limite:
+            incluir(self._por_termos(termos, vistos, limite - len(achados)))
+        return [self.como_dict(pos) for pos in achados]
+
+    def _mapa_termo(self, i):
+        mapa = self._mapas.get(i)
+        if mapa is None:
+            bits = bytearray(len(self.produtos) // 8 + 1)
+            for pos in self._postagens[i]:
+                bits[pos >> 3] |= 1 << (pos & 7)
+            mapa = self._mapas[i] = int.from_bytes(bits, 'little')
+        return mapa
+
+    def _mapa_faixa(self, inicio, fim):
+        """Bit p ligado = o produto na posição p tem algum termo da faixa."""
+        larga = fim - inicio > self.MAX_TERMOS_PREFIXO
+        if larga and (inicio, fim) in self._mapas_faixa:
+            return self._mapas_faixa[inicio, fim]
+        mapa, bits = 0, None
+        for i in range(inicio, fim):
+            if len(self._postagens[i]) >= self.MIN_POSICOES_MAPA:
+                mapa |= self._mapa_termo(i)
+                continue
+            if bits is None:
+                bits = bytearray(len(self.produtos) // 8 + 1)
+            for pos in self._postagens[i]:
+                bits[pos >> 3] |= 1 << (pos & 7)
+        if bits is not None:
+            mapa |= int.from_bytes(bits, 'little')
+        if larga:
+            if len(self._mapas_faixa) >= self.MAX_FAIXAS_GUARDADAS:
+                self._mapas_faixa.clear()
+            self._mapas_faixa[inicio, fim] = mapa
+        return mapa
+
+    @staticmethod
+    def _posicoes(mapa):
+        while mapa:
+            menor = mapa & -mapa
+            yield menor.bit_length() - 1
+            mapa ^= menor
+
+    def _por_termos(self, termos, vistos, limite):
+        faixas = [self._faixa(self._termos, t) for t in termos]
+        if any(inicio == fim for inicio, fim in faixas):
+            return []
+        if len(faixas) == 1 and faixas[0][1] - faixas[0][0] <= self.MAX_TERMOS_PREFIXO:
+            inicio, fim = faixas[0]
+            candidatos = heapq.merge(*self._postagens[inicio:fim]) # já em ordem, para no limite
+        else:
+            # E dos mapas de bits, lido do menor bit (= ordem de part_number)
+            mapa = -1
+            for inicio, fim in faixas:
+                mapa &= self._mapa_faixa(inicio, fim)
+            candidatos = self._posicoes(mapa)
+
+        achados, ultimo = [], None
+        for pos in candidatos:
+            if pos == ultimo or pos in vistos:
+                continue
+            ultimo = pos
+            achados.append(pos)
+            if len(achados) >= limite:
+                break
+        return achados
+
+    def _ordem(self, coluna):
+        """Posições em ordem da coluna (empate: part_number), montada na primeira vez."""
+        ordem = self._ordens.get(coluna)
+        if ordem is None:
+            if coluna == 'part_number':
+                ordem = range(len(self.produtos))
+            else:
+                i = CAMPOS_PRODUTO.index(coluna)
+                if coluna == 'custo':
+                    chave = lambda pos: Decimal(self.produtos[pos][i])
+                else:
+                    chave = lambda pos: normalizar_busca(self.produtos[pos][i])
+                ordem = sorted(range(len(self.produtos)), key=chave)
+            self._ordens[coluna] = ordem
+        return ordem
+
+    def valores(self, coluna):
+        """Valores distintos da coluna, para os filtros da grade."""
+        i = CAMPOS_PRODUTO.index(coluna)
+        return sorted({p[i] for p in self.produtos if p[i]})
+
+    def _mapa_valor(self, coluna, valor):
+        mapa = self._mapas_valor.get((coluna, valor))
+        if mapa is None:
+            i = CAMPOS_PRODUTO.index(coluna)
+            bits = bytearray(len(self.produtos) // 8 + 1)
+            for pos, produto in enumerate(self.produtos):
+                if produto[i] == valor:
+                    bits[pos >> 3] |= 1 << (pos & 7)
+            mapa = self._mapas_valor[coluna, valor] = int.from_bytes(bits, 'little')
+        return mapa
+
+    def _mapa_texto(self, prefixo):
+        """Mesmo critério de buscar(), sem limite: prefixo de part_number ou SKU,
+        ou todos os termos digitados."""
+        inicio, fim = self._faixa(self._part_numbers, prefixo)
+        mapa = (1 << fim) - (1 << inicio)
+        inicio, fim = self._faixa(self._skus, prefixo)
+        if fim > inicio:
+            bits = bytearray(len(self.produtos) // 8 + 1)
+            for pos in self._skus_pos[inicio:fim]:
+                bits[pos >> 3] |= 1 << (pos & 7)
+            mapa |= int.from_bytes(bits, 'little')
+        termos = TERMO_BUSCA.findall(prefixo)
+        if termos:
+            por_termos = -1
+            for termo in termos:
+                inicio, fim = self._faixa(self._termos, termo)
+                por_termos &= self._mapa_faixa(inicio, fim) if fim > inicio else 0
+            mapa |= por_termos
+        return mapa
+
+    def listar(self, texto='', filtros=None, ordenar='part_number', decrescente=False, inicio=0, quantidade=100):
+        """Uma janela da grade de produtos: (total filtrado, produtos de inicio a
+        inicio + quantidade). A lista filtrada e ordenada fica guardada, então
+        rolar a grade só fatia a mesma lista."""
+        filtros = tuple(sorted((filtros or {}).items()))
+        chave = (normalizar_busca(texto), filtros, ordenar, decrescente)
+        posicoes = self._listas.get(chave)
+        if posicoes is None:
+            posicoes = self._ordem(ordenar)
+            mapa = self._mapa_texto(chave[0]) if chave[0] else -1
+            for coluna, valor in filtros:
+                mapa &= self._mapa_valor(coluna, valor)
+            if mapa != -1:
+                bits = mapa.to_bytes(len(self.produtos) // 8 + 1, 'little')
+                posicoes = [pos for pos in posicoes if bits[pos >> 3] >> (pos & 7) & 1]
+            if decrescente:
+                posicoes = posicoes[::-1]
+            if len(self._listas) >= self.MAX_LISTAS_GUARDADAS:
+                self._listas.clear()
+            self._listas[chave] = posicoes
+        return len(posicoes), [self.como_dict(pos) for pos in posicoes[inicio:inicio + quantidade]]
+
+class CatalogoProdutos:
+    """Índice de produtos por processo, recarregado quando a versão muda.
+
+    Confere o carimbo em versao_cadastro no máximo a cada `intervalo`
+    segundos (uma leitura por chave primária); o processo que grava o
+    produto confere já na próxima chamada. Só a primeira carga do processo
+    é feita no pedido; as recargas rodam numa thread e, até terminarem,
+    todos os pedidos (inclusive os do processo que gravou) usam o índice
+    anterior.
+    """
+
+    def __init__(self, intervalo=2):
+        self.intervalo = intervalo
+        self._indice = None
+        self._conferido_em = 0
+        self._lock = Lock()
+        self.recargas = 0
+
+    def invalidar(self):
+        self._conferido_em = 0
+
+    def _carregar(self, versao):
+        linhas = db.session.query(*[getattr(Produto, c) for c in CAMPOS_PRODUTO]).all()
+        self._indice = IndiceProdutos(linhas, versao)
+        self.recargas += 1
+
+    def _recarregar(self, app, versao):
+        # Roda na thread; o lock foi adquirido por obter()
+        try:
+            with app.app_context():
+                try:
+                    self._carregar(versao)
+                finally:
+                    db.session.remove()
+        except Exception as e:
+            print(f"Erro ao recarregar o catálogo de produtos: {e}")
+            self._conferido_em = 0  # tenta de novo na próxima chamada
+        finally:
+            self._lock.release()
+
+    def obter(self):
+        indice = self._indice
+        agora = monotonic()
+        if indice is not None and agora - self._conferido_em < self.intervalo:
+            return indice
+        self._conferido_em = agora
+        versao = db.session.query(VersaoCadastro.versao).filter_by(nome='produto').scalar() or 0
+        if indice is not None and indice.versao == versao:
+            return indice
+        if not self._lock.acquire(blocking=indice is None):
+            return indice
+        if indice is not None:
+            Thread(target=self._recarregar, args=(current_app._get_current_object(), versao),
+                   name='catalogo-produtos', daemon=True).start()
+            return indice
+        try:
+            if self._indice is None:
+                self._carregar(versao)
+            return self._indice
+        finally:
+            self._lock.release()
+
+catalogo_produtos = CatalogoProdutos()
+
+@event.listens_for(Produto, 'after_insert')
+@event.listens_for(Produto, 'after_update')
+@event.listens_for(Produto, 'after_delete')
+def _produto_alterado(mapper, connection, target):
+    marcar_versao_cadastro(connection, 'produto')
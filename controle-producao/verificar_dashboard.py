@@ -0,0 +1,49 @@
+from app import app, db
+from sqlalchemy import event
+
+# Conta quantas consultas o dashboard envia ao banco.
+# Versão anterior: 6 consultas numa única requisição (4 COUNT + 2 GROUP BY).
+# Agora a página '/' não consulta o banco e cada painel faz no máximo 2 consultas:
+# a leitura do marcador de rebuild-kpis (consolidado_reconstruido) e a consulta
+# do painel, no os_kpi_mensal ou, antes do rebuild, direto na tabela os.
+# A evolução fica em cache: repetida, não faz nenhuma consulta.
+CONSULTAS_ANTES = 6
+LIMITES = {
+    '/': 0,
+    '/api/dashboard/kpis': 2,
+    '/api/dashboard/evolucao?meses=12': 2,
+    '/api/dashboard/status': 2,
+    '/api/dashboard/antigas': 1,
+}
+
+with app.app_context():
+    consultas = []
+
+    def contar(conn, cursor, statement, parameters, context, executemany):
+        consultas.append(statement)
+
+    app.config['LOGIN_DISABLED'] = True
+    event.listen(db.engine, 'before_cursor_execute', contar)
+    falhas = []
+    try:
+        with app.test_client() as client:
+            for url, limite in LIMITES.items():
+                consultas.clear()
+                resposta = client.get(url)
+                print(f"{url}: HTTP {resposta.status_code}, {len(consultas)} consulta(s) (limite {limite})")
+                if resposta.status_code != 200:
+                    falhas.append(f"{url} respondeu {resposta.status_code}")
+                if len(consultas) > limite:
+                    falhas.append(f"{url} fez {len(consultas)} consultas (limite {limite})")
+
+            consultas.clear()
+            client.get('/api/dashboard/evolucao?meses=12')
+            print(f"/api/dashboard/evolucao?meses=12 (em cache): {len(consultas)} consulta(s) (limite 0)")
+            if consultas:
+                falhas.append(f"evolução em cache fez {len(consultas)} consultas (limite 0)")
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', contar)
+
+    print(f"Consultas por requisição: antes={CONSULTAS_ANTES}, agora=no máximo {max(LIMITES.values())}")
+    assert not falhas, "; ".join(falhas)
+    print("OK: dashboard dentro do limite de consultas.")